@@ -0,0 +1,97 @@
+# accel_proxy.py (本地调试用的前置代理, 模拟 nginx 对 X-Accel-Redirect 的处理)
+# 用法: python main.py --prod --offload x-accel --port 5000
+#       python accel_proxy.py --upstream http://127.0.0.1:5000 --root .. --port 8080
+# 正式部署请用 nginx, 配置见 main.py 中 MEDIA_OFFLOAD 的注释
+import argparse
+import http.client
+import os
+import re
+import shutil
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+_HOP_HEADERS = {"server", "date", "connection", "keep-alive", "transfer-encoding", "content-length", "x-accel-redirect", "x-sendfile"}
+
+def _make_handler(upstream: str, root: str, prefix: str):
+    target = urlsplit(upstream)
+
+    class AccelProxyHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _proxy(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            conn = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=300)
+            headers = {k: v for k, v in self.headers.items() if k.lower() not in ("connection", "host")}
+            conn.request(self.command, self.path, body=body or None, headers=headers)
+            upstream_response = conn.getresponse()
+            internal = upstream_response.getheader("X-Accel-Redirect")
+            if internal and internal.startswith(prefix):
+                upstream_response.read(); conn.close()
+                # 与 nginx 一致: 保留上游的 Content-Type / Cache-Control 等头, 响应体换成磁盘上的文件
+                passthrough = [(k, v) for k, v in upstream_response.getheaders() if k.lower() not in _HOP_HEADERS]
+                return self._send_file(os.path.join(root, unquote(internal[len(prefix):])), passthrough)
+            payload = upstream_response.read(); conn.close()
+            self.send_response(upstream_response.status)
+            for key, value in upstream_response.getheaders():
+                if key.lower() not in _HOP_HEADERS: self.send_header(key, value)
+            self.send_header("Content-Length", str(len(payload))); self.end_headers()
+            if self.command != "HEAD": self.wfile.write(payload)
+
+        def _send_file(self, path: str, headers):
+            try: f = open(path, "rb")
+            except OSError:
+                self.send_response(404); self.send_header("Content-Length", "0"); self.end_headers(); return
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                start, end, status = 0, size - 1, 200
+                match = _RANGE_RE.match(self.headers.get("Range", ""))
+                if match and (match.group(1) or match.group(2)):
+                    if match.group(1): start, end = int(match.group(1)), min(int(match.group(2) or size - 1), size - 1)
+                    else: start = max(0, size - int(match.group(2)))
+                    if start > end:
+                        self.send_response(416); self.send_header("Content-Range", f"bytes */{size}"); self.send_header("Content-Length", "0"); self.end_headers(); return
+                    status = 206
+                self.send_response(status)
+                for key, value in headers: self.send_header(key, value)
+                self.send_header("Accept-Ranges", "bytes")
+                if status == 206: self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                self.send_header("Content-Length", str(end - start + 1)); self.end_headers()
+                if self.command == "HEAD": return
+                f.seek(start)
+                try: shutil.copyfileobj(_LimitedReader(f, end - start + 1), self.wfile, 1 << 20)
+                except (BrokenPipeError, ConnectionResetError): pass
+
+        do_GET = do_HEAD = do_POST = _proxy
+
+        def log_message(self, format, *args):
+            pass
+
+    return AccelProxyHandler
+
+class _LimitedReader:
+    def __init__(self, f, remaining: int):
+        self.f, self.remaining = f, remaining
+
+    def read(self, n: int = -1) -> bytes:
+        if self.remaining <= 0: return b""
+        data = self.f.read(self.remaining if n < 0 else min(n, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+def main():
+    parser = argparse.ArgumentParser(description="Minimal X-Accel-Redirect front proxy for local testing.")
+    parser.add_argument("--upstream", type=str, default="http://127.0.0.1:5000")
+    parser.add_argument("--root", type=str, default="..", help="Directory the internal location maps to (PROJECT_PARENT_DIR).")
+    parser.add_argument("--prefix", type=str, default="/_media/", help="Internal location prefix (MEDIA_OFFLOAD_PREFIX).")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), _make_handler(args.upstream, os.path.abspath(args.root), args.prefix))
+    print(f"Proxying http://{args.host}:{args.port} -> {args.upstream}, {args.prefix} -> {os.path.abspath(args.root)}")
+    try: server.serve_forever()
+    except KeyboardInterrupt: pass
+    finally: server.server_close()
+
+if __name__ == "__main__":
+    main()
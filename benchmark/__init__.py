@@ -0,0 +1,6 @@
+# benchmark (可复现的性能基准: 合成图库 + 替身打标模型 + 计时场景)
+# 在仓库根目录运行: python -m benchmark --images 20000 --output before.json
+#                   python -m benchmark --images 20000 --output after.json --compare before.json
+# synthetic.py  : 目录树 / 图片 / GIF, 以及 Zipf 分布标签的 image_tags 数据库和 embedding 存储
+# stub_model.py : 与 wd-eva02 输入输出形状一致的小 ONNX 模型 (需要 onnx 包), 通过 WD_MODEL_DIR 交给索引器
+# run.py        : scan_media_files / 所有 /api/* 接口 / handle_index 吞吐的计时, 结果写成 JSON
@@ -0,0 +1,206 @@
+# benchmark/run.py (基准测试入口, 用法见 python -m benchmark --help)
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import re
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT_NAME = "gallery"  # 合成图库中项目目录的名字, 与真实部署一样放在图库根目录下, 扫描时会被跳过
+COMPARE_KEYS = ("median_ms", "p95_ms", "cold_ms", "seconds", "images_per_second")
+SCAN_TIMEOUT = 600  # 导入 main 后最多等待首次媒体索引建立的秒数
+TAGGER_MODULES = ("huggingface_hub", "torch", "onnxruntime", "pandas", "tqdm")  # wd-eva-02-test.py 顶层导入的第三方包
+
+if REPO_DIR not in sys.path: sys.path.insert(0, REPO_DIR)
+from benchmark.synthetic import build_embed_store, build_library, build_tag_db
+from benchmark.stub_model import build_stub_model
+
+def summarize(samples_ms: list[float]) -> dict:
+    ordered = sorted(samples_ms)
+    return {"n": len(ordered), "min_ms": round(ordered[0], 3), "median_ms": round(statistics.median(ordered), 3),
+            "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+            "mean_ms": round(statistics.fmean(ordered), 3), "max_ms": round(ordered[-1], 3)}
+
+def timed(fn, repeat: int) -> list[float]:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter(); fn(); samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+def prepare_library(workdir: str, args) -> dict:
+    """生成图库 / 标签数据库 / embedding 存储, 布局与真实部署相同: <library>/<项目目录>/test.db"""
+    library, project = os.path.join(workdir, "library"), os.path.join(workdir, "library", PROJECT_NAME)
+    os.makedirs(project, exist_ok=True)
+    start = time.perf_counter()
+    images, gifs = build_library(library, args.folders, args.images, args.gifs, args.seed)
+    files_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    db_stats = build_tag_db(os.path.join(project, "test.db"), library, images, args.tags, args.characters, args.tags_per_image, args.seed)
+    build_embed_store(os.path.join(project, "image_embeds"), len(images), seed=args.seed)
+    return {"library": library, "project": project, "images": len(images), "gifs": len(gifs), "files_seconds": round(files_seconds, 3),
+            "db_seconds": round(time.perf_counter() - start, 3), **{f"db_{k}": v for k, v in db_stats.items()}}
+
+def import_app(project: str, timeout: float = SCAN_TIMEOUT):
+    """main.py 在导入时按当前目录确定图库位置并在后台建立媒体索引, 返回 (模块, 首次建立索引的秒数)
+    扫描失败 (锁已释放但仍没有索引) 或超过 timeout 秒时抛出异常"""
+    os.chdir(project)
+    start = time.perf_counter()
+    import main
+    main.TAGGER_URL = None  # 不向打标服务提交新图片
+    while True:
+        # 先看锁再看索引: 扫描线程先发布索引再删锁, 锁已不在而索引仍为空说明扫描失败
+        scanning = main.is_scanning()
+        if main.media_index.get() is not None and not scanning: break
+        if not scanning: raise RuntimeError(f"Initial media scan failed: {main.last_scan_error or 'no media index was published'}")
+        if time.perf_counter() - start > timeout: raise TimeoutError(f"Media index was not ready after {timeout:g} s.")
+        time.sleep(0.05)
+    return main, time.perf_counter() - start
+
+def bench_scan(main, repeat: int) -> dict:
+    previous = main.media_index.get().info_map()
+    return {"full_probe": summarize(timed(main.scan_media_files, repeat)),
+            "reuse_previous": summarize(timed(lambda: main.scan_media_files(previous), repeat))}
+
+def sample_requests(project: str) -> list[tuple[str, str]]:
+    """(路由规则, 请求 URL); 样本值取自合成数据库"""
+    with sqlite3.connect(os.path.join(project, "test.db")) as conn:
+        character = conn.execute("SELECT character_name FROM images WHERE character_name != 'others/oc' GROUP BY character_name ORDER BY COUNT(*) DESC LIMIT 1").fetchone()[0]
+        image_path = conn.execute("SELECT filepath FROM images ORDER BY id LIMIT 1").fetchone()[0]
+    folder = image_path.rpartition('/')[0]
+    return [
+        ("/api/images", "/api/images"),
+        ("/api/videos", "/api/videos"),
+        ("/api/random-image", "/api/random-image"),
+        ("/api/random-images", "/api/random-images?n=24&seed=1"),
+        ("/api/characters", "/api/characters?page=1"),
+        ("/api/characters", "/api/characters?page=1&search=series 01"),
+        ("/api/tag_suggest", "/api/tag_suggest?q=blu"),
+        ("/api/tag_suggest", "/api/tag_suggest?q=char:charactr"),
+        ("/api/character_images/<path:character_name>", f"/api/character_images/{quote(character)}?limit=60"),
+        ("/api/character_images/<path:character_name>", "/api/character_images/others/oc?limit=60"),
+        ("/api/search", "/api/search?q=1girl blue_eyes&limit=48"),
+        ("/api/search", "/api/search?q=solo,-red hat,rating:general|sensitive,orientation:portrait,minres:600&limit=48"),
+        ("/api/search", "/api/search?q=tag_04000|tag_04001&limit=48"),
+        ("/api/similar/<path:filepath>", f"/api/similar/{quote(image_path)}?limit=48"),
+        ("/api/folder_images", f"/api/folder_images?path={quote(folder)}&limit=48"),
+        ("/api/status", "/api/status"),
+        ("/api/export", "/api/export?q=solo,rating:general&format=ndjson"),
+        ("/api/export", "/api/export?q=orientation:landscape&format=csv&min_conf=0.5"),
+    ]
+
+def bench_endpoints(main, project: str, repeat: int) -> dict:
+    """每个请求先清空响应缓存测一次冷启动, 再连续重复测热路径"""
+    client, headers, results = main.app.test_client(), {"Accept-Encoding": "gzip, br"}, {}
+    requests = sample_requests(project)
+    for rule, url in requests:
+        main.response_cache.clear()
+        # 读完整个响应体, 流式接口 (/api/export) 的耗时才包含生成全部内容
+        start = time.perf_counter(); response = client.get(url, headers=headers); body = response.get_data(); cold_ms = (time.perf_counter() - start) * 1000
+        warm = timed(lambda: client.get(url, headers=headers).get_data(), repeat)
+        results[f"GET {url}"] = {"rule": rule, "status": response.status_code, "bytes": len(body), "cold_ms": round(cold_ms, 3), **summarize(warm)}
+        response.close()
+    covered = {rule for rule, _ in requests}
+    uncovered = sorted(r.rule for r in main.app.url_map.iter_rules() if r.rule.startswith("/api/") and r.rule not in covered)
+    if uncovered: results["uncovered"] = uncovered  # 新增接口后在 sample_requests 中补充样本
+    return results
+
+def bench_handle_index(workdir: str, args) -> dict:
+    """用替身模型在单独的小图库上跑 wd-eva-02-test.py index, 测整体吞吐 (含模型加载和元数据补全)"""
+    missing = [name for name in TAGGER_MODULES if importlib.util.find_spec(name) is None]
+    if missing: return {"skipped": f"Tagger dependencies not installed: {', '.join(missing)}"}
+    try: model_dir = build_stub_model(os.path.join(workdir, "stub_model"), image_size=args.model_size, seed=args.seed)
+    except ImportError as e: return {"skipped": str(e)}
+    library = os.path.join(workdir, "index_library"); project = os.path.join(library, PROJECT_NAME)
+    os.makedirs(project, exist_ok=True)
+    build_library(library, max(1, args.index_images // 50), args.index_images, 0, args.seed + 1)
+    command = [sys.executable, os.path.join(REPO_DIR, "wd-eva-02-test.py"), "index", "--batch-size", str(args.batch_size), "--num-workers", str(args.num_workers)]
+    start = time.perf_counter()
+    process = subprocess.run(command, cwd=project, env={**os.environ, "WD_MODEL_DIR": model_dir}, capture_output=True, text=True, encoding="utf-8", errors="replace")
+    seconds = time.perf_counter() - start
+    if process.returncode != 0: return {"error": (process.stderr or process.stdout)[-2000:]}
+    match = re.search(r"Indexing complete! (\d+)", process.stdout)
+    tagged = int(match.group(1)) if match else 0
+    return {"images": tagged, "seconds": round(seconds, 3), "images_per_second": round(tagged / seconds, 2) if seconds else None,
+            "batch_size": args.batch_size, "num_workers": args.num_workers, "model_size": args.model_size}
+
+def _git_commit():
+    try: return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError): return None
+
+def _flatten(node, prefix=""):
+    if isinstance(node, dict):
+        for key, value in node.items(): yield from _flatten(value, f"{prefix}.{key}" if prefix else key)
+    elif isinstance(node, (int, float)) and not isinstance(node, bool): yield prefix, node
+
+def compare(old: dict, new: dict):
+    """打印两次结果中耗时 / 吞吐类指标的变化; ratio < 1 表示耗时减少 (吞吐则相反)"""
+    old_values = dict(_flatten(old.get("results", {})))
+    for key, value in _flatten(new.get("results", {})):
+        if not key.endswith(COMPARE_KEYS) or key not in old_values or not old_values[key]: continue
+        print(f"{key:<110} {old_values[key]:>12.3f} -> {value:>12.3f}  x{value / old_values[key]:.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the gallery and tagger against a synthetic library.")
+    parser.add_argument("--workdir", type=str, default=None, help="Where to generate the synthetic library (default: a temporary directory).")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated files after the run.")
+    parser.add_argument("--output", type=str, default="benchmark_results.json", help="JSON file the results are written to.")
+    parser.add_argument("--compare", type=str, default=None, help="Previous results JSON to compare against.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--folders", type=int, default=200)
+    parser.add_argument("--images", type=int, default=20000)
+    parser.add_argument("--gifs", type=int, default=500)
+    parser.add_argument("--tags", type=int, default=5000)
+    parser.add_argument("--characters", type=int, default=300)
+    parser.add_argument("--tags-per-image", type=float, default=24.0)
+    parser.add_argument("--repeat", type=int, default=20, help="Warm repetitions per endpoint.")
+    parser.add_argument("--scan-repeat", type=int, default=3)
+    parser.add_argument("--skip-index", action="store_true", help="Skip the handle_index throughput scenario.")
+    parser.add_argument("--index-images", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--num-workers", type=int, default=8)
+    parser.add_argument("--model-size", type=int, default=448, help="Input size of the stub model (the real model uses 448).")
+    args = parser.parse_args()
+
+    output_path, compare_path = os.path.abspath(args.output), args.compare and os.path.abspath(args.compare)
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="gallery_bench_")
+    original_cwd = os.getcwd()
+    results = {}
+    try:
+        print(f"Generating synthetic library in '{workdir}'...")
+        setup = prepare_library(workdir, args)
+        results["generate"] = {k: v for k, v in setup.items() if k not in ("library", "project")}
+        print("Building the media index...")
+        app_module, startup_seconds = import_app(setup["project"])
+        results["startup_index"] = {"seconds": round(startup_seconds, 3)}
+        print("Timing scan_media_files...")
+        results["scan_media_files"] = bench_scan(app_module, args.scan_repeat)
+        print("Timing /api/* endpoints...")
+        results["endpoints"] = bench_endpoints(app_module, setup["project"], args.repeat)
+        if not args.skip_index:
+            print("Timing handle_index with the stub model...")
+            results["handle_index"] = bench_handle_index(workdir, args)
+    finally:
+        os.chdir(original_cwd)
+        if not args.keep and not args.workdir: shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"meta": {"timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"), "commit": _git_commit(),
+                       "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+              "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "workdir", "keep")},
+              "results": results}
+    with open(output_path, "w", encoding="utf-8") as f: json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Results written to '{output_path}'.")
+    if compare_path:
+        with open(compare_path, "r", encoding="utf-8") as f: compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
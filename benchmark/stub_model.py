@@ -0,0 +1,63 @@
+# benchmark/stub_model.py (与 wd-eva02 输入输出形状一致的小型替身 ONNX 模型, 无需下载真实模型)
+import csv
+import os
+import numpy as np
+from benchmark.synthetic import COMMON_TAGS, RATINGS, character_names, tag_names, zipf_weights
+
+# 输入: float32 [batch, size, size, 3] (BGR, 0-255, NHWC), 与 Predictor.prepare_image 的输出一致
+# 输出: float32 [batch, 标签数] 的 sigmoid 概率, 标签顺序与 selected_tags.csv 一致
+# 结构: 全局平均池化 -> MatMul -> Relu -> MatMul -> Add -> Sigmoid
+#   第二个 MatMul 就是 _find_embedding_tensor 要找的分类头, 因此 --store-embeddings 也能用 (hidden 维 embedding)
+# 偏置按 Zipf 频率设置, 常见标签更容易超过阈值, 写入数据库的标签分布与 synthetic.build_tag_db 相近
+
+def build_stub_model(out_dir: str, n_general: int = 2000, n_characters: int = 300, image_size: int = 448, hidden: int = 64, seed: int = 0) -> str:
+    """在 out_dir 写出 model.onnx 和 selected_tags.csv, 返回 out_dir; 需要 onnx 包"""
+    try:
+        import onnx
+        from onnx import TensorProto, helper, numpy_helper
+    except ImportError as e:
+        raise ImportError("Package 'onnx' is required to build the stub tagger model.") from e
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # category: 9 = rating, 0 = general, 4 = character (load_labels 按这个划分)
+    labels = [(name, 9) for name in RATINGS]
+    labels += [(name.replace(" ", "_"), 0) for name in tag_names(n_general)]
+    labels += [(name.replace(" ", "_"), 4) for name in character_names(n_characters)]
+    with open(os.path.join(out_dir, "selected_tags.csv"), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["tag_id", "name", "category", "count"])
+        for i, (name, category) in enumerate(labels): writer.writerow([i, name, category, 0])
+
+    n_labels = len(labels)
+    # 目标频率: rating 约 0.5, 常见标签接近 1, 其余按 Zipf 递减, 角色只有少数能超过 0.85
+    target = np.concatenate([np.full(len(RATINGS), 0.5),
+                             np.clip(zipf_weights(n_general, 0.9) * n_general * 0.02, 0.01, 0.97),
+                             np.clip(zipf_weights(n_characters) * 2.0, 0.001, 0.6)]).astype(np.float32)
+    target[len(RATINGS):len(RATINGS) + len(COMMON_TAGS)] = 0.9
+    bias = np.log(target / (1 - target)).astype(np.float32)
+    w1 = (rng.standard_normal((3, hidden)) / 128.0).astype(np.float32)  # 输入是 0-255 的像素均值
+    w2 = (rng.standard_normal((hidden, n_labels)) / np.sqrt(hidden)).astype(np.float32)
+
+    nodes = [
+        helper.make_node("ReduceMean", ["input"], ["pooled"], axes=[1, 2], keepdims=0),
+        helper.make_node("MatMul", ["pooled", "w1"], ["hidden_linear"]),
+        helper.make_node("Relu", ["hidden_linear"], ["features"]),
+        helper.make_node("MatMul", ["features", "w2"], ["logits_raw"]),
+        helper.make_node("Add", ["logits_raw", "bias"], ["logits"]),
+        helper.make_node("Sigmoid", ["logits"], ["output"]),
+    ]
+    graph = helper.make_graph(
+        nodes, "wd_stub_tagger",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, ["batch", image_size, image_size, 3])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, ["batch", n_labels])],
+        initializer=[numpy_helper.from_array(w1, "w1"), numpy_helper.from_array(w2, "w2"), numpy_helper.from_array(bias, "bias")],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8  # onnxruntime 1.20 可加载的版本
+    onnx.checker.check_model(model)
+    onnx.save(model, os.path.join(out_dir, "model.onnx"))
+    # 旧的 embedding 导出副本对应旧模型, 删除后由 _export_embedding_model 重新生成
+    try: os.remove(os.path.join(out_dir, "model_with_embedding.onnx"))
+    except OSError: pass
+    return out_dir
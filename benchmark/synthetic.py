@@ -0,0 +1,123 @@
+# benchmark/synthetic.py (合成图库和标签数据库: 目录树, 图片/GIF, Zipf 分布的标签)
+import io
+import os
+import sqlite3
+import numpy as np
+from PIL import Image
+from query import ensure_indexes
+from library_root import RAND_KEY_SQL, ensure_library_root, ensure_metadata_columns, ensure_rand_key
+from name_index import sync_name_index
+from vector_store import VectorStore
+
+RATINGS, RATING_WEIGHTS = ["general", "sensitive", "questionable", "explicit"], [0.55, 0.3, 0.1, 0.05]
+OC_SHARE = 0.35  # 没有识别出角色的图片比例 (others/oc), 真实图库里通常是最大的一组
+# 排在最前面的标签和真实 danbooru 分布一样是最常见的那些, main.py 的角色封面依赖 'looking at viewer'
+COMMON_TAGS = ["1girl", "solo", "looking at viewer", "smile", "long hair", "blush", "short hair", "open mouth", "simple background", "blue eyes"]
+_ADJECTIVES = ["red", "blue", "green", "black", "white", "long", "short", "open", "closed", "striped", "frilled", "holding", "hair", "animal", "bare", "floating", "torn", "wet", "star", "heart"]
+_NOUNS = ["eyes", "hair", "dress", "skirt", "ribbon", "hat", "gloves", "shirt", "ears", "tail", "sky", "flower", "sword", "book", "umbrella", "boots", "jacket", "scarf", "bow", "cup"]
+_SHAPES = [(600, 800), (800, 600), (512, 512), (720, 1280), (1920, 1080), (1080, 1350), (300, 300), (2048, 1536)]  # 竖图 / 横图 / 方图都有
+
+def zipf_weights(n: int, s: float = 1.1) -> np.ndarray:
+    weights = 1.0 / np.arange(1, n + 1) ** s
+    return weights / weights.sum()
+
+def tag_names(n: int) -> list[str]:
+    names = list(COMMON_TAGS)
+    names += [f"{a} {b}" for a in _ADJECTIVES for b in _NOUNS if f"{a} {b}" not in names]
+    names += [f"tag {i:05d}" for i in range(max(0, n - len(names)))]
+    return names[:n]
+
+def character_names(n: int) -> list[str]:
+    return [f"character {i:04d} (series {i % 40:02d})" for i in range(n)]
+
+def _encode(size, fmt: str, color) -> bytes:
+    # 只存一小块纯色图, 把尺寸写进文件头: 文件很小, 但读头得到的宽高是真实的
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format=fmt, **({"quality": 60} if fmt == "JPEG" else {}))
+    return buffer.getvalue()
+
+def _gif(frames: int) -> bytes:
+    buffer = io.BytesIO()
+    images = [Image.new("P", (240, 320), i * 40) for i in range(frames)]
+    images[0].save(buffer, format="GIF", save_all=True, append_images=images[1:], duration=100, loop=0)
+    return buffer.getvalue()
+
+def build_library(root: str, n_folders: int, n_images: int, n_gifs: int = 0, seed: int = 0) -> tuple[list[str], list[str]]:
+    """在 root 下生成 n_folders 个目录 (最多三层) 并把图片和 GIF 分配进去, 返回 (图片相对路径, GIF 相对路径)
+    目录大小也是长尾分布; 每个目录里大部分文件名带数字, 少数没有数字 (走 natural_sort_key 的 ctime 分支)"""
+    rng = np.random.default_rng(seed)
+    folders = []
+    for i in range(n_folders):
+        depth = rng.integers(1, 4)
+        parts = [f"set_{i:04d}"] + [f"part_{rng.integers(0, 5)}" for _ in range(depth - 1)]
+        folders.append("/".join(parts))
+    templates = [_encode(size, fmt, tuple(int(c) for c in rng.integers(0, 255, 3))) for size in _SHAPES for fmt in ("JPEG", "PNG", "WEBP")]
+    extensions = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+    template_exts = [extensions[fmt] for _ in _SHAPES for fmt in ("JPEG", "PNG", "WEBP")]
+    gif_templates = [_gif(frames) for frames in (2, 5, 12)]
+
+    folder_of = rng.choice(n_folders, size=n_images + n_gifs, p=zipf_weights(n_folders, 0.8))
+    counters, images, gifs = [0] * n_folders, [], []
+    for folder in dict.fromkeys(folders): os.makedirs(os.path.join(root, folder), exist_ok=True)
+    for i, folder_index in enumerate(folder_of):
+        counters[folder_index] += 1
+        number = counters[folder_index]
+        if i < n_images:
+            t = int(rng.integers(0, len(templates)))
+            stem = f"{number:04d}" if rng.random() > 0.05 else f"cover {chr(97 + int(rng.integers(0, 26)))}{chr(97 + int(rng.integers(0, 26)))}"
+            rel_path, data = f"{folders[folder_index]}/{stem}{template_exts[t]}", templates[t]
+            images.append(rel_path)
+        else:
+            rel_path, data = f"{folders[folder_index]}/anim_{number:04d}.gif", gif_templates[int(rng.integers(0, len(gif_templates)))]
+            gifs.append(rel_path)
+        with open(os.path.join(root, rel_path), "wb") as f: f.write(data)
+    images = list(dict.fromkeys(images))  # 同一目录的 "cover" 文件名可能重复
+    return images, gifs
+
+def build_tag_db(db_path: str, library_root: str, image_paths: list[str], n_tags: int = 5000, n_characters: int = 300,
+                 tags_per_image: float = 24.0, seed: int = 0) -> dict:
+    """按 wd-eva-02-test.py 的表结构生成标签数据库: 标签和角色的出现频率服从 Zipf 分布, 每张图的标签数服从泊松分布"""
+    rng = np.random.default_rng(seed)
+    tags, characters = tag_names(n_tags), character_names(n_characters)
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, filepath TEXT NOT NULL UNIQUE, rating TEXT, character_name TEXT, rand_key INTEGER)')
+        conn.execute('CREATE TABLE IF NOT EXISTS tags (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+        conn.execute('CREATE TABLE IF NOT EXISTS image_tags (image_id INTEGER, tag_id INTEGER, confidence REAL, FOREIGN KEY (image_id) REFERENCES images (id) ON DELETE CASCADE, FOREIGN KEY (tag_id) REFERENCES tags (id), PRIMARY KEY (image_id, tag_id))')
+        conn.executemany("INSERT INTO tags (id, name) VALUES (?, ?)", enumerate(tags, start=1))
+
+        n = len(image_paths)
+        ratings = rng.choice(len(RATINGS), size=n, p=RATING_WEIGHTS)
+        chars = rng.choice(n_characters, size=n, p=zipf_weights(n_characters))
+        is_oc = rng.random(n) < OC_SHARE
+        conn.executemany(f"INSERT INTO images (id, filepath, rating, character_name, rand_key) VALUES (?, ?, ?, ?, {RAND_KEY_SQL})",
+                         ((i + 1, path, RATINGS[ratings[i]], "others/oc" if is_oc[i] else characters[chars[i]]) for i, path in enumerate(image_paths)))
+
+        # 有放回地按 Zipf 权重抽样, 同一张图抽到的重复标签由主键去重
+        max_tags = int(tags_per_image * 3)
+        counts = np.clip(rng.poisson(tags_per_image, size=n), 1, max_tags)
+        weights = zipf_weights(n_tags)
+        for start in range(0, n, 10000):
+            stop = min(n, start + 10000)
+            picks = rng.choice(n_tags, size=(stop - start, max_tags), p=weights) + 1
+            confidences = 0.35 + 0.65 * rng.beta(1.0, 2.5, size=picks.shape)
+            rows = ((start + r + 1, int(picks[r, c]), float(confidences[r, c])) for r in range(stop - start) for c in range(counts[start + r]))
+            conn.executemany("INSERT OR IGNORE INTO image_tags (image_id, tag_id, confidence) VALUES (?, ?, ?)", rows)
+        conn.commit()
+        ensure_indexes(conn)
+        ensure_library_root(conn, library_root)
+        ensure_rand_key(conn)
+        ensure_metadata_columns(conn)
+        sync_name_index(conn)
+        stats = {"images": n, "tags": n_tags, "characters": n_characters,
+                 "image_tags": conn.execute("SELECT COUNT(*) FROM image_tags").fetchone()[0]}
+    return stats
+
+def build_embed_store(base_path: str, n_images: int, dim: int = 64, seed: int = 0):
+    """随机的归一化 embedding, 行号与 build_tag_db 的图片 id 对应, 供 /api/similar 使用"""
+    rng = np.random.default_rng(seed)
+    store = VectorStore(base_path, dim)
+    for start in range(0, n_images, 65536):
+        vectors = rng.standard_normal((min(n_images, start + 65536) - start, dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        store.append(np.arange(start + 1, start + 1 + len(vectors), dtype=np.int64), vectors)
+    return store
@@ -0,0 +1,49 @@
+# export.py (按查询流式导出图片及其标签: NDJSON / CSV, 内存占用与结果规模无关)
+import csv
+import io
+import json
+from query import compile_query
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_CHUNK = 500  # 每次从游标取回的图片数; 同时是取标签的 IN 列表长度, 需低于旧版 SQLite 999 个参数的上限
+CSV_COLUMNS = ["path", "rating", "character", "tags"]
+
+def export_chunks(conn, query_string: str, min_confidence: float | None = None, chunk_size: int = EXPORT_CHUNK):
+    """按 id 顺序逐块产出 [{"path", "rating", "character", "tags": {标签: 置信度}}, ...]; 查询为空时导出全部图片
+    非空但没有可用过滤条件的查询 (例如拼错的 orientation:, 单独的 conf>0.5) 与 /api/search 一致, 不产出任何结果
+    主查询只开一个游标, 每块 fetchmany 后再用一次 IN 查询取这些图片的标签 (按置信度降序)
+    导出期间游标持有读事务, 整个导出看到的是同一份快照; 数据库为 WAL 模式, 索引器的提交不会被它阻塞"""
+    select = "T0.id, T0.filepath, T0.rating, T0.character_name"
+    if query_string.strip():
+        compiled = compile_query(query_string, select=select, order_by="T0.id")
+        if compiled is None: return
+        sql, params = compiled
+    else: sql, params = f"SELECT {select} FROM images AS T0 ORDER BY T0.id", ()
+    confidence_clause, confidence_params = ("AND it.confidence >= ?", (min_confidence,)) if min_confidence is not None else ("", ())
+    cursor = conn.execute(sql, params)
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows: return
+            tags = {row[0]: {} for row in rows}
+            tag_sql = (f"SELECT it.image_id, t.name, it.confidence FROM image_tags it JOIN tags t ON it.tag_id = t.id "
+                       f"WHERE it.image_id IN ({','.join(['?'] * len(tags))}) {confidence_clause} ORDER BY it.image_id, it.confidence DESC")
+            for image_id, name, confidence in conn.execute(tag_sql, (*tags, *confidence_params)): tags[image_id][name] = round(confidence, 4)
+            yield [{"path": row[1], "rating": row[2], "character": row[3], "tags": tags[row[0]]} for row in rows]
+    finally:
+        cursor.close()
+
+def encode_export(chunks, fmt: str):
+    """把 export_chunks 的输出编码成文本, 每块一段 (CSV 先输出表头)
+    CSV 的 tags 列是 {标签: 置信度} 的 JSON 对象, 标签名含逗号或引号时也能无歧义地还原"""
+    if fmt == "ndjson":
+        for chunk in chunks: yield "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in chunk)
+        return
+    if fmt != "csv": raise ValueError(f"Unknown export format '{fmt}', expected one of: {', '.join(EXPORT_FORMATS)}")
+    buffer = io.StringIO(); writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for chunk in chunks:
+        for record in chunk:
+            writer.writerow([record["path"], record["rating"], record["character"], json.dumps(record["tags"], ensure_ascii=False)])
+        yield buffer.getvalue(); buffer.seek(0); buffer.truncate()
+    if buffer.tell(): yield buffer.getvalue()  # 结果为空时只有表头
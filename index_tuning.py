@@ -0,0 +1,146 @@
+# index_tuning.py (打标流水线的分阶段计时 / 内存采样, 以及批大小和预处理线程数的自动调参)
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import psutil  # 可选: 跨平台读取常驻内存和可用内存
+except ImportError:
+    psutil = None
+
+STAGES = ("decode", "preprocess", "queue_wait", "inference", "db_write")
+SAMPLE_INTERVAL = 0.25  # 内存采样间隔 (秒), 峰值用于判断调参候选是否超出内存预算
+MIN_GAIN = 0.03  # 调参时吞吐提升不到 3% 就不再继续增大
+
+def rss_bytes() -> int | None:
+    if psutil is not None: return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm', 'r') as f: return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError): return None
+
+def default_memory_budget() -> int | None:
+    """当前占用加上 80% 的可用内存; 没有 psutil 时不限制"""
+    if psutil is None: return None
+    return (rss_bytes() or 0) + int(psutil.virtual_memory().available * 0.8)
+
+class StageTelemetry:
+    """线程安全的分阶段计时; 后台线程每 interval 秒向 stream 写一行本区间的 JSON 统计, 并持续采样内存峰值
+    decode / preprocess 在预处理线程里累计 (总和可以超过墙钟时间), queue_wait 是推理线程等待预处理结果的时间"""
+
+    def __init__(self, stream=None, interval: float = 10.0, **context):
+        self.stream, self.interval, self.context = stream, interval, context
+        self._lock, self._stop = threading.Lock(), threading.Event()
+        self._write_lock = threading.Lock()  # 采样线程的定时输出和主线程的 set_context / close 可能同时写 stream
+        self._window, self._totals = {}, {}
+        self._window_images = self._total_images = 0
+        self._start = self._window_start = time.perf_counter()
+        self.peak_rss = rss_bytes()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, stage: str, seconds: float, count: int = 1):
+        with self._lock:
+            for stats in (self._window, self._totals):
+                entry = stats.setdefault(stage, [0.0, 0]); entry[0] += seconds; entry[1] += count
+
+    @contextmanager
+    def stage(self, name: str, count: int = 1):
+        start = time.perf_counter()
+        try: yield
+        finally: self.add(name, time.perf_counter() - start, count)
+
+    def images_done(self, n: int):
+        with self._lock: self._window_images += n; self._total_images += n
+
+    def set_context(self, **context):
+        """切换阶段 (例如调参试验 -> 正式索引) 时先输出上一段的统计"""
+        self.emit()
+        with self._lock: self.context.update(context)
+
+    def reset_peak(self):
+        self.peak_rss = rss_bytes()
+
+    def _sample(self):
+        rss = rss_bytes()
+        if rss is not None and (self.peak_rss is None or rss > self.peak_rss): self.peak_rss = rss
+
+    def _run(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            self._sample()
+            if time.perf_counter() - self._window_start >= self.interval: self.emit()
+
+    def emit(self, final: bool = False):
+        now = time.perf_counter()
+        with self._lock:
+            stats, images = (self._totals, self._total_images) if final else (self._window, self._window_images)
+            seconds = now - (self._start if final else self._window_start)
+            self._window, self._window_images, self._window_start = {}, 0, now
+            context = dict(self.context)
+        if self.stream is None or (not final and not stats and not images): return
+        rss = rss_bytes()
+        record = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "elapsed_s": round(now - self._start, 3), **context,
+                  "final": final, "window_s": round(seconds, 3), "images": images,
+                  "images_per_second": round(images / seconds, 2) if seconds > 0 else None,
+                  "stages": {name: {"seconds": round(stats[name][0], 4), "count": stats[name][1], "mean_ms": round(stats[name][0] * 1000 / stats[name][1], 3)}
+                             for name in STAGES + tuple(sorted(set(stats) - set(STAGES))) if name in stats and stats[name][1]},
+                  "rss_mb": round(rss / 2**20, 1) if rss else None, "peak_rss_mb": round(self.peak_rss / 2**20, 1) if self.peak_rss else None}
+        with self._write_lock: self.stream.write(json.dumps(record, ensure_ascii=False) + "\n"); self.stream.flush()
+
+    def close(self):
+        self._stop.set(); self._thread.join()
+        self.emit(final=True)
+
+def autotune(run_trial, batch_sizes, worker_counts, start_workers: int, memory_budget: int | None = None, log=print):
+    """坐标爬山: 先固定线程数从小到大试批大小, 再固定最佳批大小往上试线程数; 提升不足 MIN_GAIN、出错或超出内存预算即停止该方向
+    run_trial(batch_size, num_workers) 返回 {"images_per_second", "peak_rss"}, 文件不够再做一次试验时返回 None
+    返回 (最佳配置或 None, 全部试验记录)"""
+    trials, best = [], None
+
+    def attempt(batch_size, num_workers):
+        """返回 True 表示明显优于之前的最佳配置, 应继续沿这个方向尝试; None 表示文件已用完"""
+        nonlocal best
+        try: result = run_trial(batch_size, num_workers)
+        except Exception as e:
+            trials.append({"batch_size": batch_size, "num_workers": num_workers, "error": str(e)})
+            log(f"Autotune: batch_size={batch_size} num_workers={num_workers} failed: {e}")
+            return False
+        if result is None: return None
+        fits = memory_budget is None or result.get("peak_rss") is None or result["peak_rss"] <= memory_budget
+        trials.append({"batch_size": batch_size, "num_workers": num_workers, **result, "within_budget": fits})
+        peak = f"{result['peak_rss'] / 2**20:.0f} MB" if result.get("peak_rss") else "unknown"
+        log(f"Autotune: batch_size={batch_size} num_workers={num_workers} -> {result['images_per_second']:.1f} images/s, peak RSS {peak}{'' if fits else ' (over budget)'}")
+        if not fits: return False
+        improved = best is None or result["images_per_second"] > best["images_per_second"] * (1 + MIN_GAIN)
+        if best is None or result["images_per_second"] > best["images_per_second"]: best = trials[-1]
+        return improved
+
+    for batch_size in sorted(batch_sizes):
+        outcome = attempt(batch_size, start_workers)
+        if outcome is None: return best, trials
+        if not outcome: break
+    if best is None:
+        # 最小批次也超出预算: 减少预处理线程 (每个线程持有解码中的整张原图)
+        for num_workers in sorted((w for w in worker_counts if w < start_workers), reverse=True):
+            outcome = attempt(min(batch_sizes), num_workers)
+            if outcome is None or best is not None: return best, trials
+        return best, trials
+    for num_workers in sorted(w for w in worker_counts if w > start_workers):
+        outcome = attempt(best["batch_size"], num_workers)
+        if not outcome: break
+    return best, trials
+
+def load_tuning(path: str, key: str) -> dict | None:
+    try:
+        with open(path, 'r', encoding='utf-8') as f: return json.load(f).get(key)
+    except (OSError, ValueError): return None
+
+def save_tuning(path: str, key: str, result: dict):
+    """按 key (模型 + 推理后端) 分别保存, 换模型或换设备后不会误用"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f: data = json.load(f)
+    except (OSError, ValueError): data = {}
+    data[key] = result
+    with open(path + '.tmp', 'w', encoding='utf-8') as f: json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
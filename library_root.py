@@ -0,0 +1,67 @@
+# library_root.py (标签数据库的结构迁移: 图片路径统一存为相对图库根目录的 '/' 分隔路径, 以及随机顺序键 rand_key)
+import os
+
+# library_root 表只有一行, 记录上次迁移时的图库根目录; 图库整体移动后只需更新这一行
+# 旧数据库 (索引器写入绝对路径) 在第一次打开时自动迁移
+
+# 角色图集的随机顺序键: 53 位以内, 前端 JSON 解析成 double 也不丢精度
+RAND_KEY_MAX = 2**53
+RAND_KEY_SQL = "(random() & 9007199254740991)"
+
+def to_relative(path: str, root: str) -> str:
+    """绝对路径转为相对 root 的路径; 不在 root 之下 (或在另一个盘符) 时原样返回"""
+    if not os.path.isabs(path): return path.replace('\\', '/')
+    try: relative = os.path.relpath(path, root)
+    except ValueError: return path
+    if relative == '..' or relative.startswith('..' + os.sep): return path
+    return relative.replace('\\', '/')
+
+def migrate_to_relative(conn, root: str) -> int:
+    """把 images.filepath 中 root 之下的绝对路径改成相对路径, 返回修改的行数
+    同一张图片的绝对/相对两条记录同时存在时保留相对路径那条"""
+    existing, updates, duplicates = set(), [], []
+    rows = conn.execute("SELECT id, filepath FROM images").fetchall()
+    existing.update(path for _, path in rows)
+    for image_id, path in rows:
+        relative = to_relative(path, root)
+        if relative == path: continue
+        if relative in existing: duplicates.append((image_id,))
+        else: updates.append((relative, image_id)); existing.add(relative)
+    conn.executemany("UPDATE images SET filepath = ? WHERE id = ?", updates)
+    if duplicates:
+        conn.executemany("DELETE FROM image_tags WHERE image_id = ?", duplicates)
+        conn.executemany("DELETE FROM images WHERE id = ?", duplicates)
+    return len(updates) + len(duplicates)
+
+def ensure_library_root(conn, root: str):
+    """建表并在根目录首次登记 (或变化) 时迁移, 之后的打开只多一次单行查询"""
+    conn.execute("CREATE TABLE IF NOT EXISTS library_root (id INTEGER PRIMARY KEY CHECK (id = 1), path TEXT NOT NULL)")
+    row = conn.execute("SELECT path FROM library_root WHERE id = 1").fetchone()
+    if row is not None and row[0] == root: return
+    migrated = migrate_to_relative(conn, root)
+    if migrated: print(f"Migrated {migrated} image paths to be relative to '{root}'.")
+    conn.execute("INSERT INTO library_root (id, path) VALUES (1, ?) ON CONFLICT(id) DO UPDATE SET path = excluded.path", (root,))
+    conn.commit()
+
+def ensure_rand_key(conn):
+    """images.rand_key: 入库时随机生成并持久化; (character_name, rand_key) 索引支持按随机顺序分页
+    只在补列时回填一次 (全表 UPDATE), 补列和回填在同一个事务里, 中途中断不会留下永远为空的键"""
+    if "rand_key" not in {row[1] for row in conn.execute("PRAGMA table_info(images)")}:
+        if not conn.in_transaction: conn.execute("BEGIN")
+        conn.execute("ALTER TABLE images ADD COLUMN rand_key INTEGER")
+        conn.execute(f"UPDATE images SET rand_key = {RAND_KEY_SQL}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_character_rand ON images (character_name, rand_key)")
+    conn.commit()
+
+METADATA_COLUMNS = ("width", "height", "file_size", "mtime")  # media_metadata 写入, orientation: / minres: 过滤依赖它们
+
+def ensure_metadata_columns(conn):
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(images)")}
+    for column in METADATA_COLUMNS:
+        if column not in existing: conn.execute(f"ALTER TABLE images ADD COLUMN {column} INTEGER")
+    conn.commit()
+
+def missing_columns(conn) -> list[str]:
+    """只读检查: 迁移补上的列中还缺哪些; search / export 据此提示先运行 index, 而不是自己去改库"""
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(images)")}
+    return [column for column in ("rand_key",) + METADATA_COLUMNS if column not in existing]
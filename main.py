@@ -1,71 +1,356 @@
 import os
+import mimetypes
 import random
 import json
 import sqlite3
 import re
-from urllib.parse import unquote, urlencode
-from flask import Flask, send_from_directory, redirect, url_for, jsonify, render_template_string, request, send_file
+import argparse
+import threading
+import time
+import urllib.request
+from urllib.parse import quote, unquote, urlencode
+from flask import Flask, send_from_directory, redirect, url_for, jsonify, render_template_string, request, send_file, Response, g
+from PIL import Image
+from vector_store import VectorStore
+from similarity import IVFIndex, find_similar
+from query import compile_query, ensure_indexes
+from name_index import has_name_index, search_names, sync_name_index
+from library_root import RAND_KEY_MAX, ensure_library_root, ensure_metadata_columns, ensure_rand_key
+from media_index import SharedMediaIndex, publish_media_index, read_generation
+from media_scanner import IMAGE_EXTS, VIDEO_EXTS, scan_tree
+from media_metadata import cached_prober, probe_files, store_db_metadata
+from response_cache import ResponseCache, json_response
+from export import EXPORT_FORMATS, encode_export, export_chunks
+import metrics as metrics_export
 
 # --- 配置 ---
-CACHE_FILE = 'media_cache.json'
+LEGACY_CACHE_FILE = 'media_cache.json'  # 旧版 JSON 扫描缓存, 仅在从未发布过二进制索引时导入一次, 之后改名为 .imported
+MEDIA_INDEX_BASE = 'media_index'  # 多进程共享的媒体索引 (media_index.current + media_index.<代数>.bin)
+SCAN_LOCK_HEARTBEAT = 15  # 扫描期间每隔这么多秒刷新一次锁文件的修改时间
+SCAN_LOCK_TIMEOUT = 120  # 锁文件超过这个秒数没有刷新, 视为持有它的进程已经崩溃或被杀
 DB_PATH = "test.db"
+EMBED_STORE_PATH = "image_embeds"
+TAGGER_URL = "http://127.0.0.1:5001"  # wd-eva-02-test.py serve 的地址, 设为 None 则不自动提交新图片
 PAGE_SIZE = 24
+RANDOM_BATCH_MAX = 100  # /api/random-images 单次最多返回的数量
+CHARACTER_PAGE_MAX = 200  # /api/character_images 单页最多返回的数量
+# 媒体文件交给前置代理发送: None 由 Flask 自己发送, 'x-accel' 对应 nginx, 'x-sendfile' 对应 Apache/lighttpd
+# nginx 配置示例 (alias 指向 PROJECT_PARENT_DIR):
+#   location /_media/ { internal; alias /path/to/library/; }
+#   location / { proxy_pass http://127.0.0.1:5000; }
+MEDIA_OFFLOAD = None
+MEDIA_OFFLOAD_PREFIX = '/_media/'  # nginx 中 internal location 的前缀
+MEDIA_MAX_AGE = 3600  # 不带版本号的 /media/ 链接的缓存时间
+MEDIA_IMMUTABLE_MAX_AGE = 31536000  # 带 ?v=<mtime> 的链接内容不会变, 缓存一年
+METRICS_DIR = 'metrics'  # 多进程部署时各 worker 的指标快照目录, /metrics 合并输出; None 则只输出本进程的数据
+METRICS_FLUSH_INTERVAL = 5  # 每个进程最多每隔这么多秒写一次快照
+SLOW_QUERY_MS = None  # 设为毫秒数后, 超过它的 SQL 连同 EXPLAIN QUERY PLAN 追加到 SLOW_QUERY_LOG
+SLOW_QUERY_LOG = 'slow_queries.log'
 PROJECT_PARENT_DIR = os.path.abspath('..')
 PROJECT_DIR_NAME = os.path.basename(os.getcwd())
 
 app = Flask(__name__)
 
+# --- 指标 ---
+metrics = metrics_export.MetricsRegistry()
+REQUEST_SECONDS = metrics.histogram("gallery_request_duration_seconds", "Time spent in the request handler (file bodies are streamed afterwards).", ("route", "method", "status"))
+SQL_SECONDS = metrics.histogram("gallery_sql_duration_seconds", "SQL statement time including fetching all rows.", ("statement",))
+CACHE_REQUESTS = metrics.counter("gallery_response_cache_requests_total", "Response cache lookups.", ("kind", "result"))
+CACHE_BUILD_SECONDS = metrics.histogram("gallery_response_build_seconds", "Time to build a cached response payload on a cache miss.", ("kind",))
+CACHE_ENCODE_SECONDS = metrics.histogram("gallery_response_encode_seconds", "Time to JSON-encode and compress a cached response on a cache miss.", ("kind",))
+MEDIA_BYTES = metrics.counter("gallery_media_bytes_served_total", "Media body bytes sent by serve_media (offloaded responses are sent by the proxy and not counted).", ("kind",))
+SCAN_SECONDS = metrics.histogram("gallery_media_scan_duration_seconds", "Duration of a full media scan and index publish.", ("result",), buckets=metrics_export.SCAN_BUCKETS)
+
+def observe_response_cache(key, hit, build_seconds, encode_seconds):
+    CACHE_REQUESTS.inc(kind=key[0], result="hit" if hit else "miss")
+    if not hit: CACHE_BUILD_SECONDS.observe(build_seconds, kind=key[0]); CACHE_ENCODE_SECONDS.observe(encode_seconds, kind=key[0])
+
+response_cache = ResponseCache(observe=observe_response_cache)  # 大列表接口的预序列化响应, key 中带媒体索引代数或数据库版本
+
+@app.before_request
+def start_request_timer(): g.request_start = time.perf_counter()
+
+@app.after_request
+def remember_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def record_request(exc):
+    """teardown 总会执行; 处理函数抛出异常 (调试模式下异常直接上抛, 不经过 after_request) 时按 500 记录"""
+    start = g.pop('request_start', None)
+    if start is not None:
+        # 路由规则而不是实际路径作标签, 序列数量有上限
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        REQUEST_SECONDS.observe(time.perf_counter() - start, route=route, method=request.method, status=g.get('response_status', 500))
+    metrics.flush(METRICS_DIR, METRICS_FLUSH_INTERVAL)
+
 # --- 数据库与后端逻辑 ---
+def db_version():
+    """数据库文件 (以及 WAL 文件) 的 (修改时间, 大小), 用作响应缓存的版本号; 数据库不存在时返回 None
+    WAL 模式下提交只写 -wal 文件, 主文件要等到检查点才变化, 因此两者都要算进去"""
+    try: st = os.stat(DB_PATH)
+    except OSError: return None
+    try: wal = os.stat(DB_PATH + '-wal'); return st.st_mtime_ns, st.st_size, wal.st_mtime_ns, wal.st_size
+    except OSError: return st.st_mtime_ns, st.st_size
+
+_indexes_checked = False
 def get_db_connection():
+    global _indexes_checked
     if not os.path.exists(DB_PATH): return None
     conn = sqlite3.connect(DB_PATH); conn.row_factory = sqlite3.Row
+    if not _indexes_checked:
+        # WAL: /api/export 的长读事务期间索引器仍能提交; 模式记录在数据库文件里, 设置一次即可
+        try: conn.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.OperationalError as e: print(f"Could not enable WAL for '{DB_PATH}': {e}")
+        ensure_indexes(conn)
+        # 旧数据库里的绝对路径迁移为相对 PROJECT_PARENT_DIR 的路径, 之后各接口直接返回 filepath
+        ensure_library_root(conn, PROJECT_PARENT_DIR)
+        ensure_rand_key(conn)
+        ensure_metadata_columns(conn)
+        # 旧数据库还没有名字索引时补建一次, 之后由索引器保持同步
+        if not has_name_index(conn): sync_name_index(conn)
+        _indexes_checked = True
     return conn
 
-def scan_media_files(force_rescan=False):
-    if not force_rescan and os.path.exists(CACHE_FILE):
-        try:
-            with open(CACHE_FILE, 'r', encoding='utf-8') as f: data = json.load(f); return data.get("images", []), data.get("videos_and_gifs", [])
-        except Exception: pass
-    image_list, video_and_gif_list = [], []
-    image_formats = ('.png', '.jpg', '.jpeg', '.bmp', '.webp'); video_formats = ('.mp4', '.webm', '.mov', '.mkv', '.avi', '.gif')
-    for root, dirs, files in os.walk(PROJECT_PARENT_DIR, topdown=True):
-        if PROJECT_DIR_NAME in dirs: dirs.remove(PROJECT_DIR_NAME)
-        for file in files:
-            file_lower, relative_path = file.lower(), os.path.relpath(os.path.join(root, file), PROJECT_PARENT_DIR).replace('\\', '/')
-            if file_lower.endswith(image_formats): image_list.append(relative_path)
-            elif file_lower.endswith(video_formats): video_and_gif_list.append(relative_path)
-    try:
-        with open(CACHE_FILE, 'w', encoding='utf-8') as f: json.dump({"images": image_list, "videos_and_gifs": video_and_gif_list}, f)
-    except IOError: pass
-    return image_list, video_and_gif_list
-
-image_files, video_and_gif_files = scan_media_files()
-
-def natural_sort_key(filepath):
+def run_query(conn, name, sql, params=()):
+    """执行并取回全部行, 按语句名记录耗时; 超过 SLOW_QUERY_MS 时连同查询计划写入慢查询日志"""
+    start = time.perf_counter()
+    rows = conn.execute(sql, params).fetchall()
+    elapsed = time.perf_counter() - start
+    SQL_SECONDS.observe(elapsed, statement=name)
+    if SLOW_QUERY_MS is not None and elapsed * 1000 >= SLOW_QUERY_MS: metrics_export.log_slow_query(SLOW_QUERY_LOG, conn, name, sql, params, elapsed)
+    return rows
+
+def scan_media_files(previous_infos=None):
+    """返回 (图片, 视频和 GIF, ctimes, infos)
+    ctimes 为文件名不含数字的文件的创建时间, 供 natural_sort_key 排序; infos 为 路径 -> MediaInfo, 在扫描线程里顺带读取文件头
+    previous_infos 中大小和修改时间没变的文件不再重新读取"""
+    image_list, video_and_gif_list, ctimes, infos = [], [], {}, {}
+    for entry in scan_tree(PROJECT_PARENT_DIR, IMAGE_EXTS + VIDEO_EXTS, exclude_dirs={PROJECT_DIR_NAME}, probe=cached_prober(previous_infos)):
+        (image_list if entry.path.lower().endswith(IMAGE_EXTS) else video_and_gif_list).append(entry.path)
+        if not re.search(r'\d', entry.path.rpartition('/')[2]): ctimes[entry.path] = entry.stat.st_ctime
+        infos[entry.path] = entry.info
+    return image_list, video_and_gif_list, ctimes, infos
+
+def submit_for_tagging(paths):
+    """在后台线程把新图片 (相对路径) 提交给常驻打标服务, 服务未启动时静默忽略"""
+    if not TAGGER_URL or not paths: return
+    def post():
+        body = json.dumps({"paths": list(paths), "wait": False}).encode('utf-8')
+        req = urllib.request.Request(f"{TAGGER_URL}/tag", data=body, headers={"Content-Type": "application/json"}, method="POST")
+        try: urllib.request.urlopen(req, timeout=5).close()
+        except OSError as e: print(f"Tagging service unavailable, {len(paths)} new images not submitted: {e}")
+    threading.Thread(target=post, daemon=True).start()
+
+def natural_sort_key(filepath, ctimes=None):
     filename = os.path.basename(filepath)
     numbers = [int(s) for s in re.findall(r'\d+', filename)]
     if numbers: return (0, numbers, filename)
+    elif ctimes is not None and filepath in ctimes: return (1, ctimes[filepath], filename)
     else:
         full_path = os.path.join(PROJECT_PARENT_DIR, filepath)
         try: return (1, os.path.getctime(full_path), filename)
         except: return (2, filename)
 
+# --- 媒体索引 ---
+# 启动时不扫描也不解析任何缓存: 索引存在就直接映射, 不存在则在后台线程建立, 期间接口返回加载中状态
+# 所有进程映射同一份只读索引; /rescan 在后台发布新一代, 各进程下次访问时切换
+# 切换到新一代时清掉按旧代数缓存的响应: 不等 LRU 淘汰, 否则每次重扫都在每个 worker 里多留一份完整的 /api/images 三种编码
+MEDIA_CACHE_KINDS = ('images', 'videos', 'folder')  # key[1] 为媒体索引代数的缓存条目
+def drop_stale_media_responses(generation):
+    response_cache.drop(lambda key: key[0] in MEDIA_CACHE_KINDS and key[1] != generation)
+
+media_index = SharedMediaIndex(MEDIA_INDEX_BASE, on_switch=drop_stale_media_responses)
+
+def _load_legacy_cache():
+    try:
+        with open(LEGACY_CACHE_FILE, 'r', encoding='utf-8') as f: data = json.load(f)
+        return data.get("images", []), data.get("videos_and_gifs", [])
+    except (OSError, ValueError): return None
+
+last_scan_error = None  # 本进程最近一次扫描失败的原因, 成功后清空
+def _build_media_index(force_rescan, lock_path):
+    global last_scan_error
+    start, result, done = time.perf_counter(), "error", threading.Event()
+    threading.Thread(target=_lock_heartbeat, args=(lock_path, done), daemon=True).start()
+    try:
+        previous = media_index.get()
+        known_images = set(previous.images) if previous else None
+        # 只在从未发布过索引时导入: 格式升级或索引损坏后的重建若导入这份旧快照, 之后新增的文件会消失
+        legacy_lists = None if force_rescan or read_generation(MEDIA_INDEX_BASE) else _load_legacy_cache()
+        if legacy_lists:
+            image_files, video_and_gif_files = legacy_lists
+            ctimes, infos = None, probe_files(PROJECT_PARENT_DIR, ((p, None) for p in image_files + video_and_gif_files))
+        else: image_files, video_and_gif_files, ctimes, infos = scan_media_files(previous.info_map() if previous else None)
+        publish_media_index(MEDIA_INDEX_BASE, image_files, video_and_gif_files, sort_key=lambda p: natural_sort_key(p, ctimes), infos=infos)
+        if legacy_lists:
+            try: os.replace(LEGACY_CACHE_FILE, LEGACY_CACHE_FILE + '.imported')
+            except OSError: pass
+        # 同步写进标签数据库, 供 orientation: / minres: 搜索过滤
+        conn = get_db_connection()
+        if conn is not None:
+            try: store_db_metadata(conn, infos)
+            finally: conn.close()
+        if known_images is not None: submit_for_tagging([p for p in image_files if p not in known_images])
+        result, last_scan_error = "ok", None
+    except Exception as e:
+        print(f"Media scan failed: {e}"); last_scan_error = e
+    finally:
+        # 扫描线程可能在不处理请求的进程里 (gunicorn 主进程), 立即写快照
+        SCAN_SECONDS.observe(time.perf_counter() - start, result=result); metrics.flush(METRICS_DIR)
+        done.set()
+        # 只删除自己的锁: 本进程若长时间停顿, 锁可能已被其他 worker 当作过期锁接管
+        if _lock_owner(lock_path) == str(os.getpid()):
+            try: os.remove(lock_path)
+            except OSError: pass
+
+# --- 扫描锁 ---
+# 锁文件内容是持有者的 pid, 扫描线程定期刷新修改时间; 超过 SCAN_LOCK_TIMEOUT 没有刷新即为过期锁
+def _lock_heartbeat(lock_path, done):
+    while not done.wait(SCAN_LOCK_HEARTBEAT):
+        try: os.utime(lock_path)
+        except OSError: return
+
+def _lock_owner(lock_path):
+    try:
+        with open(lock_path, 'r', encoding='utf-8') as f: return f.read().strip()
+    except OSError: return None
+
+def _lock_is_stale(path) -> bool:
+    try: return time.time() - os.path.getmtime(path) > SCAN_LOCK_TIMEOUT
+    except OSError: return False
+
+def _remove_stale_lock(lock_path) -> bool:
+    """多个 worker 同时发现过期锁时, 只有先建立接管锁的一个在其中重新确认并删除, 其余直接放弃"""
+    guard = lock_path + '.takeover'
+    try: os.close(os.open(guard, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        if _lock_is_stale(guard):  # 接管过程中崩溃留下的
+            try: os.remove(guard)
+            except OSError: pass
+        return False
+    try:
+        if not _lock_is_stale(lock_path): return False
+        os.remove(lock_path); return True
+    except OSError: return False
+    finally:
+        try: os.remove(guard)
+        except OSError: pass
+
+def _acquire_scan_lock(lock_path) -> bool:
+    # 删除过期锁之后仍用 O_EXCL 创建, 同时接管的 worker 中只有一个能成功
+    for _ in range(2):
+        try: fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not _lock_is_stale(lock_path) or not _remove_stale_lock(lock_path): return False
+            continue
+        with os.fdopen(fd, 'w', encoding='utf-8') as f: f.write(str(os.getpid()))
+        return True
+    return False
+
+def start_media_scan(force_rescan=False) -> bool:
+    """在后台线程扫描并发布新一代索引; 本进程或其他 worker 已在扫描时返回 False"""
+    lock_path = MEDIA_INDEX_BASE + '.lock'
+    if not _acquire_scan_lock(lock_path): return False
+    threading.Thread(target=_build_media_index, args=(force_rescan, lock_path), daemon=True).start()
+    return True
+
+def is_scanning() -> bool:
+    """锁存在且仍在刷新; 崩溃进程留下的过期锁不算"""
+    lock_path = MEDIA_INDEX_BASE + '.lock'
+    return os.path.exists(lock_path) and not _lock_is_stale(lock_path)
+
+def current_media():
+    """返回当前一代的 (图片列表, 视频/GIF 列表), 均为只读序列; 索引尚未建立时返回 None"""
+    index = media_index.get()
+    return None if index is None else (index.images, index.videos)
+
+def _feistel(x: int, half_bits: int, keys) -> int:
+    mask = (1 << half_bits) - 1
+    left, right = x >> half_bits, x & mask
+    for key in keys:
+        left, right = right, left ^ (((right * 0x9E3779B1) ^ key) * 0x85EBCA77 >> 7 & mask)
+    return (left << half_bits) | right
+
+def seeded_picks(total: int, seed: int, start: int, n: int) -> list[int]:
+    """种子决定的 0..total-1 的伪随机排列中第 start 到 start+n 个元素
+    用 Feistel 网络加循环折返实现, 一轮之内不重复, 且不需要生成整个排列"""
+    if total == 0: return []
+    half_bits = max(1, ((total - 1).bit_length() + 1) // 2)
+    rng = random.Random(seed); keys = [rng.getrandbits(32) for _ in range(4)]
+    picks = []
+    for i in range(start, start + min(n, total)):
+        x = _feistel(i % total, half_bits, keys)
+        while x >= total: x = _feistel(x, half_bits, keys)
+        picks.append(x)
+    return picks
+
+def image_size(rel_path):
+    """只读取图片头部得到 (宽, 高), 读取失败时返回 (None, None)"""
+    try:
+        with Image.open(os.path.join(PROJECT_PARENT_DIR, rel_path)) as img: return img.size
+    except Exception: return None, None
+
+def media_url(rel_path: str, mtime: int | None = None) -> str:
+    """带修改时间 (毫秒) 版本号的媒体链接, 文件变化后链接随之变化, 因此可以长期缓存; 未给出 mtime 时 stat 一次"""
+    if not mtime:
+        try: mtime = os.stat(os.path.join(PROJECT_PARENT_DIR, rel_path)).st_mtime_ns // 1_000_000
+        except OSError: return f"/media/{quote(rel_path)}"
+    return f"/media/{quote(rel_path)}?v={mtime}"
+
+def media_records(media_list, rows=slice(None)):
+    """路径加上尺寸 / 帧数 / 大小 / 修改时间, 前端据此预留布局并生成带版本号的链接; 未知的尺寸为 0"""
+    return [{"path": path, "width": info.width, "height": info.height, "frames": info.frames, "size": info.size, "mtime": info.mtime}
+            for path, info in zip(media_list[rows], media_list.info(rows))]
+
+def preload_header(urls) -> str:
+    return ", ".join(f"<{url}>; rel=preload; as=image" for url in urls)
+
+def loading_response():
+    return jsonify({"loading": True, "error": "Media index is still loading."}), 503
+
+def loading_page():
+    """依赖媒体索引的页面在首次建立索引期间返回的自动刷新页"""
+    return '<meta http-equiv="refresh" content="2">正在建立媒体索引, 请稍候...', 503
+
+if media_index.get() is None: start_media_scan()
+
 # --- HTML 页面路由 ---
 @app.route('/')
 def random_image_page():
+    media = current_media()
+    if media is None: return loading_page()
+    image_files, _ = media
     if not image_files: return "没有找到静态图片。", 404
-    chosen_image = random.choice(image_files)
+    # 按种子排列依次浏览, 下一张在本页加载时就开始预加载, 点击后直接命中缓存
+    seed = request.args.get('seed', random.randrange(2**31), type=int); position = request.args.get('i', 0, type=int)
+    picks = seeded_picks(len(image_files), seed, position, 2)
+    chosen_image, next_image = image_files[picks[0]], image_files[picks[-1]]
     folder_path = os.path.dirname(chosen_image)
-    return render_template_string(RANDOM_IMAGE_HTML, image_path=chosen_image, folder_path=folder_path)
+    image_url, next_image_url = media_url(chosen_image, image_files.info(picks[0]).mtime), media_url(next_image, image_files.info(picks[-1]).mtime)
+    html = render_template_string(RANDOM_IMAGE_HTML, image_url=image_url, folder_path=folder_path, next_url=url_for('random_image_page', seed=seed, i=position + 1))
+    return html, 200, {"Link": preload_header([next_image_url])}
 
 @app.route('/slideshow')
-def slideshow_page(): return render_template_string(SLIDESHOW_HTML)
-
+def slideshow_page():
+    # 首批图片随页面一起下发并通过 Link 头预加载, 后续批次由前端从 /api/random-images 补充
+    media = current_media()
+    seed = random.randrange(2**31)
+    first_batch = random_images_payload(media[0], seed, 0, 8) if media else None
+    headers = {"Link": preload_header([item["url"] for item in first_batch["images"][:3]])} if first_batch and first_batch["images"] else {}
+    return render_template_string(SLIDESHOW_HTML, first_batch=first_batch), 200, headers
+
+# 页面脚本只请求一次列表, 索引建立之前先返回刷新页, 避免脚本拿到 503 的加载中状态后不再重试
 @app.route('/grid')
-def grid_page(): return render_template_string(GRID_HTML)
+def grid_page():
+    if media_index.get() is None: return loading_page()
+    return render_template_string(GRID_HTML)
 
 @app.route('/videos')
-def video_grid_page(): return render_template_string(VIDEO_GRID_HTML)
+def video_grid_page():
+    if media_index.get() is None: return loading_page()
+    return render_template_string(VIDEO_GRID_HTML)
 
 @app.route('/tags')
 def tags_index_page(): return render_template_string(TAGS_INDEX_HTML)
@@ -79,119 +364,159 @@ def search_page():
     query = request.args.get('q', '')
     return render_template_string(SEARCH_PAGE_HTML, query=query, PAGE_SIZE=PAGE_SIZE)
 
+@app.route('/similar/<path:filepath>')
+def similar_page(filepath):
+    return render_template_string(SIMILAR_PAGE_HTML, filepath=unquote(filepath).replace('\\', '/'))
+
 @app.route('/folder/<path:folder_path>')
 def folder_view_page(folder_path):
-    decoded_path = unquote(folder_path).replace('\\', '/')
-    clean_dir = decoded_path.lstrip('/')
-    if clean_dir.startswith('media/'): clean_dir = clean_dir[6:]
-    elif clean_dir == 'media': clean_dir = ''
-    
-    # 将解码后的路径也转为相对路径进行匹配逻辑（防御性编程）
-    if os.path.isabs(clean_dir):
-        try: clean_dir = os.path.relpath(clean_dir, PROJECT_PARENT_DIR).replace('\\', '/')
-        except ValueError: pass
-
-    folder_media = []
-    all_media_files = image_files + video_and_gif_files
-    for media_path in all_media_files:
-        img_dir = os.path.dirname(media_path).replace('\\', '/')
-        if img_dir == clean_dir:
-            folder_media.append(media_path)
-            
-    folder_media.sort(key=natural_sort_key)
     return render_template_string(FOLDER_VIEW_HTML, folder_path_encoded=folder_path, PAGE_SIZE=PAGE_SIZE)
 
 # --- API 数据接口 ---
 @app.route('/api/images')
 def get_all_images(): 
-    if not image_files: return jsonify([])
-    return jsonify(random.sample(image_files, len(image_files)))
+    index = media_index.get()
+    if index is None: return loading_response()
+    # 列表按代缓存并预压缩, 打乱顺序交给前端
+    return json_response(response_cache.get(('images', index.generation), lambda: media_records(index.images)), request)
 
 @app.route('/api/videos')
 def get_all_videos(): 
-    if not video_and_gif_files: return jsonify([])
-    return jsonify(random.sample(video_and_gif_files, len(video_and_gif_files)))
+    index = media_index.get()
+    if index is None: return loading_response()
+    return json_response(response_cache.get(('videos', index.generation), lambda: list(index.videos)), request)
 
 @app.route('/api/random-image')
 def get_random_image_path():
+    media = current_media()
+    if media is None: return loading_response()
+    image_files, _ = media
     if not image_files: return jsonify({'error': 'No images found'}), 404
     return jsonify({'path': random.choice(image_files)})
 
+def random_images_payload(image_files, seed, start, n):
+    picks = seeded_picks(len(image_files), seed, start, n)
+    images = []
+    for i in picks:
+        path, info = image_files[i], image_files.info(i)
+        width, height = (info.width, info.height) if info.width else image_size(path)
+        images.append({"path": path, "url": media_url(path, info.mtime), "width": width, "height": height})
+    return {"seed": seed, "next": start + len(picks), "images": images}
+
+@app.route('/api/random-images')
+def get_random_images():
+    """按种子返回一批不重复的随机图片 (含尺寸); 同一 seed 用 start=next 继续取下一批, 整轮之内不会重复"""
+    media = current_media()
+    if media is None: return loading_response()
+    n = max(1, min(request.args.get('n', 8, type=int), RANDOM_BATCH_MAX))
+    seed = request.args.get('seed', random.randrange(2**31), type=int); start = max(0, request.args.get('start', 0, type=int))
+    payload = random_images_payload(media[0], seed, start, n)
+    response = jsonify(payload)
+    if payload["images"]: response.headers["Link"] = preload_header([item["url"] for item in payload["images"]])
+    return response
+
 @app.route('/api/characters')
 def get_characters_with_covers():
-    conn = get_db_connection();
-    if conn is None: return jsonify({"error": f"Database file '{DB_PATH}' not found."}), 404
-    page = request.args.get('page', 1, type=int); search_term = request.args.get('search', '', type=str).strip().replace(" ", "_"); offset = (page - 1) * PAGE_SIZE
+    version = db_version()
+    if version is None: return jsonify({"error": f"Database file '{DB_PATH}' not found."}), 404
+    page = request.args.get('page', 1, type=int); search_term = request.args.get('search', '', type=str).strip()
+    return json_response(response_cache.get(('characters', version, page, search_term), lambda: load_characters(page, search_term)), request)
+
+def load_characters(page, search_term):
+    conn = get_db_connection(); offset = (page - 1) * PAGE_SIZE
     character_data = []
     if page == 1 and not search_term:
         oc_query = "SELECT 'others/oc' as character_name, i.filepath FROM images i JOIN image_tags it ON i.id = it.image_id JOIN tags t ON it.tag_id = t.id WHERE i.character_name = 'others/oc' AND t.name = 'looking at viewer' LIMIT 1"
-        oc_cover = conn.execute(oc_query).fetchone()
+        oc_cover = next(iter(run_query(conn, "characters_oc_cover", oc_query)), None)
         if oc_cover: character_data.append(dict(oc_cover))
     params = []; search_clause = ""
-    if search_term: search_clause = "AND i.character_name LIKE ?"; params.append(f"%{search_term}%")
+    if search_term and has_name_index(conn):
+        # 先在 trigram 索引里找出匹配的角色名, 再用 character_name 索引取封面
+        with SQL_SECONDS.time(statement="characters_name_search"): names = search_names(conn, search_term, 'char', limit=1000)
+        if not names: conn.close(); return []
+        search_clause = f"AND i.character_name IN ({','.join(['?']*len(names))})"; params.extend(names)
+    elif search_term: search_clause = "AND i.character_name LIKE ?"; params.append(f"%{search_term.replace(' ', '_')}%")
     query = f"SELECT T1.character_name, T1.filepath FROM images AS T1 INNER JOIN (SELECT i.character_name, MIN(i.id) as image_id FROM images i JOIN image_tags it ON i.id = it.image_id JOIN tags t ON it.tag_id = t.id WHERE t.name = 'looking at viewer' AND i.character_name != 'others/oc' {search_clause} GROUP BY i.character_name) AS T2 ON T1.character_name = T2.character_name AND T1.id = T2.image_id ORDER BY T1.character_name LIMIT ? OFFSET ?"
-    params.extend([PAGE_SIZE, offset]); other_characters = conn.execute(query, params).fetchall(); conn.close()
+    params.extend([PAGE_SIZE, offset]); other_characters = run_query(conn, "characters_covers", query, params); conn.close()
     character_data.extend([dict(row) for row in other_characters])
-    return jsonify(character_data)
+    return character_data
+
+@app.route('/api/tag_suggest')
+def api_tag_suggest():
+    conn = get_db_connection()
+    if conn is None: return jsonify({"error": f"Database file '{DB_PATH}' not found."}), 404
+    term = request.args.get('q', '', type=str).strip(); limit = request.args.get('limit', 20, type=int)
+    if not term or not has_name_index(conn): conn.close(); return jsonify([])
+    kind = 'char' if term.lower().startswith('char:') else 'tag'
+    with SQL_SECONDS.time(statement="tag_suggest"): names = search_names(conn, term.split(':', 1)[1].strip() if kind == 'char' else term, kind, limit)
+    conn.close()
+    return jsonify([f"char:{n}" if kind == 'char' else n for n in names])
 
-# ==========================================================
-#  ↓↓↓ 核心修复：将绝对路径转为相对路径，修复图集跳转链接 ↓↓↓
-# ==========================================================
 @app.route('/api/character_images/<path:character_name>')
 def get_character_images(character_name):
-    conn = get_db_connection();
-    if conn is None: return jsonify([]), 404
-    query = "SELECT filepath FROM images WHERE character_name = ?"
-    params = (character_name,)
-    images = conn.execute(query, params).fetchall()
-    conn.close()
-    
-    results = []
-    for row in images:
-        db_path = row['filepath']
-        if os.path.isabs(db_path):
-            try:
-                rel = os.path.relpath(db_path, PROJECT_PARENT_DIR)
-                results.append(rel.replace('\\', '/'))
-            except ValueError:
-                results.append(db_path.replace('\\', '/'))
-        else:
-            results.append(db_path.replace('\\', '/'))
-            
-    random.shuffle(results) 
-    return jsonify(results)
+    """按 rand_key 的随机顺序分页返回 {"seed", "images", "next"}; 下一页带上同一 seed 和 after=next, next 为 null 表示已到末尾"""
+    conn = get_db_connection()
+    if conn is None: return jsonify({"error": f"Database file '{DB_PATH}' not found."}), 404
+    limit = max(1, min(request.args.get('limit', PAGE_SIZE, type=int), CHARACTER_PAGE_MAX))
+    seed = request.args.get('seed', random.randrange(RAND_KEY_MAX), type=int) % RAND_KEY_MAX
+    rows = character_page(conn, character_name, seed, request.args.get('after', None, type=int), limit); conn.close()
+    return jsonify({"seed": seed, "images": [row[0] for row in rows], "next": rows[-1][1] if len(rows) == limit else None})
+
+def character_page(conn, character_name, seed, after, limit):
+    """seed 决定从哪个 rand_key 开始, 先取 [seed, 末尾], 再绕回取 [0, seed); 每页都是 (character_name, rand_key) 索引上的一次范围扫描"""
+    query = "SELECT filepath, rand_key FROM images WHERE character_name = ? AND {} ORDER BY rand_key LIMIT ?"
+    rows = []
+    if after is None or after >= seed:
+        lower = ("rand_key >= ?", seed) if after is None else ("rand_key > ?", after)
+        rows = run_query(conn, "character_page", query.format(lower[0]), (character_name, lower[1], limit))
+        after = -1
+    if len(rows) < limit:
+        rows += run_query(conn, "character_page_wrap", query.format("rand_key > ? AND rand_key < ?"), (character_name, after, seed, limit - len(rows)))
+    return rows
 
 @app.route('/api/search')
 def api_search():
-    conn = get_db_connection()
-    if conn is None: return jsonify({"error": f"Database file '{DB_PATH}' not found."}), 404
+    version = db_version()
+    if version is None: return jsonify({"error": f"Database file '{DB_PATH}' not found."}), 404
     page = request.args.get('page', 1, type=int); limit = request.args.get('limit', PAGE_SIZE, type=int)
     query_str = request.args.get('q', '', type=str); offset = (page - 1) * limit
     if not query_str: return jsonify([])
-    raw_tags = [tag.strip() for tag in query_str.split(' ') if tag.strip()]
-    rating_filters, char_filters, general_tags = [], [], []
-    for tag in raw_tags:
-        if tag.lower().startswith("rating:"): rating_filters.append(f"rating:{tag.split(':', 1)[1].strip()}")
-        elif tag.lower().startswith("char:"): char_filters.append(tag.split(':', 1)[1].strip().replace(' ', '_'))
-        else: general_tags.append(tag.replace('_', ' '))
-    base_query = "SELECT T0.filepath FROM images AS T0"; params = []; where_clauses = []
-    if general_tags:
-        general_subquery = f"T0.id IN (SELECT it.image_id FROM image_tags it JOIN tags t ON it.tag_id = t.id WHERE t.name IN ({','.join(['?']*len(general_tags))}) GROUP BY it.image_id HAVING COUNT(it.image_id) = ?)"
-        where_clauses.append(general_subquery); params.extend(general_tags); params.append(len(general_tags))
-    for rating in rating_filters: where_clauses.append("T0.rating = ?"); params.append(rating)
-    for char in char_filters: where_clauses.append("T0.character_name = ?"); params.append(char)
-    if not where_clauses: return jsonify([])
-    final_query = f"{base_query} WHERE {' AND '.join(where_clauses)} ORDER BY T0.id DESC LIMIT ? OFFSET ?"; params.extend([limit, offset])
-    cursor = conn.cursor(); cursor.execute(final_query, params); 
-    results = []
-    for row in cursor.fetchall():
-        db_path = row['filepath']
-        if os.path.isabs(db_path):
-            try: results.append(os.path.relpath(db_path, PROJECT_PARENT_DIR).replace('\\', '/'))
-            except ValueError: results.append(db_path.replace('\\', '/'))
-        else: results.append(db_path.replace('\\', '/'))
+    return json_response(response_cache.get(('search', version, query_str, limit, offset), lambda: load_search_page(query_str, limit, offset)), request)
+
+def load_search_page(query_str, limit, offset):
+    compiled = compile_query(query_str, select="T0.filepath, T0.width, T0.height, T0.file_size, T0.mtime")
+    if compiled is None: return []
+    conn = get_db_connection()
+    final_query = f"{compiled[0]} LIMIT ? OFFSET ?"; params = [*compiled[1], limit, offset]
+    # 元数据尚未写入的行 width 等为 null
+    results = [{"path": row[0], "width": row[1], "height": row[2], "size": row[3], "mtime": row[4]} for row in run_query(conn, "search", final_query, params)]
+    conn.close()
+    return results
+
+_embed_store, _embed_ivf = None, None
+def get_embed_store():
+    global _embed_store, _embed_ivf
+    store = VectorStore(EMBED_STORE_PATH)
+    if not store.exists(): return None, None
+    # 索引器追加了新行就重新打开, 保证新图片能被搜到
+    if _embed_store is None or len(_embed_store) != len(store): _embed_store, _embed_ivf = store, IVFIndex.load(store)
+    return _embed_store, _embed_ivf
+
+@app.route('/api/similar/<path:filepath>')
+def api_similar(filepath):
+    store, ivf = get_embed_store()
+    if store is None: return jsonify({"error": f"Embedding store '{EMBED_STORE_PATH}' not found."}), 404
+    conn = get_db_connection()
+    if conn is None: return jsonify({"error": f"Database file '{DB_PATH}' not found."}), 404
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    rel_path = unquote(filepath).replace('\\', '/').lstrip('/')
+    row = conn.execute("SELECT id FROM images WHERE filepath = ?", (rel_path,)).fetchone()
+    matches = find_similar(store, row['id'], limit, ivf) if row else None
+    if matches is None: conn.close(); return jsonify({"error": "No embedding stored for this image."}), 404
+    ids = [image_id for image_id, _ in matches]
+    paths = {r['id']: r['filepath'] for r in conn.execute(f"SELECT id, filepath FROM images WHERE id IN ({','.join(['?']*len(ids))})", ids)}
     conn.close()
-    return jsonify(results)
+    return jsonify([{"path": paths[image_id], "score": round(score, 4)} for image_id, score in matches if image_id in paths])
 
 @app.route('/api/folder_images')
 def api_folder_images():
@@ -210,33 +535,70 @@ def api_folder_images():
         try: clean_dir = os.path.relpath(clean_dir, PROJECT_PARENT_DIR).replace('\\', '/')
         except ValueError: pass
     
-    folder_media = []
-    all_media_files = image_files + video_and_gif_files
-    for media_path in all_media_files:
-        img_dir = os.path.dirname(media_path).replace('\\', '/')
-        if img_dir == clean_dir:
-            folder_media.append(media_path)
-            
-    folder_media.sort(key=natural_sort_key)
-    paginated_media = folder_media[offset : offset + limit]
-    
-    return jsonify({
-        "files": paginated_media,
-        "folder_name": clean_dir if clean_dir else "Root",
-        "total": len(folder_media),
-        "has_more": (offset + limit) < len(folder_media)
-    })
+    # 索引中同一目录的文件连续存放且已按 natural_sort_key 排好, 直接切片
+    index = media_index.get()
+    if index is None: return loading_response()
+    def build():
+        folder_media = index.folder(clean_dir)
+        paginated_media = media_records(folder_media, slice(offset, offset + limit))
+        return {
+            "files": paginated_media,
+            "folder_name": clean_dir if clean_dir else "Root",
+            "total": len(folder_media),
+            "has_more": (offset + limit) < len(folder_media)
+        }
+    return json_response(response_cache.get(('folder', index.generation, clean_dir, offset, limit), build), request)
+
+@app.route('/api/export')
+def api_export():
+    """流式导出查询匹配的全部图片及其标签: ?q=查询 (为空导出全部) &format=ndjson|csv &min_conf=只导出置信度不低于它的标签"""
+    conn = get_db_connection()
+    if conn is None: return jsonify({"error": f"Database file '{DB_PATH}' not found."}), 404
+    fmt = request.args.get('format', 'ndjson', type=str)
+    if fmt not in EXPORT_FORMATS: conn.close(); return jsonify({"error": f"Unknown format '{fmt}'."}), 400
+    chunks = export_chunks(conn, request.args.get('q', '', type=str), request.args.get('min_conf', None, type=float))
+    def generate():
+        # 连接在生成器里关闭; 客户端中途断开时 WSGI 服务器会调用 close, 同样走到 finally
+        try: yield from encode_export(chunks, fmt)
+        finally: chunks.close(); conn.close()
+    # X-Accel-Buffering: 让 nginx 边收边发, 不把整个导出缓存在代理上
+    return Response(generate(), mimetype=EXPORT_FORMATS[fmt], headers={"Content-Disposition": f'attachment; filename="export.{fmt}"', "X-Accel-Buffering": "no"})
+
+@app.route('/api/status')
+def api_status():
+    index = media_index.get()
+    status = {"ready": index is not None, "scanning": is_scanning()}
+    if index is not None: status.update(generation=index.generation, images=len(index.images), videos=len(index.videos))
+    return jsonify(status)
 
 # --- 文件服务与管理 ---
 @app.route('/media/<path:filepath>')
 def serve_media(filepath):
-    decoded_filepath = unquote(filepath); absolute_path = os.path.join(PROJECT_PARENT_DIR, decoded_filepath)
-    if not os.path.abspath(absolute_path).startswith(os.path.abspath(PROJECT_PARENT_DIR)): return "Forbidden", 403
-    if os.path.exists(absolute_path): return send_file(absolute_path)
-    else: return "File not found", 404
+    # 只做字符串级的路径检查; 开启 MEDIA_OFFLOAD 时不访问文件系统, 文件是否存在由前置代理判断
+    relative_path = unquote(filepath).replace('\\', '/').lstrip('/')
+    parts = relative_path.split('/')
+    if '..' in parts or ':' in parts[0]: return "Forbidden", 403
+    if MEDIA_OFFLOAD == 'x-accel':
+        response = Response(headers={"X-Accel-Redirect": MEDIA_OFFLOAD_PREFIX + quote(relative_path)}, mimetype=mimetypes.guess_type(relative_path)[0])
+    elif MEDIA_OFFLOAD == 'x-sendfile':
+        response = Response(headers={"X-Sendfile": os.path.join(PROJECT_PARENT_DIR, relative_path)}, mimetype=mimetypes.guess_type(relative_path)[0])
+    else:
+        absolute_path = os.path.join(PROJECT_PARENT_DIR, relative_path)
+        if not os.path.isfile(absolute_path): return "File not found", 404
+        response = send_file(absolute_path, conditional=True)
+        if response.status_code in (200, 206): MEDIA_BYTES.inc(response.content_length or 0, kind=(mimetypes.guess_type(relative_path)[0] or "other").split('/')[0])
+    # 带版本号的链接指向的内容不会变化, 允许浏览器和代理长期缓存
+    response.headers["Cache-Control"] = f"public, max-age={MEDIA_IMMUTABLE_MAX_AGE}, immutable" if request.args.get('v') else f"public, max-age={MEDIA_MAX_AGE}"
+    return response
+
+@app.route('/metrics')
+def metrics_page():
+    return Response(metrics.render(METRICS_DIR), content_type=metrics_export.CONTENT_TYPE)
+
 @app.route('/rescan')
 def rescan_media():
-    global image_files, video_and_gif_files; image_files, video_and_gif_files = scan_media_files(force_rescan=True)
+    # 扫描在后台进行, 完成前继续使用上一代索引
+    start_media_scan(force_rescan=True)
     referrer = request.headers.get("Referer");
     if referrer and any(x in referrer for x in ['/grid', '/videos', '/slideshow', '/tags', '/search', '/folder']): return redirect(referrer)
     return redirect(url_for('random_image_page'))
@@ -244,11 +606,32 @@ def rescan_media():
 # --- HTML 模板 (使用 r"..." 原始字符串) ---
 
 RANDOM_IMAGE_HTML = r"""
-<!DOCTYPE html><html lang="zh-CN"><head><title>随机图片</title><style>body,html{margin:0;padding:0;height:100%;background-color:#111;color:#fff;font-family:sans-serif}.nav{position:absolute;top:15px;right:20px;z-index:100}.nav a{color:#fff;text-decoration:none;padding:8px 15px;background-color:rgba(0,0,0,0.5);border-radius:5px;margin-left:10px}.nav a.folder-btn{background-color:rgba(0,100,200,0.6);font-weight:bold}#container{width:100vw;height:100vh;display:flex;justify-content:center;align-items:center}#container a{display:contents}#container img{max-width:100%;max-height:100%;object-fit:contain;cursor:pointer}</style></head><body><div class="nav"><a href="/folder/{{ folder_path }}" class="folder-btn">查看图集</a><a href="/search">搜索</a><a href="/slideshow">幻灯片</a><a href="/grid">图片网格</a><a href="/videos">视频/GIF</a><a href="/tags">角色</a><a href="/rescan">扫描</a></div><div id="container"><a href="/"><img src="/media/{{ image_path }}" alt="随机图片"></a></div></body></html>
+<!DOCTYPE html><html lang="zh-CN"><head><title>随机图片</title><style>body,html{margin:0;padding:0;height:100%;background-color:#111;color:#fff;font-family:sans-serif}.nav{position:absolute;top:15px;right:20px;z-index:100}.nav a{color:#fff;text-decoration:none;padding:8px 15px;background-color:rgba(0,0,0,0.5);border-radius:5px;margin-left:10px}.nav a.folder-btn{background-color:rgba(0,100,200,0.6);font-weight:bold}#container{width:100vw;height:100vh;display:flex;justify-content:center;align-items:center}#container a{display:contents}#container img{max-width:100%;max-height:100%;object-fit:contain;cursor:pointer}</style></head><body><div class="nav"><a href="/folder/{{ folder_path }}" class="folder-btn">查看图集</a><a href="/search">搜索</a><a href="/slideshow">幻灯片</a><a href="/grid">图片网格</a><a href="/videos">视频/GIF</a><a href="/tags">角色</a><a href="/rescan">扫描</a></div><div id="container"><a href="{{ next_url }}"><img src="{{ image_url }}" alt="随机图片"></a></div></body></html>
 """
 
 SLIDESHOW_HTML = r"""
-<!DOCTYPE html><html lang="zh-CN"><head><title>幻灯片</title><style>{% raw %}body,html{margin:0;padding:0;height:100%;background-color:#111;color:#fff;overflow:hidden;font-family:sans-serif}.nav{position:absolute;top:15px;right:20px;z-index:100}.nav a{color:#fff;text-decoration:none;padding:8px 15px;background-color:rgba(0,0,0,0.5);border-radius:5px;margin-left:10px}#slideshow-container{width:100vw;height:100vh;display:flex;justify-content:center;align-items:center;cursor:pointer}#slideshow-container img{max-width:100%;max-height:100%;object-fit:contain;opacity:0;transition:opacity .8s ease-in-out}#slideshow-container img.loaded{opacity:1}{% endraw %}</style></head><body><div class="nav"><a href="/search">搜索</a><a href="/">随机</a><a href="/grid">图片网格</a><a href="/videos">视频/GIF</a><a href="/tags">角色</a><a href="/rescan">扫描</a></div><div id="slideshow-container"><img id="image-display" alt="正在加载..."></div><script>{% raw %}const container=document.getElementById("slideshow-container"),imgElement=document.getElementById("image-display"),SLIDESHOW_INTERVAL=5e3;let timer;async function fetchAndShowNextImage(){try{const e=await fetch("/api/random-image");if(!e.ok)throw new Error("无法获取图片");const t=await e.json();imgElement.classList.remove("loaded");const a=new Image;a.src=`/media/${t.path}`,a.onload=()=>{imgElement.src=a.src,imgElement.classList.add("loaded")}}catch(e){console.error("幻灯片错误:",e)}}function startSlideshow(){timer&&clearInterval(timer),fetchAndShowNextImage(),timer=setInterval(fetchAndShowNextImage,SLIDESHOW_INTERVAL)}container.addEventListener("click",startSlideshow),document.addEventListener("DOMContentLoaded",startSlideshow);{% endraw %}</script></body></html>
+<!DOCTYPE html><html lang="zh-CN"><head><title>幻灯片</title><style>{% raw %}body,html{margin:0;padding:0;height:100%;background-color:#111;color:#fff;overflow:hidden;font-family:sans-serif}.nav{position:absolute;top:15px;right:20px;z-index:100}.nav a{color:#fff;text-decoration:none;padding:8px 15px;background-color:rgba(0,0,0,0.5);border-radius:5px;margin-left:10px}#slideshow-container{width:100vw;height:100vh;display:flex;justify-content:center;align-items:center;cursor:pointer}#slideshow-container img{max-width:100%;max-height:100%;object-fit:contain;opacity:0;transition:opacity .8s ease-in-out}#slideshow-container img.loaded{opacity:1}{% endraw %}</style></head><body><div class="nav"><a href="/search">搜索</a><a href="/">随机</a><a href="/grid">图片网格</a><a href="/videos">视频/GIF</a><a href="/tags">角色</a><a href="/rescan">扫描</a></div><div id="slideshow-container"><img id="image-display" alt="正在加载..."></div><script>const FIRST_BATCH={{ first_batch | tojson }};</script><script>{% raw %}
+    const container=document.getElementById("slideshow-container"),imgElement=document.getElementById("image-display"),SLIDESHOW_INTERVAL=5e3,BATCH_SIZE=8,PREFETCH_LOW=3;
+    // 预取缓冲: 每一项在入队时就开始下载, 播放时通常已在缓存中
+    let timer,buffer=[],seed=null,nextStart=0,refilling=false;
+    function enqueue(batch){seed=batch.seed;nextStart=batch.next;for(const item of batch.images){const img=new Image;img.src=item.url;buffer.push(img)}}
+    async function refill(){
+        if(refilling)return;refilling=true;
+        try{const p=new URLSearchParams({n:BATCH_SIZE,start:nextStart});if(seed!==null)p.set("seed",seed);const e=await fetch(`/api/random-images?${p.toString()}`);if(!e.ok)throw new Error("无法获取图片");enqueue(await e.json())}
+        catch(e){console.error("幻灯片错误:",e)}finally{refilling=false}
+    }
+    async function showNextImage(){
+        if(buffer.length===0)await refill();
+        const next=buffer.shift();if(!next)return;
+        if(buffer.length<PREFETCH_LOW)refill();
+        imgElement.classList.remove("loaded");
+        const show=()=>{imgElement.src=next.src;imgElement.classList.add("loaded")};
+        if(next.complete)show();else next.onload=show;
+    }
+    function startSlideshow(){timer&&clearInterval(timer),showNextImage(),timer=setInterval(showNextImage,SLIDESHOW_INTERVAL)}
+    if(FIRST_BATCH)enqueue(FIRST_BATCH);
+    container.addEventListener("click",startSlideshow),document.addEventListener("DOMContentLoaded",startSlideshow);
+{% endraw %}</script></body></html>
 """
 
 FOLDER_VIEW_HTML = r"""
@@ -280,6 +663,7 @@ FOLDER_VIEW_HTML = r"""
 <div class="modal-content-container" id="modalMediaContainer"></div>
 <span class="modal-nav modal-next">&#10095;</span></div>
 <script>{% raw %}
+    const mediaSrc = rec => rec.mtime ? `/media/${rec.path}?v=${rec.mtime}` : `/media/${rec.path}`;
     document.addEventListener("DOMContentLoaded",()=>{
         const grid=document.getElementById("grid-container"),loader=document.getElementById("loader"),titleText=document.getElementById("pageTitleText"),mod=document.getElementById("imageModal"),mediaContainer=document.getElementById("modalMediaContainer"),closeBtn=document.querySelector(".modal-close"),prevBtn=document.querySelector(".modal-prev"),nextBtn=document.querySelector(".modal-next");
         const folderPath = document.body.dataset.folderPath;
@@ -312,9 +696,12 @@ FOLDER_VIEW_HTML = r"""
                 const startIdx = allImages.length;
                 allImages.push(...data.files);
                 
-                data.files.forEach((path, i) => {
+                data.files.forEach((rec, i) => {
+                    const path = rec.path;
                     const item = document.createElement("div");
                     item.className = "grid-item";
+                    // 按记录的尺寸预留高度, 图片加载时页面不再跳动
+                    if(rec.width && rec.height) { item.style.aspectRatio = `${rec.width}/${rec.height}`; item.style.minHeight = "0"; }
                     const skel = document.createElement("div");
                     skel.className = "skeleton";
                     item.appendChild(skel);
@@ -332,7 +719,7 @@ FOLDER_VIEW_HTML = r"""
                     }
                     
                     el.dataset.index = idx;
-                    el.src = `/media/${path}`;
+                    el.src = mediaSrc(rec);
                     const loadEv = isVid ? "onloadeddata" : "onload";
                     el[loadEv] = () => {
                         if(item.contains(skel)) item.removeChild(skel);
@@ -363,7 +750,7 @@ FOLDER_VIEW_HTML = r"""
 
         function openMod(idx){
             currIdx=parseInt(idx);
-            const path = allImages[currIdx];
+            const path = allImages[currIdx].path;
             const isVideo = path.toLowerCase().match(/\.(mp4|webm|mov|mkv|avi)$/);
             mediaContainer.innerHTML = '';
             let el;
@@ -373,7 +760,7 @@ FOLDER_VIEW_HTML = r"""
                 el.autoplay = true; el.loop = true; el.muted = true; el.playsInline = true; el.controls = true;
             } else {
                 el = document.createElement('img');
-                el.src = `/media/${path}`;
+                el.src = mediaSrc(allImages[currIdx]);
             }
             mediaContainer.appendChild(el);
             mod.style.display="flex";document.body.style.overflow="hidden";
@@ -395,24 +782,24 @@ FOLDER_VIEW_HTML = r"""
 """
 
 GRID_HTML=r"""
-<!DOCTYPE html><html lang="zh-CN"><head><title>图片网格</title><style>{% raw %}body{margin:0;background-color:#222;font-family:sans-serif}.header{position:sticky;top:0;background-color:rgba(20,20,20,.95);padding:15px;text-align:right;z-index:100}.header a{color:#fff;text-decoration:none;padding:8px 15px;background-color:rgba(0,0,0,.5);border-radius:5px;margin-left:10px}#grid-container{display:grid;grid-template-columns:repeat(auto-fill,minmax(250px,1fr));gap:10px;padding:10px}.grid-item{position:relative;border-radius:8px;cursor:pointer;background-color:#333;aspect-ratio:3/4;overflow:hidden}.grid-item img{width:100%;height:100%;display:block;object-fit:cover;opacity:0;transition:opacity .5s}.grid-item img.loaded{opacity:1}.skeleton{position:absolute;top:0;left:0;width:100%;height:100%;background:linear-gradient(90deg,#333 25%,#444 50%,#333 75%);background-size:200% 100%;animation:shimmer 1.5s infinite}@keyframes shimmer{0%{background-position:200% 0}100%{background-position:-200% 0}}#loader{text-align:center;padding:20px;color:#888}.modal{display:none;position:fixed;z-index:1000;left:0;top:0;width:100%;height:100%;overflow:hidden;background-color:rgba(0,0,0,.9);align-items:center;justify-content:center}.modal-content{max-width:95vw;max-height:95vh;object-fit:contain}.modal-close{position:absolute;top:20px;right:35px;color:#f1f1f1;font-size:40px;font-weight:700;cursor:pointer}.modal-nav{position:absolute;top:50%;transform:translateY(-50%);color:#f1f1f1;font-size:60px;font-weight:700;cursor:pointer;user-select:none;padding:16px}.modal-prev{left:0}.modal-next{right:0}
+<!DOCTYPE html><html lang="zh-CN"><head><title>图片网格</title><style>{% raw %}body{margin:0;background-color:#222;font-family:sans-serif}.header{position:sticky;top:0;background-color:rgba(20,20,20,.95);padding:15px;text-align:right;z-index:100}.header a{color:#fff;text-decoration:none;padding:8px 15px;background-color:rgba(0,0,0,.5);border-radius:5px;margin-left:10px}#grid-container{display:grid;grid-template-columns:repeat(auto-fill,minmax(250px,1fr));gap:10px;padding:10px}#grid-container{align-items:start}.grid-item{position:relative;border-radius:8px;cursor:pointer;background-color:#333;aspect-ratio:3/4;overflow:hidden}.grid-item img{width:100%;height:100%;display:block;object-fit:cover;opacity:0;transition:opacity .5s}.grid-item img.loaded{opacity:1}.skeleton{position:absolute;top:0;left:0;width:100%;height:100%;background:linear-gradient(90deg,#333 25%,#444 50%,#333 75%);background-size:200% 100%;animation:shimmer 1.5s infinite}@keyframes shimmer{0%{background-position:200% 0}100%{background-position:-200% 0}}#loader{text-align:center;padding:20px;color:#888}.modal{display:none;position:fixed;z-index:1000;left:0;top:0;width:100%;height:100%;overflow:hidden;background-color:rgba(0,0,0,.9);align-items:center;justify-content:center}.modal-content{max-width:95vw;max-height:95vh;object-fit:contain}.modal-close{position:absolute;top:20px;right:35px;color:#f1f1f1;font-size:40px;font-weight:700;cursor:pointer}.modal-nav{position:absolute;top:50%;transform:translateY(-50%);color:#f1f1f1;font-size:60px;font-weight:700;cursor:pointer;user-select:none;padding:16px}.modal-prev{left:0}.modal-next{right:0}
 .modal-folder-btn{position:absolute;bottom:30px;left:50%;transform:translateX(-50%);background:rgba(0,0,0,0.6);border:1px solid #fff;color:#fff;padding:8px 16px;border-radius:4px;text-decoration:none;font-size:14px;z-index:1002;transition:background .2s}.modal-folder-btn:hover{background:rgba(255,255,255,0.2)}
 {% endraw %}</style></head><body><div class="header"><a href="/search">搜索</a><a href="/">随机</a><a href="/slideshow">幻灯片</a><a href="/videos">视频/GIF</a><a href="/tags">角色</a><a href="/rescan">扫描</a></div><div id="grid-container"></div><div id="loader">正在加载...</div><div id="imageModal" class="modal"><span class="modal-close">&times;</span>
-<a id="modalFolderBtn" class="modal-folder-btn" target="_blank">查看所属图集</a>
-<span class="modal-nav modal-prev">&#10094;</span><img class="modal-content" id="modalImage"><span class="modal-nav modal-next">&#10095;</span></div><script>{% raw %}const grid=document.getElementById("grid-container"),loader=document.getElementById("loader"),imageModal=document.getElementById("imageModal"),modalImage=document.getElementById("modalImage"),closeBtn=document.querySelector(".modal-close"),prevBtn=document.querySelector(".modal-prev"),nextBtn=document.querySelector(".modal-next"),modFolderBtn=document.getElementById("modalFolderBtn");let allImages=[],currentIndex=0,currentModalImageIndex=-1;const BATCH_SIZE=30;function loadMoreImages(){if(currentIndex>=allImages.length){loader.textContent="已加载全部";return}const t=allImages.slice(currentIndex,currentIndex+BATCH_SIZE);for(const[e,a]of t.entries()){const t=document.createElement("div");t.className="grid-item";const n=document.createElement("div");n.className="skeleton",t.appendChild(n);const d=document.createElement("img"),o=currentIndex+e;t.dataset.index=o,d.dataset.index=o,d.onload=()=>{t.removeChild(n),d.classList.add("loaded")},d.src=`/media/${a}`,t.appendChild(d),grid.appendChild(t)}currentIndex+=BATCH_SIZE}function openModal(e){currentModalImageIndex=parseInt(e);const path=allImages[currentModalImageIndex];modalImage.src=`/media/${path}`;imageModal.style.display="flex";document.body.style.overflow="hidden";
-const normalizedPath = path.replace(/\\/g, '/');
+<a id="modalFolderBtn" class="modal-folder-btn" target="_blank">查看所属图集</a><a id="modalSimilarBtn" class="modal-folder-btn" style="bottom:80px" target="_blank">相似图片</a>
+<span class="modal-nav modal-prev">&#10094;</span><img class="modal-content" id="modalImage"><span class="modal-nav modal-next">&#10095;</span></div><script>{% raw %}const mediaSrc=a=>a.mtime?`/media/${a.path}?v=${a.mtime}`:`/media/${a.path}`;function shuffleList(a){for(let i=a.length-1;i>0;i--){const j=Math.floor(Math.random()*(i+1));[a[i],a[j]]=[a[j],a[i]]}return a}const grid=document.getElementById("grid-container"),loader=document.getElementById("loader"),imageModal=document.getElementById("imageModal"),modalImage=document.getElementById("modalImage"),closeBtn=document.querySelector(".modal-close"),prevBtn=document.querySelector(".modal-prev"),nextBtn=document.querySelector(".modal-next"),modFolderBtn=document.getElementById("modalFolderBtn");let allImages=[],currentIndex=0,currentModalImageIndex=-1;const BATCH_SIZE=30;function loadMoreImages(){if(currentIndex>=allImages.length){loader.textContent="已加载全部";return}const t=allImages.slice(currentIndex,currentIndex+BATCH_SIZE);for(const[e,a]of t.entries()){const t=document.createElement("div");t.className="grid-item";const n=document.createElement("div");n.className="skeleton",t.appendChild(n);const d=document.createElement("img"),o=currentIndex+e;t.dataset.index=o,d.dataset.index=o,d.onload=()=>{t.removeChild(n),d.classList.add("loaded")},a.width&&a.height&&(t.style.aspectRatio=`${a.width}/${a.height}`),d.src=mediaSrc(a),t.appendChild(d),grid.appendChild(t)}currentIndex+=BATCH_SIZE}function openModal(e){currentModalImageIndex=parseInt(e);const path=allImages[currentModalImageIndex].path;modalImage.src=mediaSrc(allImages[currentModalImageIndex]);imageModal.style.display="flex";document.body.style.overflow="hidden";
+const normalizedPath = path.replace(/\\/g, '/');const simBtn=document.getElementById("modalSimilarBtn");simBtn.href=`/similar/${normalizedPath.replace(/^\//,'').split('/').map(encodeURIComponent).join('/')}`;
 const lastSlash=normalizedPath.lastIndexOf('/');if(lastSlash>-1){let f=normalizedPath.substring(0,lastSlash);if(f.startsWith('/'))f=f.substring(1);modFolderBtn.href=`/folder/${encodeURIComponent(f)}`;modFolderBtn.style.display="block"}else{modFolderBtn.style.display="none"}
-}function closeModal(){imageModal.style.display="none",document.body.style.overflow=""}function showNextImage(){currentModalImageIndex=(currentModalImageIndex+1)%allImages.length,openModal(currentModalImageIndex)}function showPrevImage(){currentModalImageIndex=(currentModalImageIndex-1+allImages.length)%allImages.length,openModal(currentModalImageIndex)}async function initializeGrid(){try{const e=await fetch("/api/images");if(allImages=await e.json(),0===allImages.length)return void(loader.textContent="未找到任何图片。");loadMoreImages();new IntersectionObserver(e=>{e[0].isIntersecting&&loadMoreImages()},{rootMargin:"200px"}).observe(loader)}catch(e){console.error("无法初始化网格:",e),loader.textContent="加载图片列表失败。"}}grid.addEventListener("click",e=>{e.target.dataset.index&&openModal(e.target.dataset.index)}),closeBtn.addEventListener("click",closeModal),prevBtn.addEventListener("click",showPrevImage),nextBtn.addEventListener("click",showNextImage),document.addEventListener("keydown",e=>{"flex"===imageModal.style.display&&("Escape"===e.key?closeModal():"ArrowRight"===e.key?showNextImage():"ArrowLeft"===e.key&&showPrevImage())}),imageModal.addEventListener("click",e=>{if(e.target===imageModal)closeModal()}),document.addEventListener("DOMContentLoaded",initializeGrid);{% endraw %}</script></body></html>
+}function closeModal(){imageModal.style.display="none",document.body.style.overflow=""}function showNextImage(){currentModalImageIndex=(currentModalImageIndex+1)%allImages.length,openModal(currentModalImageIndex)}function showPrevImage(){currentModalImageIndex=(currentModalImageIndex-1+allImages.length)%allImages.length,openModal(currentModalImageIndex)}async function initializeGrid(){try{const e=await fetch("/api/images");if(allImages=shuffleList(await e.json()),0===allImages.length)return void(loader.textContent="未找到任何图片。");loadMoreImages();new IntersectionObserver(e=>{e[0].isIntersecting&&loadMoreImages()},{rootMargin:"200px"}).observe(loader)}catch(e){console.error("无法初始化网格:",e),loader.textContent="加载图片列表失败。"}}grid.addEventListener("click",e=>{e.target.dataset.index&&openModal(e.target.dataset.index)}),closeBtn.addEventListener("click",closeModal),prevBtn.addEventListener("click",showPrevImage),nextBtn.addEventListener("click",showNextImage),document.addEventListener("keydown",e=>{"flex"===imageModal.style.display&&("Escape"===e.key?closeModal():"ArrowRight"===e.key?showNextImage():"ArrowLeft"===e.key&&showPrevImage())}),imageModal.addEventListener("click",e=>{if(e.target===imageModal)closeModal()}),document.addEventListener("DOMContentLoaded",initializeGrid);{% endraw %}</script></body></html>
 """
 
 VIDEO_GRID_HTML=r"""<!DOCTYPE html><html lang="zh-CN"><head><title>视频/GIF 网格</title><style>{% raw %}body{margin:0;background-color:#222;font-family:sans-serif}.header{position:sticky;top:0;background-color:rgba(20,20,20,.95);padding:15px;text-align:right;z-index:100}.header a{color:#fff;text-decoration:none;padding:8px 15px;background-color:rgba(0,0,0,.5);border-radius:5px;margin-left:10px}#grid-container{display:grid;grid-template-columns:repeat(auto-fill,minmax(320px,1fr));gap:10px;padding:10px}.grid-item{position:relative;border-radius:8px;cursor:pointer;background-color:#333;aspect-ratio:9/16;overflow:hidden}.grid-item img,.grid-item video{width:100%;height:100%;display:block;object-fit:cover;opacity:0;transition:opacity .5s}.grid-item img.loaded,.grid-item video.loaded{opacity:1}.skeleton{position:absolute;top:0;left:0;width:100%;height:100%;background:linear-gradient(90deg,#333 25%,#444 50%,#333 75%);background-size:200% 100%;animation:shimmer 1.5s infinite}@keyframes shimmer{0%{background-position:200% 0}100%{background-position:-200% 0}}#loader{text-align:center;padding:20px;color:#888}.modal{display:none;position:fixed;z-index:1000;left:0;top:0;width:100%;height:100%;overflow:hidden;background-color:rgba(0,0,0,.9)}.modal-content-container{width:100%;height:100%;display:flex;justify-content:center;align-items:center}.modal-content-container img,.modal-content-container video{max-width:95vw;max-height:95vh;object-fit:contain}.modal-close{position:absolute;top:15px;right:35px;color:#f1f1f1;font-size:40px;font-weight:700;cursor:pointer}.modal-nav{position:absolute;top:50%;transform:translateY(-50%);font-size:50px;color:#fff;padding:16px;cursor:pointer;user-select:none;z-index:1001}.modal-prev{left:10px}.modal-next{right:10px}
 .modal-folder-btn{position:absolute;bottom:30px;left:50%;transform:translateX(-50%);background:rgba(0,0,0,0.6);border:1px solid #fff;color:#fff;padding:8px 16px;border-radius:4px;text-decoration:none;font-size:14px;z-index:1002;transition:background .2s}.modal-folder-btn:hover{background:rgba(255,255,255,0.2)}
 {% endraw %}</style></head><body><div class="header"><a href="/search">搜索</a><a href="/">随机</a><a href="/slideshow">幻灯片</a><a href="/grid">图片网格</a><a href="/tags">角色</a><a href="/rescan">扫描</a></div><div id="grid-container"></div><div id="loader">正在加载...</div><div id="mediaModal" class="modal"><span class="modal-close">&times;</span>
 <a id="modalFolderBtn" class="modal-folder-btn" target="_blank">查看所属图集</a>
-<span class="modal-nav modal-prev">&#10094;</span><div class="modal-content-container" id="modalMediaContainer"></div><span class="modal-nav modal-next">&#10095;</span></div><script>{% raw %}const grid=document.getElementById("grid-container"),loader=document.getElementById("loader"),mediaModal=document.getElementById("mediaModal"),modalMediaContainer=document.getElementById("modalMediaContainer"),modFolderBtn=document.getElementById("modalFolderBtn");let allMedia=[],currentIndex=0,currentModalIndex=-1;const BATCH_SIZE=20;function createMediaElement(e,t){const a=e.toLowerCase().endsWith(".gif");let l;if(a)l=document.createElement("img");else{l=document.createElement("video"),l.loop=!0,l.playsinline=!0,t?(l.autoplay=!0,l.muted=!0):(l.autoplay=!0,l.controls=!0,l.muted=!0)}return l.src=`/media/${e}`,l}function loadMoreMedia(){if(currentIndex>=allMedia.length){loader.textContent="已加载全部";return}const e=allMedia.slice(currentIndex,currentIndex+BATCH_SIZE);for(const[t,a]of e.entries()){const e=document.createElement("div");e.className="grid-item";const n=document.createElement("div");n.className="skeleton",e.appendChild(n);const d=currentIndex+t;e.dataset.index=d;const i=createMediaElement(a,!0);e.appendChild(i);const o=i.tagName.toLowerCase();"video"===o?i.onloadeddata=()=>{e.contains(n)&&e.removeChild(n),i.classList.add("loaded")}:i.onload=()=>{e.contains(n)&&e.removeChild(n),i.classList.add("loaded")},grid.appendChild(e)}currentIndex+=BATCH_SIZE}function openModal(e){currentModalIndex=parseInt(e);const t=allMedia[currentModalIndex];modalMediaContainer.innerHTML="";const a=createMediaElement(t,!1);modalMediaContainer.appendChild(a),mediaModal.style.display="block",document.body.style.overflow="hidden";
+<span class="modal-nav modal-prev">&#10094;</span><div class="modal-content-container" id="modalMediaContainer"></div><span class="modal-nav modal-next">&#10095;</span></div><script>{% raw %}function shuffleList(a){for(let i=a.length-1;i>0;i--){const j=Math.floor(Math.random()*(i+1));[a[i],a[j]]=[a[j],a[i]]}return a}const grid=document.getElementById("grid-container"),loader=document.getElementById("loader"),mediaModal=document.getElementById("mediaModal"),modalMediaContainer=document.getElementById("modalMediaContainer"),modFolderBtn=document.getElementById("modalFolderBtn");let allMedia=[],currentIndex=0,currentModalIndex=-1;const BATCH_SIZE=20;function createMediaElement(e,t){const a=e.toLowerCase().endsWith(".gif");let l;if(a)l=document.createElement("img");else{l=document.createElement("video"),l.loop=!0,l.playsinline=!0,t?(l.autoplay=!0,l.muted=!0):(l.autoplay=!0,l.controls=!0,l.muted=!0)}return l.src=`/media/${e}`,l}function loadMoreMedia(){if(currentIndex>=allMedia.length){loader.textContent="已加载全部";return}const e=allMedia.slice(currentIndex,currentIndex+BATCH_SIZE);for(const[t,a]of e.entries()){const e=document.createElement("div");e.className="grid-item";const n=document.createElement("div");n.className="skeleton",e.appendChild(n);const d=currentIndex+t;e.dataset.index=d;const i=createMediaElement(a,!0);e.appendChild(i);const o=i.tagName.toLowerCase();"video"===o?i.onloadeddata=()=>{e.contains(n)&&e.removeChild(n),i.classList.add("loaded")}:i.onload=()=>{e.contains(n)&&e.removeChild(n),i.classList.add("loaded")},grid.appendChild(e)}currentIndex+=BATCH_SIZE}function openModal(e){currentModalIndex=parseInt(e);const t=allMedia[currentModalIndex];modalMediaContainer.innerHTML="";const a=createMediaElement(t,!1);modalMediaContainer.appendChild(a),mediaModal.style.display="block",document.body.style.overflow="hidden";
 const normalizedPath = t.replace(/\\/g, '/');
 const lastSlash=normalizedPath.lastIndexOf('/');if(lastSlash>-1){let f=normalizedPath.substring(0,lastSlash);if(f.startsWith('/'))f=f.substring(1);modFolderBtn.href=`/folder/${encodeURIComponent(f)}`;modFolderBtn.style.display="block"}else{modFolderBtn.style.display="none"}
-}function closeModal(){mediaModal.style.display="none",modalMediaContainer.innerHTML="",document.body.style.overflow=""}function showAdjacentMedia(e){if(-1===currentModalIndex)return;currentModalIndex=(currentModalIndex+e+allMedia.length)%allMedia.length,openModal(currentModalIndex)}async function initializeGrid(){try{const e=await fetch("/api/videos");if(allMedia=await e.json(),0===allMedia.length)return void(loader.textContent="未找到任何视频或GIF。");loadMoreMedia();new IntersectionObserver(e=>{e[0].isIntersecting&&loadMoreMedia()},{rootMargin:"400px"}).observe(loader)}catch(e){console.error("无法初始化网格:",e),loader.textContent="加载列表失败。"}}grid.addEventListener("click",e=>{const t=e.target.closest(".grid-item");t&&t.dataset.index&&openModal(t.dataset.index)}),document.querySelector(".modal-close").addEventListener("click",closeModal),document.querySelector(".modal-prev").addEventListener("click",()=>showAdjacentMedia(-1)),document.querySelector(".modal-next").addEventListener("click",()=>showAdjacentMedia(1)),document.addEventListener("keydown",e=>{"block"===mediaModal.style.display&&("Escape"===e.key?closeModal():"ArrowRight"===e.key?showAdjacentMedia(1):"ArrowLeft"===e.key&&showAdjacentMedia(-1))}),mediaModal.addEventListener("click",e=>{if(e.target===mediaModal||e.target===modalMediaContainer)closeModal()}),document.addEventListener("DOMContentLoaded",initializeGrid);{% endraw %}</script></body></html>"""
+}function closeModal(){mediaModal.style.display="none",modalMediaContainer.innerHTML="",document.body.style.overflow=""}function showAdjacentMedia(e){if(-1===currentModalIndex)return;currentModalIndex=(currentModalIndex+e+allMedia.length)%allMedia.length,openModal(currentModalIndex)}async function initializeGrid(){try{const e=await fetch("/api/videos");if(allMedia=shuffleList(await e.json()),0===allMedia.length)return void(loader.textContent="未找到任何视频或GIF。");loadMoreMedia();new IntersectionObserver(e=>{e[0].isIntersecting&&loadMoreMedia()},{rootMargin:"400px"}).observe(loader)}catch(e){console.error("无法初始化网格:",e),loader.textContent="加载列表失败。"}}grid.addEventListener("click",e=>{const t=e.target.closest(".grid-item");t&&t.dataset.index&&openModal(t.dataset.index)}),document.querySelector(".modal-close").addEventListener("click",closeModal),document.querySelector(".modal-prev").addEventListener("click",()=>showAdjacentMedia(-1)),document.querySelector(".modal-next").addEventListener("click",()=>showAdjacentMedia(1)),document.addEventListener("keydown",e=>{"block"===mediaModal.style.display&&("Escape"===e.key?closeModal():"ArrowRight"===e.key?showAdjacentMedia(1):"ArrowLeft"===e.key&&showAdjacentMedia(-1))}),mediaModal.addEventListener("click",e=>{if(e.target===mediaModal||e.target===modalMediaContainer)closeModal()}),document.addEventListener("DOMContentLoaded",initializeGrid);{% endraw %}</script></body></html>"""
 TAGS_INDEX_HTML=r"""<!DOCTYPE html><html lang="zh-CN"><head><meta charset="UTF-8"><title>角色标签</title><style>{% raw %}body{margin:0;background-color:#222;font-family:sans-serif}.header{position:sticky;top:0;background-color:rgba(20,20,20,.95);padding:15px;z-index:100;display:flex;align-items:center;gap:15px}.header .nav{margin-left:auto}.header a{color:#fff;text-decoration:none;padding:8px 15px;background-color:rgba(0,0,0,.5);border-radius:5px;margin-left:10px}#search-box{padding:8px 12px;font-size:1em;border-radius:5px;border:1px solid #555;background-color:#333;color:#fff;width:250px}#grid-container{display:grid;grid-template-columns:repeat(auto-fill,minmax(280px,1fr));gap:15px;padding:15px}.character-card{display:block;position:relative;border-radius:8px;overflow:hidden;aspect-ratio:3/4;background-size:cover;background-position:center;text-decoration:none;color:#fff;transition:transform .2s ease-out;background-color:#333}.character-card:hover{transform:scale(1.03)}.character-card::after{content:'';position:absolute;top:0;left:0;width:100%;height:100%;background:linear-gradient(to top,rgba(0,0,0,.8) 0%,rgba(0,0,0,0) 50%)}.character-name{position:absolute;bottom:10px;left:15px;font-size:1.2em;font-weight:700;z-index:1;text-shadow:1px 1px 3px rgba(0,0,0,.7)}#loader{text-align:center;padding:20px;color:#888}{% endraw %}</style></head><body><div class="header"><input type="search" id="search-box" placeholder="搜索角色..."><div class="nav"><a href="/search">搜索</a><a href="/">随机</a><a href="/slideshow">幻灯片</a><a href="/grid">图片网格</a><a href="/videos">视频/GIF</a><a href="/rescan">扫描</a></div></div><div id="grid-container"></div><div id="loader">正在加载角色列表...</div><script>{% raw %}
         const grid = document.getElementById('grid-container');
         const loader = document.getElementById('loader');
@@ -482,22 +869,87 @@ CHARACTER_GALLERY_HTML=r"""
         .modal-prev{left:0}.modal-next{right:0}
         .modal-folder-btn{position:absolute;bottom:30px;left:50%;transform:translateX(-50%);background:rgba(0,0,0,0.6);border:1px solid #fff;color:#fff;padding:8px 16px;border-radius:4px;text-decoration:none;font-size:14px;z-index:1002;transition:background .2s}.modal-folder-btn:hover{background:rgba(255,255,255,0.2)}
     {% endraw %}</style></head><body data-character-name="{{ character_name | urlencode }}"><div class="header"><span class="title">角色: {{ character_name.replace('_', ' ') }}</span><div class="nav"><a href="/search">搜索</a><a href="/">随机</a><a href="/grid">图片网格</a><a href="/tags">返回角色列表</a><a href="/rescan">重新扫描</a></div></div><div id="grid-container"></div><div id="loader">正在加载图片...</div><div id="imageModal" class="modal"><span class="modal-close">&times;</span>
-    <a id="modalFolderBtn" class="modal-folder-btn" target="_blank">查看所属图集</a>
+    <a id="modalFolderBtn" class="modal-folder-btn" target="_blank">查看所属图集</a><a id="modalSimilarBtn" class="modal-folder-btn" style="bottom:80px" target="_blank">相似图片</a>
     <span class="modal-nav modal-prev">&#10094;</span><img class="modal-content" id="modalImage"><span class="modal-nav modal-next">&#10095;</span></div><script>{% raw %}
-    document.addEventListener("DOMContentLoaded",()=>{const e=document.body.dataset.characterName;const grid=document.getElementById("grid-container"),loader=document.getElementById("loader"),imageModal=document.getElementById("imageModal"),modalImage=document.getElementById("modalImage"),closeBtn=document.querySelector(".modal-close"),prevBtn=document.querySelector(".modal-prev"),nextBtn=document.querySelector(".modal-next"),modFolderBtn=document.getElementById("modalFolderBtn");let allImages=[],currentModalImageIndex=-1;async function initialize(){try{const r=await fetch(`/api/character_images/${e}`);if(allImages=await r.json(),0===allImages.length)return void(loader.textContent="未找到该角色的任何图片。");loader.style.display="none";for(const[t,a]of allImages.entries()){const n=document.createElement("div");n.className="grid-item";const d=document.createElement("div");d.className="skeleton",n.appendChild(d);const i=document.createElement("img");n.dataset.index=t,i.dataset.index=t,i.onload=()=>{n.contains(d)&&n.removeChild(d),i.classList.add("loaded")},i.src=`/media/${a}`,n.appendChild(i),grid.appendChild(n)}}catch(r){console.error("无法加载图片:",r),loader.textContent="加载失败。"}}function openModal(e){currentModalImageIndex=parseInt(e);const path=allImages[currentModalImageIndex];modalImage.src=`/media/${path}`;imageModal.style.display="flex";document.body.style.overflow="hidden";
-    const normalizedPath = path.replace(/\\/g, '/');
+    document.addEventListener("DOMContentLoaded",()=>{const e=document.body.dataset.characterName;const grid=document.getElementById("grid-container"),loader=document.getElementById("loader"),imageModal=document.getElementById("imageModal"),modalImage=document.getElementById("modalImage"),closeBtn=document.querySelector(".modal-close"),prevBtn=document.querySelector(".modal-prev"),nextBtn=document.querySelector(".modal-next"),modFolderBtn=document.getElementById("modalFolderBtn");let allImages=[],currentModalImageIndex=-1,seed=null,after=null,done=!1,loading=!1;async function loadMoreImages(){if(loading||done)return;loading=!0;try{const q=new URLSearchParams({limit:60});null!==seed&&q.set("seed",seed),null!==after&&q.set("after",after);const r=await fetch(`/api/character_images/${e}?${q}`),p=await r.json();if(seed=p.seed,after=p.next,done=null===p.next,0===allImages.length&&0===p.images.length)return void(loader.textContent="未找到该角色的任何图片。");const base=allImages.length;allImages.push(...p.images);for(const[k,a]of p.images.entries()){const t=base+k,n=document.createElement("div");n.className="grid-item";const d=document.createElement("div");d.className="skeleton",n.appendChild(d);const i=document.createElement("img");n.dataset.index=t,i.dataset.index=t,i.onload=()=>{n.contains(d)&&n.removeChild(d),i.classList.add("loaded")},i.src=`/media/${a}`,n.appendChild(i),grid.appendChild(n)}done&&(loader.textContent="已加载全部")}catch(r){console.error("无法加载图片:",r),loader.textContent="加载失败。",done=!0}finally{loading=!1,!done&&loader.getBoundingClientRect().top<innerHeight+400&&loadMoreImages()}}function initialize(){new IntersectionObserver(x=>{x[0].isIntersecting&&loadMoreImages()},{rootMargin:"400px"}).observe(loader)}function openModal(e){currentModalImageIndex=parseInt(e);const path=allImages[currentModalImageIndex];modalImage.src=`/media/${path}`;imageModal.style.display="flex";document.body.style.overflow="hidden";
+    const normalizedPath = path.replace(/\\/g, '/');const simBtn=document.getElementById("modalSimilarBtn");simBtn.href=`/similar/${normalizedPath.replace(/^\//,'').split('/').map(encodeURIComponent).join('/')}`;
     const lastSlash=normalizedPath.lastIndexOf('/');if(lastSlash>-1){let f=normalizedPath.substring(0,lastSlash);if(f.startsWith('/'))f=f.substring(1);modFolderBtn.href=`/folder/${encodeURIComponent(f)}`;modFolderBtn.style.display="block"}else{modFolderBtn.style.display="none"}}function closeModal(){imageModal.style.display="none";document.body.style.overflow=""}function showNextImage(){if(allImages.length)currentModalImageIndex=(currentModalImageIndex+1)%allImages.length,openModal(currentModalImageIndex)}function showPrevImage(){if(allImages.length)currentModalImageIndex=(currentModalImageIndex-1+allImages.length)%allImages.length,openModal(currentModalImageIndex)}initialize();grid.addEventListener("click",e=>{e.target.dataset.index&&openModal(e.target.dataset.index)}),closeBtn.addEventListener("click",closeModal),prevBtn.addEventListener("click",showPrevImage),nextBtn.addEventListener("click",showNextImage),document.addEventListener("keydown",e=>{"flex"===imageModal.style.display&&("Escape"===e.key?closeModal():"ArrowRight"===e.key?showNextImage():"ArrowLeft"===e.key&&showPrevImage())}),imageModal.addEventListener("click",e=>{if(e.target===imageModal)closeModal()})});{% endraw %}</script></body></html>"""
 SEARCH_PAGE_HTML=r"""
-<!DOCTYPE html><html lang="zh-CN"><head><meta charset="UTF-8"><title>标签搜索</title><style>{% raw %}body{margin:0;background-color:#222;font-family:sans-serif}.header{position:sticky;top:0;background-color:rgba(20,20,20,.95);padding:10px 15px;z-index:100;display:flex;align-items:center;gap:15px}.header .search-form{display:flex;flex-grow:1}.header #search-box{flex-grow:1;padding:10px 15px;font-size:1.1em;border-radius:5px 0 0 5px;border:1px solid #555;background-color:#333;color:#fff;border-right:none}.header #search-button{padding:10px 20px;font-size:1.1em;border-radius:0 5px 5px 0;border:1px solid #555;background-color:#444;color:#fff;cursor:pointer}.header .nav{margin-left:auto;white-space:nowrap}.header .nav a{color:#fff;text-decoration:none;padding:8px 15px;background-color:rgba(0,0,0,.5);border-radius:5px;margin-left:10px}#grid-container{display:grid;grid-template-columns:repeat(auto-fill,minmax(250px,1fr));gap:10px;padding:10px}.grid-item{position:relative;border-radius:8px;cursor:pointer;background-color:#333;aspect-ratio:3/4;overflow:hidden}.grid-item img, .grid-item video{width:100%;height:100%;display:block;object-fit:cover;opacity:0;transition:opacity .5s}.grid-item img.loaded, .grid-item video.loaded{opacity:1}.skeleton{position:absolute;top:0;left:0;width:100%;height:100%;background:linear-gradient(90deg,#333 25%,#444 50%,#333 75%);background-size:200% 100%;animation:shimmer 1.5s infinite}@keyframes shimmer{0%{background-position:200% 0}100%{background-position:-200% 0}}#loader{text-align:center;padding:20px;color:#888}.modal{display:none;position:fixed;z-index:1000;left:0;top:0;width:100%;height:100%;overflow:hidden;background-color:rgba(0,0,0,.9);align-items:center;justify-content:center}.modal-content-container{width:100%;height:100%;display:flex;justify-content:center;align-items:center}.modal-content-container img,.modal-content-container video{max-width:95vw;max-height:95vh;object-fit:contain}.modal-close{position:absolute;top:20px;right:35px;color:#f1f1f1;font-size:40px;font-weight:700;cursor:pointer}.modal-nav{position:absolute;top:50%;transform:translateY(-50%);color:#f1f1f1;font-size:60px;font-weight:700;cursor:pointer;user-select:none;padding:16px}.modal-prev{left:0}.modal-next{right:0}
+<!DOCTYPE html><html lang="zh-CN"><head><meta charset="UTF-8"><title>标签搜索</title><style>{% raw %}body{margin:0;background-color:#222;font-family:sans-serif}.header{position:sticky;top:0;background-color:rgba(20,20,20,.95);padding:10px 15px;z-index:100;display:flex;align-items:center;gap:15px}.header .search-form{display:flex;flex-grow:1}.header #search-box{flex-grow:1;padding:10px 15px;font-size:1.1em;border-radius:5px 0 0 5px;border:1px solid #555;background-color:#333;color:#fff;border-right:none}.header #search-button{padding:10px 20px;font-size:1.1em;border-radius:0 5px 5px 0;border:1px solid #555;background-color:#444;color:#fff;cursor:pointer}.header .nav{margin-left:auto;white-space:nowrap}.header .nav a{color:#fff;text-decoration:none;padding:8px 15px;background-color:rgba(0,0,0,.5);border-radius:5px;margin-left:10px}#grid-container{display:grid;grid-template-columns:repeat(auto-fill,minmax(250px,1fr));gap:10px;padding:10px}#grid-container{align-items:start}.grid-item{position:relative;border-radius:8px;cursor:pointer;background-color:#333;aspect-ratio:3/4;overflow:hidden}.grid-item img, .grid-item video{width:100%;height:100%;display:block;object-fit:cover;opacity:0;transition:opacity .5s}.grid-item img.loaded, .grid-item video.loaded{opacity:1}.skeleton{position:absolute;top:0;left:0;width:100%;height:100%;background:linear-gradient(90deg,#333 25%,#444 50%,#333 75%);background-size:200% 100%;animation:shimmer 1.5s infinite}@keyframes shimmer{0%{background-position:200% 0}100%{background-position:-200% 0}}#loader{text-align:center;padding:20px;color:#888}.modal{display:none;position:fixed;z-index:1000;left:0;top:0;width:100%;height:100%;overflow:hidden;background-color:rgba(0,0,0,.9);align-items:center;justify-content:center}.modal-content-container{width:100%;height:100%;display:flex;justify-content:center;align-items:center}.modal-content-container img,.modal-content-container video{max-width:95vw;max-height:95vh;object-fit:contain}.modal-close{position:absolute;top:20px;right:35px;color:#f1f1f1;font-size:40px;font-weight:700;cursor:pointer}.modal-nav{position:absolute;top:50%;transform:translateY(-50%);color:#f1f1f1;font-size:60px;font-weight:700;cursor:pointer;user-select:none;padding:16px}.modal-prev{left:0}.modal-next{right:0}
 .modal-folder-btn{position:absolute;bottom:30px;left:50%;transform:translateX(-50%);background:rgba(0,0,0,0.6);border:1px solid #fff;color:#fff;padding:8px 16px;border-radius:4px;text-decoration:none;font-size:14px;z-index:1002;transition:background .2s}.modal-folder-btn:hover{background:rgba(255,255,255,0.2)}
-{% endraw %}</style></head><body data-query="{{ query }}" data-page-size="{{ PAGE_SIZE }}"><div class="header"><form class="search-form" id="search-form"><input type="search" id="search-box" placeholder="输入标签, 以空格分隔 (可用 rating: 和 char: 前缀)..." value="{{ query }}"><button type="submit" id="search-button">搜索</button></form><div class="nav"><a href="/">随机</a><a href="/tags">角色</a><a href="/grid">图网</a><a href="/videos">视频</a><a href="/rescan">扫描</a></div></div><div id="grid-container"></div><div id="loader">输入标签以开始搜索</div><div id="imageModal" class="modal"><span class="modal-close">&times;</span>
-<a id="modalFolderBtn" class="modal-folder-btn" target="_blank">查看所属图集</a>
+{% endraw %}</style></head><body data-query="{{ query }}" data-page-size="{{ PAGE_SIZE }}"><div class="header"><form class="search-form" id="search-form"><input type="search" id="search-box" list="tag-suggestions" autocomplete="off" placeholder="输入标签, 以空格分隔 (可用 rating: 和 char: 前缀)..." value="{{ query }}"><datalist id="tag-suggestions"></datalist><button type="submit" id="search-button">搜索</button></form><div class="nav"><a href="/">随机</a><a href="/tags">角色</a><a href="/grid">图网</a><a href="/videos">视频</a><a href="/rescan">扫描</a></div></div><div id="grid-container"></div><div id="loader">输入标签以开始搜索</div><div id="imageModal" class="modal"><span class="modal-close">&times;</span>
+<a id="modalFolderBtn" class="modal-folder-btn" target="_blank">查看所属图集</a><a id="modalSimilarBtn" class="modal-folder-btn" style="bottom:80px" target="_blank">相似图片</a>
 <span class="modal-nav modal-prev">&#10094;</span><div class="modal-content-container" id="modalMediaContainer"></div><span class="modal-nav modal-next">&#10095;</span></div><script>{% raw %}
-    document.addEventListener("DOMContentLoaded",()=>{const grid=document.getElementById("grid-container"),loader=document.getElementById("loader"),searchForm=document.getElementById("search-form"),searchBox=document.getElementById("search-box"),batchSize=parseInt(document.body.dataset.pageSize),mod=document.getElementById("imageModal"),mediaContainer=document.getElementById("modalMediaContainer"),closeBtn=document.querySelector(".modal-close"),prevBtn=document.querySelector(".modal-prev"),nextBtn=document.querySelector(".modal-next"),modFolderBtn=document.getElementById("modalFolderBtn");let allImages=[],currentPage=1,isLoading=!1,noMoreData=!1,currentQuery="",currIdx=-1;async function loadResults(){if(isLoading||noMoreData||!currentQuery)return;isLoading=!0;loader.textContent="正在加载...";try{const p=new URLSearchParams({q:currentQuery,page:currentPage,limit:batchSize});const r=await fetch(`/api/search?${p.toString()}`);const d=await r.json();if(0===d.length){noMoreData=!0;loader.textContent=0===allImages.length?"未找到匹配的图片。":"已加载全部结果";if(observer)observer.disconnect();return}const startIdx=allImages.length;allImages.push(...d);d.forEach((path,i)=>{const item=document.createElement("div");item.className="grid-item";const skel=document.createElement("div");skel.className="skeleton";item.appendChild(skel);const idx=startIdx+i;item.dataset.index=idx;const isVid=path.toLowerCase().match(/\.(mp4|webm|mov|mkv|avi)$/);let el;if(isVid){el=document.createElement("video");el.loop=!0;el.playsInline=!0;el.muted=!0;el.autoplay=!0}else{el=document.createElement("img")}el.dataset.index=idx;el.src=`/media/${path}`;const loadEv=isVid?"onloadeddata":"onload";el[loadEv]=()=>{if(item.contains(skel))item.removeChild(skel);el.classList.add("loaded")};item.appendChild(el);grid.appendChild(item)});currentPage++}catch(err){console.error("Error:",err);loader.textContent="加载失败。"}finally{isLoading=!1}}const observer=new IntersectionObserver(e=>{if(e[0].isIntersecting)loadResults()},{rootMargin:"400px"});function doSearch(q){q=q.trim();if(q===currentQuery&&allImages.length>0)return;currentQuery=q;history.pushState(null,"",`/search?q=${encodeURIComponent(q)}`);grid.innerHTML="";allImages=[];currentPage=1;isLoading=!1;noMoreData=!1;observer.disconnect();if(currentQuery){loadResults();observer.observe(loader)}else{loader.textContent="输入标签以开始搜索"}}function openMod(idx){currIdx=parseInt(idx);const path=allImages[currIdx];const isVideo=path.toLowerCase().match(/\.(mp4|webm|mov|mkv|avi)$/);mediaContainer.innerHTML='';let el;if(isVideo){el=document.createElement('video');el.src=`/media/${path}`;el.autoplay=!0;el.loop=!0;el.muted=!0;el.playsInline=!0;el.controls=!0}else{el=document.createElement('img');el.src=`/media/${path}`}mediaContainer.appendChild(el);mod.style.display="flex";document.body.style.overflow="hidden";
-    const normalizedPath = path.replace(/\\/g, '/');
+    const mediaSrc=a=>a.mtime?`/media/${a.path}?v=${a.mtime}`:`/media/${a.path}`;document.addEventListener("DOMContentLoaded",()=>{const grid=document.getElementById("grid-container"),loader=document.getElementById("loader"),searchForm=document.getElementById("search-form"),searchBox=document.getElementById("search-box"),batchSize=parseInt(document.body.dataset.pageSize),mod=document.getElementById("imageModal"),mediaContainer=document.getElementById("modalMediaContainer"),closeBtn=document.querySelector(".modal-close"),prevBtn=document.querySelector(".modal-prev"),nextBtn=document.querySelector(".modal-next"),modFolderBtn=document.getElementById("modalFolderBtn");let allImages=[],currentPage=1,isLoading=!1,noMoreData=!1,currentQuery="",currIdx=-1;async function loadResults(){if(isLoading||noMoreData||!currentQuery)return;isLoading=!0;loader.textContent="正在加载...";try{const p=new URLSearchParams({q:currentQuery,page:currentPage,limit:batchSize});const r=await fetch(`/api/search?${p.toString()}`);const d=await r.json();if(0===d.length){noMoreData=!0;loader.textContent=0===allImages.length?"未找到匹配的图片。":"已加载全部结果";if(observer)observer.disconnect();return}const startIdx=allImages.length;allImages.push(...d);d.forEach((rec,i)=>{const path=rec.path,item=document.createElement("div");item.className="grid-item";if(rec.width&&rec.height)item.style.aspectRatio=`${rec.width}/${rec.height}`;const skel=document.createElement("div");skel.className="skeleton";item.appendChild(skel);const idx=startIdx+i;item.dataset.index=idx;const isVid=path.toLowerCase().match(/\.(mp4|webm|mov|mkv|avi)$/);let el;if(isVid){el=document.createElement("video");el.loop=!0;el.playsInline=!0;el.muted=!0;el.autoplay=!0}else{el=document.createElement("img")}el.dataset.index=idx;el.src=mediaSrc(rec);const loadEv=isVid?"onloadeddata":"onload";el[loadEv]=()=>{if(item.contains(skel))item.removeChild(skel);el.classList.add("loaded")};item.appendChild(el);grid.appendChild(item)});currentPage++}catch(err){console.error("Error:",err);loader.textContent="加载失败。"}finally{isLoading=!1}}const observer=new IntersectionObserver(e=>{if(e[0].isIntersecting)loadResults()},{rootMargin:"400px"});function doSearch(q){q=q.trim();if(q===currentQuery&&allImages.length>0)return;currentQuery=q;history.pushState(null,"",`/search?q=${encodeURIComponent(q)}`);grid.innerHTML="";allImages=[];currentPage=1;isLoading=!1;noMoreData=!1;observer.disconnect();if(currentQuery){loadResults();observer.observe(loader)}else{loader.textContent="输入标签以开始搜索"}}function openMod(idx){currIdx=parseInt(idx);const path=allImages[currIdx].path;const isVideo=path.toLowerCase().match(/\.(mp4|webm|mov|mkv|avi)$/);mediaContainer.innerHTML='';let el;if(isVideo){el=document.createElement('video');el.src=`/media/${path}`;el.autoplay=!0;el.loop=!0;el.muted=!0;el.playsInline=!0;el.controls=!0}else{el=document.createElement('img');el.src=mediaSrc(allImages[currIdx])}mediaContainer.appendChild(el);mod.style.display="flex";document.body.style.overflow="hidden";
+    const normalizedPath = path.replace(/\\/g, '/');const simBtn=document.getElementById("modalSimilarBtn");simBtn.href=`/similar/${normalizedPath.replace(/^\//,'').split('/').map(encodeURIComponent).join('/')}`;
     const lastSlash=normalizedPath.lastIndexOf('/');if(lastSlash>-1){let f=normalizedPath.substring(0,lastSlash);if(f.startsWith('/'))f=f.substring(1);modFolderBtn.href=`/folder/${encodeURIComponent(f)}`;modFolderBtn.style.display="block"}else{modFolderBtn.style.display="none"}}function closeMod(){mod.style.display="none";document.body.style.overflow="";mediaContainer.innerHTML=''}function nextMod(){if(allImages.length){currIdx=(currIdx+1)%allImages.length;openMod(currIdx)}}function prevMod(){if(allImages.length){currIdx=(currIdx-1+allImages.length)%allImages.length;openMod(currIdx)}}searchForm.addEventListener("submit",e=>{e.preventDefault();doSearch(searchBox.value)});grid.addEventListener("click",e=>{const t=e.target.closest(".grid-item");if(t&&t.dataset.index)openMod(t.dataset.index)});closeBtn.addEventListener("click",closeMod);prevBtn.addEventListener("click",prevMod);nextBtn.addEventListener("click",nextMod);mod.addEventListener("click",e=>{if(e.target===mod||e.target===mediaContainer)closeMod()});document.addEventListener("keydown",e=>{if(mod.style.display==="flex"){if(e.key==="Escape")closeMod();else if(e.key==="ArrowRight")nextMod();else if(e.key==="ArrowLeft")prevMod()}});const initQ=document.body.dataset.query;if(initQ){searchBox.value=initQ;doSearch(initQ)}});
+{% endraw %}</script><script>{% raw %}
+    (()=>{const box=document.getElementById("search-box"),list=document.getElementById("tag-suggestions");let timer=null;
+    box.addEventListener("input",()=>{clearTimeout(timer);timer=setTimeout(async()=>{const v=box.value,sep=v.includes(",")?",":" ",cut=v.lastIndexOf(sep)+1,head=v.slice(0,cut),term=v.slice(cut).trim().replace(/^-/,"");
+    if(term.length<2){list.innerHTML="";return}try{const r=await fetch(`/api/tag_suggest?q=${encodeURIComponent(term)}`);const names=await r.json();const neg=v.slice(cut).trim().startsWith("-")?"-":"";
+    list.innerHTML="";for(const n of names){const o=document.createElement("option");o.value=head+(head&&sep===","?" ":"")+neg+n.replace(/ /g,"_");list.appendChild(o)}}catch(err){console.error("Error:",err)}},200)})})();
+{% endraw %}</script></body></html>"""
+
+SIMILAR_PAGE_HTML=r"""
+<!DOCTYPE html><html lang="zh-CN"><head><meta charset="UTF-8"><title>相似图片</title><style>{% raw %}
+    body{margin:0;background-color:#222;font-family:sans-serif}
+    .header{position:sticky;top:0;background-color:rgba(20,20,20,.95);padding:15px;z-index:100;display:flex;justify-content:flex-end;align-items:center}
+    .header .title{font-size:1.2em;color:#fff;margin-right:auto;padding-left:15px;word-break:break-all}
+    .header a{color:#fff;text-decoration:none;padding:8px 15px;background-color:rgba(0,0,0,.5);border-radius:5px;margin-left:10px}
+    #query-image{display:block;max-width:90vw;max-height:50vh;margin:20px auto;border-radius:8px}
+    #grid-container{display:grid;grid-template-columns:repeat(auto-fill,minmax(250px,1fr));gap:10px;padding:10px}
+    .grid-item{position:relative;border-radius:8px;background-color:#333;aspect-ratio:3/4;overflow:hidden;display:block}
+    .grid-item img{width:100%;height:100%;display:block;object-fit:cover}
+    .grid-item span{position:absolute;bottom:0;right:0;padding:4px 8px;background:rgba(0,0,0,.6);color:#fff;font-size:.85em}
+    #loader{text-align:center;padding:20px;color:#888}
+{% endraw %}</style></head><body data-filepath="{{ filepath }}"><div class="header"><span class="title">相似图片: {{ filepath }}</span><a href="/search">搜索</a><a href="/grid">网格</a><a href="/">随机</a></div>
+<img id="query-image"><div id="grid-container"></div><div id="loader">正在加载...</div>
+<script>{% raw %}
+    document.addEventListener("DOMContentLoaded",async()=>{
+        const path=document.body.dataset.filepath,grid=document.getElementById("grid-container"),loader=document.getElementById("loader");
+        const enc=p=>p.split('/').map(encodeURIComponent).join('/');
+        document.getElementById("query-image").src=`/media/${enc(path)}`;
+        try{
+            const r=await fetch(`/api/similar/${enc(path)}?limit=60`);const d=await r.json();
+            if(!r.ok)throw new Error(d.error||"加载失败");
+            if(d.length===0){loader.textContent="没有找到相似图片。";return}
+            for(const m of d){const a=document.createElement("a");a.className="grid-item";a.href=`/similar/${enc(m.path)}`;const img=document.createElement("img");img.loading="lazy";img.src=`/media/${enc(m.path)}`;const sc=document.createElement("span");sc.textContent=m.score.toFixed(3);a.appendChild(img);a.appendChild(sc);grid.appendChild(a)}
+            loader.textContent="";
+        }catch(err){console.error("Error:",err);loader.textContent=`加载失败: ${err.message}`}
+    });
 {% endraw %}</script></body></html>"""
 
 # --- 启动服务器 ---
+def run_production(host, port, workers):
+    """多进程部署: 优先 gunicorn (Linux), 其次 waitress (Windows, 单进程多线程)"""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        BaseApplication = None
+    if BaseApplication is not None:
+        class GunicornApp(BaseApplication):
+            def load_config(self):
+                for key, value in {"bind": f"{host}:{port}", "workers": workers}.items(): self.cfg.set(key, value)
+            def load(self): return app
+        GunicornApp().run(); return
+    try:
+        from waitress import serve
+    except ImportError:
+        print("Neither gunicorn nor waitress is installed; falling back to the threaded Flask server.")
+        app.run(host=host, port=port, threaded=True); return
+    serve(app, host=host, port=port, threads=max(4, workers * 4))
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Local media gallery server.")
+    parser.add_argument("--prod", action="store_true", help="Serve with gunicorn/waitress instead of the debug server.")
+    parser.add_argument("--host", type=str, default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=4, help="Worker processes in --prod mode.")
+    parser.add_argument("--slow-query-ms", type=float, default=SLOW_QUERY_MS, help=f"Log SQL statements slower than this to '{SLOW_QUERY_LOG}' with their query plan.")
+    parser.add_argument("--offload", choices=["x-accel", "x-sendfile"], default=MEDIA_OFFLOAD, help="Let a front proxy send media files (nginx X-Accel-Redirect or X-Sendfile).")
+    args = parser.parse_args()
+    MEDIA_OFFLOAD, SLOW_QUERY_MS = args.offload, args.slow_query_ms
+    # 上次运行留下的快照属于已退出的进程, 计数从这次启动重新开始
+    metrics_export.clear_snapshots(METRICS_DIR)
+    if args.prod: run_production(args.host, args.port, args.workers)
+    else: app.run(host=args.host, port=args.port, debug=True)
\ No newline at end of file
@@ -0,0 +1,184 @@
+# media_index.py (多进程共享的只读媒体索引, 基于内存映射的紧凑二进制文件)
+import mmap
+import os
+import struct
+from collections.abc import Sequence
+from typing import NamedTuple
+import numpy as np
+
+# --- 文件布局 ---
+# <base>.current      : 当前代数 (文本), 通过 os.replace 原子更新
+# <base>.<gen>.bin    : 某一代的索引, 写完后不再修改, 各进程只读映射
+#   header      : magic, version, generation, 文件数, 目录数, 图片数, 视频数, 目录 blob 长度, 文件名 blob 长度
+#   dir_offsets : uint64[n_dirs + 1]   目录名在目录 blob 中的起止位置 (目录名只存一次)
+#   dir_starts  : uint64[n_dirs + 1]   每个目录的文件在条目数组中的起止行 (同目录文件连续存放)
+#   name_offsets: uint64[n_files + 1]  文件名在文件名 blob 中的起止位置
+#   file_dirs   : uint32[n_files]      每个文件所属目录
+#   kinds       : uint8[n_files]       KIND_IMAGE / KIND_VIDEO / KIND_GIF
+#   widths, heights, frames : uint32[n_files]  图片尺寸和 GIF 帧数, 0 表示未知 (视频或无法解析)
+#   sizes       : uint64[n_files]      文件字节数
+#   mtimes      : int64[n_files]       修改时间 (毫秒)
+#   image_rows  : uint32[n_images]     图片所在行, 用于 O(1) 随机抽取
+#   video_rows  : uint32[n_videos]     视频和 GIF 所在行
+#   dir blob, name blob (UTF-8)
+MAGIC, VERSION = b"MIDX", 3
+_HEADER = struct.Struct("<4sIQQQQQQQ")
+KIND_IMAGE, KIND_VIDEO, KIND_GIF = 0, 1, 2
+
+class MediaInfo(NamedTuple):
+    width: int
+    height: int
+    frames: int  # 静态图为 1, 视频为 0
+    size: int
+    mtime: int  # 毫秒, 与 /media/ 链接上的 ?v= 版本号一致
+
+UNKNOWN_INFO = MediaInfo(0, 0, 0, 0, 0)
+
+class MediaList(Sequence):
+    """索引中一组行的只读视图, 取元素时才拼接出路径字符串"""
+
+    def __init__(self, index, rows):
+        self._index, self._rows = index, rows  # rows 为 range 或 numpy 行号数组
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._index.path_at(int(row)) for row in self._rows[i]]
+        return self._index.path_at(int(self._rows[i]))
+
+    def __iter__(self):
+        path_at = self._index.path_at
+        for row in self._rows: yield path_at(int(row))
+
+    def info(self, i):
+        """第 i 个元素的 MediaInfo; i 为切片时返回列表"""
+        if isinstance(i, slice): return self._index.infos(np.asarray(self._rows[i], dtype=np.int64))
+        return self._index.info(int(self._rows[i]))
+
+class MediaIndex:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.generation, n_files, n_dirs, n_images, n_videos, dirs_len, names_len = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION: raise ValueError(f"'{path}' is not a media index (version {VERSION}).")
+        pos = _HEADER.size
+        def section(dtype, count):
+            nonlocal pos
+            array = np.frombuffer(self._mm, dtype=dtype, count=count, offset=pos)
+            pos += array.nbytes
+            return array
+        dir_offsets, self._dir_starts = section(np.uint64, n_dirs + 1), section(np.uint64, n_dirs + 1)
+        self._name_offsets, self._file_dirs = section(np.uint64, n_files + 1), section(np.uint32, n_files)
+        self.kinds = section(np.uint8, n_files)
+        self._widths, self._heights, self._frames = section(np.uint32, n_files), section(np.uint32, n_files), section(np.uint32, n_files)
+        self._sizes, self._mtimes = section(np.uint64, n_files), section(np.int64, n_files)
+        image_rows, video_rows = section(np.uint32, n_images), section(np.uint32, n_videos)
+        dirs_blob = self._mm[pos:pos + dirs_len].decode('utf-8')
+        self._names_start = pos + dirs_len
+        # 目录表规模很小, 解码成 str 常驻内存; 文件名留在映射里按需解码
+        self._dirs = [dirs_blob[int(dir_offsets[d]):int(dir_offsets[d + 1])] for d in range(n_dirs)]
+        self._dir_ids = {name: d for d, name in enumerate(self._dirs)}
+        self.images, self.videos = MediaList(self, image_rows), MediaList(self, video_rows)
+        self.all = MediaList(self, range(n_files))
+
+    def path_at(self, row: int) -> str:
+        start, stop = self._names_start + int(self._name_offsets[row]), self._names_start + int(self._name_offsets[row + 1])
+        directory, name = self._dirs[self._file_dirs[row]], self._mm[start:stop].decode('utf-8')
+        return f"{directory}/{name}" if directory else name
+
+    def info(self, row: int) -> MediaInfo:
+        return MediaInfo(int(self._widths[row]), int(self._heights[row]), int(self._frames[row]), int(self._sizes[row]), int(self._mtimes[row]))
+
+    def infos(self, rows) -> list[MediaInfo]:
+        """批量取 MediaInfo, 一次 numpy 索引代替逐行读取"""
+        columns = (self._widths[rows], self._heights[rows], self._frames[rows], self._sizes[rows], self._mtimes[rows])
+        return list(map(MediaInfo._make, zip(*(column.tolist() for column in columns))))
+
+    def info_map(self) -> dict[str, MediaInfo]:
+        """路径 -> MediaInfo, 重新扫描时用来复用未变化文件的元数据"""
+        return dict(zip(self.all, self.infos(np.arange(len(self.all)))))
+
+    def folder(self, directory: str) -> MediaList:
+        """某个目录下的所有媒体 (不含子目录), 已按构建时的排序键排好"""
+        d = self._dir_ids.get(directory.strip('/'))
+        if d is None: return MediaList(self, range(0))
+        return MediaList(self, range(int(self._dir_starts[d]), int(self._dir_starts[d + 1])))
+
+    @property
+    def directories(self) -> list[str]:
+        return self._dirs
+
+def _pointer_path(base: str) -> str: return base + ".current"
+def _data_path(base: str, generation: int) -> str: return f"{base}.{generation}.bin"
+
+def read_generation(base: str) -> int:
+    try:
+        with open(_pointer_path(base), 'r', encoding='utf-8') as f: return int(f.read().strip())
+    except (OSError, ValueError): return 0
+
+def _offsets(encoded) -> np.ndarray:
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    np.cumsum([len(p) for p in encoded], out=offsets[1:])
+    return offsets
+
+def publish_media_index(base: str, images, videos, sort_key=None, infos=None) -> int:
+    """写出新一代索引并切换指针, 返回新的代数; 已打开旧索引的进程不受影响
+    sort_key 决定同一目录内文件的顺序 (作用于完整相对路径), infos 为路径 -> MediaInfo, 缺失的记为未知"""
+    generation = read_generation(base) + 1
+    entries = [(p, KIND_IMAGE) for p in images] + [(p, KIND_GIF if p.lower().endswith('.gif') else KIND_VIDEO) for p in videos]
+    entries = [(*p.rpartition('/')[::2], p, kind) for p, kind in entries]
+    entries.sort(key=(lambda e: (e[0], sort_key(e[2]))) if sort_key else (lambda e: (e[0], e[1])))
+
+    dirs = list(dict.fromkeys(e[0] for e in entries))
+    dir_ids = {name: d for d, name in enumerate(dirs)}
+    file_dirs = np.array([dir_ids[e[0]] for e in entries], dtype=np.uint32)
+    kinds = np.array([e[3] for e in entries], dtype=np.uint8)
+    infos = infos or {}
+    info_rows = [infos.get(e[2], UNKNOWN_INFO) for e in entries]
+    info_columns = [np.array(column, dtype=dtype) for column, dtype in zip(zip(*info_rows) if info_rows else ((),) * 5, (np.uint32, np.uint32, np.uint32, np.uint64, np.int64))]
+    dir_starts = np.searchsorted(file_dirs, np.arange(len(dirs) + 1)).astype(np.uint64)
+    encoded_dirs, encoded_names = [d.encode('utf-8') for d in dirs], [e[1].encode('utf-8') for e in entries]
+    dirs_blob, names_blob = b"".join(encoded_dirs), b"".join(encoded_names)
+    image_rows = np.flatnonzero(kinds == KIND_IMAGE).astype(np.uint32)
+    video_rows = np.flatnonzero(kinds != KIND_IMAGE).astype(np.uint32)
+
+    tmp_path = _data_path(base, generation) + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, generation, len(entries), len(dirs), len(image_rows), len(video_rows), len(dirs_blob), len(names_blob)))
+        for array in (_offsets(encoded_dirs), dir_starts, _offsets(encoded_names), file_dirs, kinds, *info_columns, image_rows, video_rows): f.write(array.tobytes())
+        f.write(dirs_blob); f.write(names_blob)
+    os.replace(tmp_path, _data_path(base, generation))
+    with open(_pointer_path(base) + ".tmp", 'w', encoding='utf-8') as f: f.write(str(generation))
+    os.replace(_pointer_path(base) + ".tmp", _pointer_path(base))
+    # 清理更早的代; 其他进程仍映射着的文件在 Windows 上删不掉, 留到下次
+    for old in range(max(1, generation - 10), generation - 1):
+        try: os.remove(_data_path(base, old))
+        except OSError: pass
+    return generation
+
+class SharedMediaIndex:
+    """每次访问时检查指针文件, 发现新一代就重新映射, 让所有 worker 原子地切换到同一份索引
+    on_switch(generation) 在切换到新一代后调用, 供调用方清除按旧代数缓存的数据"""
+
+    def __init__(self, base: str, on_switch=None):
+        self.base, self.on_switch, self._index, self._pointer_stat = base, on_switch, None, None
+
+    def exists(self) -> bool:
+        return read_generation(self.base) > 0
+
+    def get(self) -> MediaIndex | None:
+        try: st = os.stat(_pointer_path(self.base))
+        except OSError: return self._index
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if stamp != self._pointer_stat:
+            generation = read_generation(self.base)
+            # 旧映射不主动关闭, 其他线程可能正在读取, 失去引用后自动释放
+            if self._index is None or self._index.generation != generation:
+                try: self._index = MediaIndex(_data_path(self.base, generation))
+                except ValueError: return self._index  # 旧版本格式, 交给调用方重建
+                if self.on_switch is not None: self.on_switch(generation)
+            self._pointer_stat = stamp
+        return self._index
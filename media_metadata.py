@@ -0,0 +1,58 @@
+# media_metadata.py (只读文件头的元数据提取: 尺寸, GIF 帧数, 文件大小, 修改时间)
+import os
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from media_index import MediaInfo, UNKNOWN_INFO
+from media_scanner import IMAGE_EXTS
+
+PROBE_WORKERS = 16  # 读文件头以 I/O 等待为主, 线程数与扫描器相同
+PROBE_EXTS = IMAGE_EXTS + ('.gif',)  # 视频只记录大小和修改时间
+
+def probe_file(abs_path: str, stat=None) -> MediaInfo:
+    """Image.open 是惰性的, 只解析文件头, 不解码像素; stat 为扫描时已取得的结果时不再重复 stat"""
+    try: stat = stat or os.stat(abs_path)
+    except OSError: return UNKNOWN_INFO
+    width = height = frames = 0
+    if abs_path.lower().endswith(PROBE_EXTS):
+        try:
+            with Image.open(abs_path) as img:
+                width, height = img.size
+                # GIF 的 n_frames 需要跳读每一帧的块头, 但仍不解码像素
+                frames = getattr(img, "n_frames", 1) if img.format == "GIF" else 1
+        except Exception: pass
+    return MediaInfo(width, height, frames, stat.st_size, stat.st_mtime_ns // 1_000_000)
+
+def cached_prober(previous=None):
+    """返回给 scan_tree(probe=...) 用的函数: 大小和修改时间都没变的文件直接沿用 previous 中的结果"""
+    previous = previous or {}
+    def probe(abs_path, rel_path, stat):
+        old = previous.get(rel_path)
+        if old is not None and old.size == stat.st_size and old.mtime == stat.st_mtime_ns // 1_000_000: return old
+        return probe_file(abs_path, stat)
+    return probe
+
+def probe_files(root: str, entries, previous=None, workers: int = PROBE_WORKERS) -> dict[str, MediaInfo]:
+    """并行提取 entries ((相对路径, stat 或 None) 序列) 的元数据, 返回 路径 -> MediaInfo
+    previous 为上一次的结果, 大小和修改时间都没变的文件直接复用, 不再打开"""
+    previous, infos, todo = previous or {}, {}, []
+    for path, stat in entries:
+        old = previous.get(path)
+        if old is not None and stat is not None and old.size == stat.st_size and old.mtime == stat.st_mtime_ns // 1_000_000: infos[path] = old
+        else: todo.append((path, stat))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for (path, _), info in zip(todo, executor.map(lambda item: probe_file(os.path.join(root, item[0]), item[1]), todo)): infos[path] = info
+    return infos
+
+def store_db_metadata(conn, infos: dict[str, MediaInfo]) -> int:
+    """把元数据写进 images 表 (只更新修改时间变化或尚未填写的行), 返回更新的行数"""
+    before = conn.total_changes
+    conn.executemany("UPDATE images SET width = ?, height = ?, file_size = ?, mtime = ? WHERE filepath = ? AND (mtime IS NULL OR mtime != ?)",
+                     ((info.width or None, info.height or None, info.size, info.mtime, path, info.mtime) for path, info in infos.items() if info.mtime))
+    conn.commit()
+    return conn.total_changes - before
+
+def fill_missing_db_metadata(conn, root: str, workers: int = PROBE_WORKERS) -> int:
+    """为还没有元数据的图片补一遍 (索引器的 metadata 子命令, 以及 index 结束时调用)"""
+    paths = [row[0] for row in conn.execute("SELECT filepath FROM images WHERE mtime IS NULL")]
+    if not paths: return 0
+    return store_db_metadata(conn, probe_files(root, ((path, None) for path in paths), workers=workers))
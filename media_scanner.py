@@ -0,0 +1,66 @@
+# media_scanner.py (main.py 与两个打标脚本共用的并行目录扫描器)
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+VIDEO_EXTS = ('.mp4', '.webm', '.mov', '.mkv', '.avi', '.gif')
+SCAN_WORKERS = 16  # 扫描受 I/O 延迟限制 (尤其是网络共享), 线程数可以远多于 CPU 核数
+PROBE_CHUNK = 256  # 带 probe 扫描时, 同一目录的文件按这个数量拆成多个任务
+
+class ScanEntry(NamedTuple):
+    path: str  # 相对扫描根目录的 '/' 分隔路径
+    stat: os.stat_result | None  # with_stat=True 时为 DirEntry.stat() 的结果 (Windows 上随目录列表一起返回, 无额外开销)
+    info: object = None  # probe(绝对路径, 相对路径, stat) 的返回值
+
+def scan_tree(root: str, extensions: tuple[str, ...], exclude_dirs=(), with_stat: bool = False, probe=None, workers: int = SCAN_WORKERS):
+    """并行扫描 root 下扩展名匹配的文件, 以生成器形式边扫边产出 ScanEntry (顺序不固定)
+    每个目录是线程池里的一个任务, 子目录在发现时继续提交, 因此大子树也会被拆开并行
+    probe 在扫描线程里对每个文件调用 (隐含 with_stat), 用于顺带读取文件头等逐文件的 I/O; 大目录会拆块并行
+    与 os.walk 一致: 不进入指向目录的符号链接; exclude_dirs 中的目录名在任何层级都跳过"""
+    with_stat = with_stat or probe is not None
+    results, lock = queue.Queue(), threading.Lock()
+    pending = 1  # 已提交但结果尚未取走的目录数
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scan")
+
+    def probe_chunk(chunk):
+        entries = []
+        try:
+            for abs_path, entry in chunk: entries.append(entry._replace(info=probe(abs_path, entry.path, entry.stat)))
+        finally: results.put(entries)
+
+    def scan_dir(abs_dir: str, prefix: str):
+        nonlocal pending
+        entries, subdirs, tasks = [], [], []
+        try:
+            with os.scandir(abs_dir) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in exclude_dirs: subdirs.append((scan_dir, entry.path, prefix + entry.name + '/'))
+                        elif entry.name.lower().endswith(extensions):
+                            entries.append((entry.path, ScanEntry(prefix + entry.name, entry.stat() if with_stat else None)))
+                    except OSError: continue  # 扫描期间被删除或无权限的条目
+        except OSError: pass
+        finally:
+            if probe: tasks = [(probe_chunk, entries[i:i + PROBE_CHUNK]) for i in range(0, len(entries), PROBE_CHUNK)]; entries = []
+            tasks += subdirs
+            # 先登记新任务再交出结果, 消费方看到 "已取走数 == pending" 时就说明全部完成 (每个任务恰好交出一份结果)
+            with lock: pending += len(tasks)
+            for task in tasks:
+                try: executor.submit(*task)
+                except RuntimeError: results.put([])  # 消费方已提前结束, 执行器已关闭
+            results.put([entry for _, entry in entries])
+
+    executor.submit(scan_dir, root, '')
+    received = 0
+    try:
+        while True:
+            yield from results.get()
+            received += 1
+            with lock:
+                if received == pending: return
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,145 @@
+# metrics.py (进程内计数器 / 直方图, Prometheus 文本格式导出, 以及慢查询日志)
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SCAN_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# 多进程部署 (gunicorn) 时 Prometheus 只能抓到其中一个 worker, 因此各进程把自己的数据定期写成
+# <目录>/<pid>.json 快照, /metrics 把其他进程的快照与本进程的实时数据相加后输出
+# 计数只增不减; 服务启动时 clear_snapshots 清空目录, 相当于一次正常的计数器重置
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class Metric:
+    """counter 的每个序列是 [值]; histogram 是 [各桶计数..., +Inf 桶计数, 总和], 合并时逐项相加"""
+
+    def __init__(self, kind: str, name: str, help_text: str, labelnames=(), buckets=None):
+        self.kind, self.name, self.help, self.labelnames = kind, name, help_text, tuple(labelnames)
+        self.buckets = tuple(buckets) if kind == 'histogram' else ()
+        self.series, self._lock = {}, threading.Lock()
+
+    def _state(self, labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        state = self.series.get(key)
+        if state is None: state = self.series.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0] if self.kind == 'histogram' else [0.0])
+        return state
+
+    def inc(self, amount: float = 1.0, **labels):
+        with self._lock: self._state(labels)[0] += amount
+
+    def observe(self, value: float, **labels):
+        with self._lock:
+            state = self._state(labels)
+            state[bisect_left(self.buckets, value)] += 1; state[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try: yield
+        finally: self.observe(time.perf_counter() - start, **labels)
+
+    def render(self, series) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, state in sorted(series.items()):
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+            if self.kind == 'counter':
+                lines.append(f"{self.name}{{{','.join(labels)}}} {_format_number(state[0])}" if labels else f"{self.name} {_format_number(state[0])}")
+                continue
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{_format_number(float(bound))}"'
+                lines.append(f"{self.name}_bucket{{{','.join(labels + [le])}}} {cumulative}")
+            suffix = f"{{{','.join(labels)}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {_format_number(state[-1])}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics, self._last_flush = {}, 0.0
+        # fork 出的子进程 (gunicorn worker) 不继承父进程已记录的数据, 否则合并快照时会重复计算
+        if hasattr(os, 'register_at_fork'): os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        for metric in self.metrics.values(): metric.series = {}; metric._lock = threading.Lock()
+        self._last_flush = 0.0
+
+    def counter(self, name: str, help_text: str, labelnames=()) -> Metric:
+        return self.metrics.setdefault(name, Metric('counter', name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Metric:
+        return self.metrics.setdefault(name, Metric('histogram', name, help_text, labelnames, buckets))
+
+    def snapshot(self) -> dict:
+        snapshot = {}
+        for name, metric in self.metrics.items():
+            with metric._lock: snapshot[name] = [[list(key), list(state)] for key, state in metric.series.items()]
+        return snapshot
+
+    def flush(self, directory: str | None, interval: float = 0.0):
+        """把本进程的快照写到 <directory>/<pid>.json; interval 内已写过则跳过 (供每个请求结束时调用)"""
+        now = time.monotonic()
+        if not directory or now - self._last_flush < interval: return
+        self._last_flush = now
+        try:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{os.getpid()}.json")
+            with open(path + '.tmp', 'w', encoding='utf-8') as f: json.dump(self.snapshot(), f)
+            os.replace(path + '.tmp', path)
+        except OSError as e: print(f"Failed to write metrics snapshot: {e}")
+
+    def render(self, directory: str | None = None) -> str:
+        """本进程的数据加上 directory 中其他进程的快照, 按 Prometheus 文本格式输出"""
+        merged = {name: {key: list(state) for key, state in metric.series.copy().items()} for name, metric in self.metrics.items()}
+        for snapshot in _other_snapshots(directory):
+            for name, series in snapshot.items():
+                if name not in merged: continue
+                for key, state in series:
+                    current = merged[name].setdefault(tuple(key), [0] * len(state))
+                    if len(current) == len(state): merged[name][tuple(key)] = [a + b for a, b in zip(current, state)]
+        lines = []
+        for name, metric in self.metrics.items(): lines += metric.render(merged[name])
+        return "\n".join(lines) + "\n"
+
+def _other_snapshots(directory):
+    if not directory: return
+    own = f"{os.getpid()}.json"
+    try: names = [name for name in os.listdir(directory) if name.endswith('.json') and name != own]
+    except OSError: return
+    for name in names:
+        try:
+            with open(os.path.join(directory, name), 'r', encoding='utf-8') as f: yield json.load(f)
+        except (OSError, ValueError): continue
+
+def clear_snapshots(directory: str | None):
+    """删除之前运行留下的快照; 本进程自己的快照 (导入时启动的扫描可能已经写出) 保留"""
+    if not directory: return
+    try: names = os.listdir(directory)
+    except OSError: return
+    for name in names:
+        if name.endswith(('.json', '.tmp')) and not name.startswith(f"{os.getpid()}."):
+            try: os.remove(os.path.join(directory, name))
+            except OSError: pass
+
+_slow_log_lock = threading.Lock()
+def log_slow_query(path: str, conn, name: str, sql: str, params, seconds: float):
+    """把慢查询连同 EXPLAIN QUERY PLAN 作为一行 JSON 追加到 path"""
+    try: plan = [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+    except Exception as e: plan = [f"EXPLAIN failed: {e}"]
+    record = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "statement": name, "ms": round(seconds * 1000, 2),
+              "sql": " ".join(sql.split()), "params": [p if isinstance(p, (int, float, str)) or p is None else repr(p) for p in params], "plan": plan}
+    with _slow_log_lock:
+        try:
+            with open(path, 'a', encoding='utf-8') as f: f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e: print(f"Failed to write slow query log: {e}")
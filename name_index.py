@@ -0,0 +1,47 @@
+# name_index.py (角色名 / 标签名的 FTS5 trigram 子串索引)
+import sqlite3
+
+# name_fts 只保存去重后的名字 (kind 为 'char' 或 'tag'), 规模是名字数而不是图片数
+# trigram 分词让 LIKE '%term%' 也能走索引; 没有子串匹配时按 trigram 重合度做模糊匹配
+
+def init_name_index(conn) -> bool:
+    """建表, SQLite 不支持 FTS5 trigram (3.34 以下) 时返回 False"""
+    try:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS name_fts USING fts5(name, kind UNINDEXED, tokenize='trigram')")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+def has_name_index(conn) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'name_fts'").fetchone() is not None
+
+def load_indexed_names(conn) -> set[tuple[str, str]]:
+    return set(conn.execute("SELECT kind, name FROM name_fts").fetchall())
+
+def add_names(conn, kind: str, names, indexed: set):
+    """增量写入尚未索引的名字, indexed 为调用方维护的 (kind, name) 集合"""
+    new_names = [(name, kind) for name in dict.fromkeys(names) if name and (kind, name) not in indexed]
+    if not new_names: return
+    conn.executemany("INSERT INTO name_fts (name, kind) VALUES (?, ?)", new_names)
+    indexed.update((kind, name) for name, _ in new_names)
+
+def sync_name_index(conn):
+    """按 images / tags 表全量对齐 (补上缺失的名字, 删除已无图片的角色名)"""
+    if not init_name_index(conn): return
+    conn.execute("DELETE FROM name_fts WHERE kind = 'char' AND name NOT IN (SELECT DISTINCT character_name FROM images WHERE character_name IS NOT NULL)")
+    indexed = load_indexed_names(conn)
+    add_names(conn, 'char', (row[0] for row in conn.execute("SELECT DISTINCT character_name FROM images WHERE character_name IS NOT NULL")), indexed)
+    add_names(conn, 'tag', (row[0] for row in conn.execute("SELECT name FROM tags")), indexed)
+    conn.commit()
+
+def search_names(conn, term: str, kind: str, limit: int = 200) -> list[str]:
+    """子串匹配, 没有结果时退回 trigram 模糊匹配"""
+    # LIKE 中的 '_' 匹配任意单个字符, 空格和下划线两种写法由同一个模式覆盖
+    pattern = "%" + term.replace("%", "").replace(" ", "_") + "%"
+    rows = conn.execute("SELECT name FROM name_fts WHERE name LIKE ? AND kind = ? ORDER BY length(name), name LIMIT ?", (pattern, kind, limit)).fetchall()
+    if rows or len(term) < 3: return [row[0] for row in rows]
+    normalized = term.replace("_", " ").lower()
+    trigrams = dict.fromkeys(normalized[i:i + 3] for i in range(len(normalized) - 2))
+    match = " OR ".join('"' + t.replace('"', '""') + '"' for t in trigrams)
+    rows = conn.execute("SELECT name FROM name_fts WHERE name_fts MATCH ? AND kind = ? ORDER BY rank LIMIT ?", (f"name : ({match})", kind, limit)).fetchall()
+    return [row[0] for row in rows]
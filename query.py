@@ -0,0 +1,104 @@
+# query.py (search.py / main.py / wd-eva-02-test.py 共用的标签查询编译器)
+import re
+from functools import lru_cache
+
+# --- 查询语法 ---
+# 有逗号时按逗号分隔, 否则按空白分隔; 标签中的下划线和空格等价
+#   1girl, blue_eyes      同时包含 (AND)
+#   -hat                  排除
+#   cat_ears|fox_ears     任意一个 (OR)
+#   blue_eyes>0.8         对单个标签限定置信度 (支持 > >= < <=)
+#   conf>0.5              对所有未单独限定的标签限定置信度
+#   rating:general        评级, 可写成 rating:general|sensitive, 也可加 - 排除
+#   char:hatsune_miku     角色, 同上
+#   orientation:portrait  方向 (portrait / landscape / square), 同上
+#   minres:1080           短边至少 1080; minres:1920x1080 表示宽和高分别至少这么大
+
+_BOUND_RE = re.compile(r"^(?P<name>.+?)\s*(?P<op>>=|<=|>|<)\s*(?P<value>\d*\.?\d+)$")
+_CONF_KEYS = ("conf", "confidence")
+_MINRES_RE = re.compile(r"^(\d+)(?:\s*[x*]\s*(\d+))?$")
+_ORIENTATIONS = {"portrait": "T0.height > T0.width", "landscape": "T0.width > T0.height", "square": "T0.width = T0.height"}
+
+def ensure_indexes(conn):
+    """查询依赖的索引: 按 tag_id 反查图片, 以及 rating / character_name 过滤; 由建库 / 迁移的代码调用, 只读的查询路径不调用"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_image_tags_tag ON image_tags (tag_id, image_id, confidence)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_character ON images (character_name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_rating ON images (rating)")
+    conn.commit()
+
+def _variants(name: str, prefix: str = "") -> list[str]:
+    """数据库里既有空格形式也有下划线形式 (两个打标脚本不一致), 两种都匹配"""
+    name = name.strip()
+    forms = [name, name.replace("_", " "), name.replace(" ", "_")]
+    if prefix: forms += [prefix + form for form in forms]
+    return list(dict.fromkeys(forms))
+
+def _split_terms(query_string: str) -> list[str]:
+    separator = "," if "," in query_string else None
+    return [term.strip() for term in query_string.split(separator) if term.strip()]
+
+def parse_query(query_string: str):
+    """返回 (tag_terms, rating_terms, char_terms, default_bounds, size_terms)
+    tag_terms 的元素为 (names, negate, bounds), rating / char 为 (names, negate), bounds 为 [(op, value)]
+    size_terms 为已编译好的 (sql 条件, params), 来自 orientation: 和 minres:"""
+    tag_terms, rating_terms, char_terms, default_bounds, size_terms = [], [], [], [], []
+    for term in _split_terms(query_string):
+        negate = term.startswith("-") and len(term) > 1
+        if negate: term = term[1:].strip()
+        key, _, value = term.partition(":")
+        key = key.strip().lower()
+        if value and key == "rating":
+            names = [n for alt in value.split("|") if alt.strip() for n in _variants(alt, "rating:")]
+            if names: rating_terms.append((names, negate))
+            continue
+        if value and key == "char":
+            names = [n for alt in value.split("|") if alt.strip() for n in _variants(alt)]
+            if names: char_terms.append((names, negate))
+            continue
+        if value and key == "orientation":
+            conditions = [_ORIENTATIONS[alt.strip().lower()] for alt in value.split("|") if alt.strip().lower() in _ORIENTATIONS]
+            if conditions: size_terms.append((f"{'NOT ' if negate else ''}({' OR '.join(conditions)})", ()))
+            continue
+        if value and key == "minres":
+            match = _MINRES_RE.match(value.strip().lower())
+            if match and match.group(2): condition, params = "T0.width >= ? AND T0.height >= ?", (int(match.group(1)), int(match.group(2)))
+            elif match: condition, params = "MIN(T0.width, T0.height) >= ?", (int(match.group(1)),)
+            else: continue
+            size_terms.append((f"{'NOT ' if negate else ''}({condition})", params))
+            continue
+        bounds, match = [], _BOUND_RE.match(term)
+        if match:
+            term, bounds = match.group("name"), [(match.group("op"), float(match.group("value")))]
+            if term.strip().lower() in _CONF_KEYS:
+                default_bounds.extend(bounds); continue
+        names = [n for alt in term.split("|") if alt.strip() for n in _variants(alt)]
+        if names: tag_terms.append((names, negate, bounds))
+    return tag_terms, rating_terms, char_terms, default_bounds, size_terms
+
+@lru_cache(maxsize=256)
+def compile_query(query_string: str, select: str = "T0.filepath", order_by: str | None = "T0.id DESC", min_confidence: float | None = None):
+    """把查询字符串编译成 (sql, params); 没有任何过滤条件时返回 None
+    结果按参数缓存, 调用方如需分页在 sql 后追加 LIMIT/OFFSET"""
+    tag_terms, rating_terms, char_terms, default_bounds, size_terms = parse_query(query_string)
+    if min_confidence is not None: default_bounds = default_bounds or [(">=", min_confidence)]
+    where_clauses, params = [], []
+
+    for names, negate, bounds in tag_terms:
+        subquery = f"SELECT it.image_id FROM image_tags it JOIN tags t ON it.tag_id = t.id WHERE t.name IN ({','.join(['?']*len(names))})"
+        params.extend(names)
+        for op, value in bounds or default_bounds:
+            subquery += f" AND it.confidence {op} ?"; params.append(value)
+        where_clauses.append(f"T0.id {'NOT IN' if negate else 'IN'} ({subquery})")
+
+    for column, terms in (("T0.rating", rating_terms), ("T0.character_name", char_terms)):
+        for names, negate in terms:
+            where_clauses.append(f"{column} {'NOT IN' if negate else 'IN'} ({','.join(['?']*len(names))})")
+            params.extend(names)
+
+    for condition, condition_params in size_terms:
+        where_clauses.append(condition); params.extend(condition_params)
+
+    if not where_clauses: return None
+    sql = f"SELECT {select} FROM images AS T0 WHERE {' AND '.join(where_clauses)}"
+    if order_by: sql += f" ORDER BY {order_by}"
+    return sql, tuple(params)
@@ -0,0 +1,87 @@
+# response_cache.py (预序列化 + 预压缩的 JSON 响应缓存, 带强 ETag)
+import gzip
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from flask import Response
+
+try:
+    import orjson  # 可选: 比标准库 json 快得多
+except ImportError:
+    orjson = None
+try:
+    import brotli  # 可选: 提供 br 编码
+except ImportError:
+    brotli = None
+
+MIN_COMPRESS_SIZE = 1024  # 小于此字节数的响应不压缩
+
+def dumps(obj) -> bytes:
+    if orjson is not None: return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+class CachedJSON:
+    """同一份 JSON 的原始/gzip/brotli 三种编码, 在构建时一次性算好"""
+
+    def __init__(self, obj):
+        self.body = dumps(obj)
+        self.etag = hashlib.blake2b(self.body, digest_size=12).hexdigest()
+        self.encoded = {}
+        if len(self.body) >= MIN_COMPRESS_SIZE:
+            self.encoded['gzip'] = gzip.compress(self.body, compresslevel=6)
+            if brotli is not None: self.encoded['br'] = brotli.compress(self.body, quality=8)
+
+class ResponseCache:
+    """按 key 缓存 CachedJSON; key 中应包含数据的代数 (媒体索引代数或数据库版本), 过期条目随 LRU 淘汰或由 drop 主动清除
+    observe(key, hit, build_seconds, encode_seconds) 在每次查找后调用, 用于统计命中率和构建 / 序列化耗时"""
+
+    def __init__(self, max_entries: int = 256, observe=None):
+        self.max_entries, self.observe, self._entries, self._lock = max_entries, observe, OrderedDict(), threading.Lock()
+
+    def clear(self):
+        with self._lock: self._entries.clear()
+
+    def drop(self, predicate):
+        """删除 predicate(key) 为真的条目, 返回删除的数量"""
+        with self._lock:
+            stale = [key for key in self._entries if predicate(key)]
+            for key in stale: del self._entries[key]
+        return len(stale)
+
+    def get(self, key, build) -> CachedJSON:
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None: self._entries.move_to_end(key)
+        if cached is not None:
+            if self.observe: self.observe(key, True, 0.0, 0.0)
+            return cached
+        # 在锁外构建, 并发的相同请求最多重复构建一次
+        start = time.perf_counter(); obj = build(); built = time.perf_counter()
+        cached = CachedJSON(obj)
+        if self.observe: self.observe(key, False, built - start, time.perf_counter() - built)
+        with self._lock:
+            self._entries[key] = cached
+            while len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+        return cached
+
+def _accepts(accept_encoding: str, coding: str) -> bool:
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        if name.strip().lower() == coding: return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+def json_response(cached: CachedJSON, request, status: int = 200) -> Response:
+    """根据 If-None-Match 返回 304, 否则按 Accept-Encoding 选择最优的预压缩版本"""
+    headers = {"Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("If-None-Match", "")
+    # 每种编码的 ETag 带后缀区分, 比较时去掉后缀
+    if any(tag.strip().removeprefix('W/').strip('"').split('-')[0] == cached.etag for tag in if_none_match.split(',') if tag.strip()):
+        return Response(status=304, headers={**headers, "ETag": f'"{cached.etag}"'})
+    accept_encoding = request.headers.get("Accept-Encoding", "")
+    for coding, suffix in (('br', 'br'), ('gzip', 'gz')):
+        if coding in cached.encoded and _accepts(accept_encoding, coding):
+            return Response(cached.encoded[coding], status=status, mimetype="application/json",
+                            headers={**headers, "Content-Encoding": coding, "ETag": f'"{cached.etag}-{suffix}"'})
+    return Response(cached.body, status=status, mimetype="application/json", headers={**headers, "ETag": f'"{cached.etag}"'})
@@ -0,0 +1,101 @@
+# similarity.py (基于 VectorStore 中归一化 embedding 的余弦 top-k 搜索)
+import os
+import numpy as np
+from vector_store import VectorStore
+
+# --- 配置 ---
+SEARCH_BLOCK_ROWS = 65536       # 暴力搜索时每块读入的行数
+IVF_MIN_VECTORS = 1_000_000     # 向量数超过此值才建立 IVF 粗排索引
+IVF_DEFAULT_NPROBE = 16
+IVF_SAMPLE_PER_LIST = 39        # k-means 训练样本: 每个簇 39 个点, 至少 IVF_MIN_SAMPLE 个 (不超过总数)
+IVF_MIN_SAMPLE = 65536
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def _merge_top_k(best_ids, best_scores, ids, scores, k):
+    ids, scores = np.concatenate([best_ids, ids]), np.concatenate([best_scores, scores])
+    if len(scores) > k:
+        part = np.argpartition(-scores, k - 1)[:k]
+        ids, scores = ids[part], scores[part]
+    return ids, scores
+
+def _finish(ids, scores, exclude_id):
+    order = np.argsort(-scores, kind="stable")
+    return [(int(i), float(s)) for i, s in zip(ids[order], scores[order]) if i != exclude_id]
+
+def top_k_cosine(store: VectorStore, query: np.ndarray, k: int, exclude_id=None, block_rows: int = SEARCH_BLOCK_ROWS):
+    """分块暴力搜索, 返回按相似度降序的 [(image_id, score)], 内存占用只与 block_rows 有关"""
+    q = normalize(query).ravel()
+    want = k + (exclude_id is not None)
+    best_ids, best_scores = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    for ids, block in store.iter_chunks(block_rows):
+        best_ids, best_scores = _merge_top_k(best_ids, best_scores, ids, block @ q, want)
+    return _finish(best_ids, best_scores, exclude_id)[:k]
+
+# --- IVF 粗排索引 ---
+def _assign(vectors, centroids, block_rows):
+    """每行最近的中心; 分块计算, 相似度矩阵最多 block_rows x nlist"""
+    return np.concatenate([(np.asarray(vectors[s:s + block_rows], dtype=np.float32) @ centroids.T).argmax(axis=1)
+                           for s in range(0, len(vectors), block_rows)])
+
+class IVFIndex:
+    """倒排文件索引: 球面 k-means 聚类中心 + 按簇排序的行号, 查询时只扫描 nprobe 个最近簇"""
+
+    def __init__(self, centroids, order, offsets, built_rows):
+        self.centroids, self.order, self.offsets, self.built_rows = centroids, order, offsets, built_rows
+
+    @staticmethod
+    def path_for(store: VectorStore) -> str:
+        return store.base_path + ".ivf.npz"
+
+    @classmethod
+    def load(cls, store: VectorStore):
+        path = cls.path_for(store)
+        if not os.path.exists(path): return None
+        with np.load(path) as data:
+            return cls(data["centroids"], data["order"], data["offsets"], int(data["built_rows"]))
+
+    @classmethod
+    def build(cls, store: VectorStore, nlist: int | None = None, iterations: int = 10, seed: int = 0, block_rows: int = SEARCH_BLOCK_ROWS):
+        # 被重新写入的 id 只有最后一行参与聚类和分簇, 旧行不进倒排表
+        matrix, live_rows = store.matrix, np.flatnonzero(store.live)
+        n = len(live_rows)
+        nlist = nlist or max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        sample_size = min(n, max(nlist * IVF_SAMPLE_PER_LIST, IVF_MIN_SAMPLE))
+        sample = normalize(matrix[live_rows[np.sort(rng.choice(n, size=sample_size, replace=False))]])
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)]
+        for _ in range(iterations):
+            assign = _assign(sample, centroids, block_rows)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            empty = np.bincount(assign, minlength=nlist) == 0
+            sums[empty] = centroids[empty]  # 空簇保留原中心
+            centroids = normalize(sums)
+        assign = _assign(matrix, centroids, block_rows)[live_rows]
+        order = live_rows[np.argsort(assign, kind="stable")]
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))])
+        index = cls(centroids.astype(np.float32), order.astype(np.int64), offsets.astype(np.int64), len(matrix))
+        np.savez(cls.path_for(store), centroids=index.centroids, order=index.order, offsets=index.offsets, built_rows=len(matrix))
+        return index
+
+    def search(self, store: VectorStore, query: np.ndarray, k: int, exclude_id=None, nprobe: int = IVF_DEFAULT_NPROBE):
+        q = normalize(query).ravel()
+        lists = np.argsort(-(self.centroids @ q))[:nprobe]
+        # 建索引之后追加的行还没有分簇, 直接加入候选
+        rows = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in lists] + [np.arange(self.built_rows, len(store.ids))])
+        rows = rows[store.live[rows]]  # 建索引之后被重新写入的 id, 旧行已不再有效
+        rows.sort()
+        scores = np.asarray(store.matrix[rows], dtype=np.float32) @ q
+        want = k + (exclude_id is not None)
+        ids, scores = _merge_top_k(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32), store.ids[rows], scores, want)
+        return _finish(ids, scores, exclude_id)[:k]
+
+def find_similar(store: VectorStore, image_id: int, k: int, ivf: IVFIndex | None = None):
+    query = store.get(image_id)
+    if query is None: return None
+    if ivf is not None: return ivf.search(store, query, k, exclude_id=image_id)
+    return top_k_cosine(store, query, k, exclude_id=image_id)
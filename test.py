@@ -9,21 +9,28 @@ import huggingface_hub
 import pandas as pd
 from PIL import Image
 from tqdm import tqdm
+from library_root import RAND_KEY_SQL, ensure_library_root, ensure_metadata_columns, ensure_rand_key
+from media_scanner import IMAGE_EXTS, scan_tree
+from name_index import sync_name_index
 
 # --- 配置 ---
 MODEL_REPO = "SmilingWolf/wd-eva02-large-tagger-v3"
 LABEL_FILENAME = "selected_tags.csv"
 DB_PATH = "image_tags.db"
+LIBRARY_ROOT = os.path.abspath('..')  # 数据库里的 filepath 相对这个目录存储
 CHARACTER_CONFIDENCE_THRESHOLD = 0.85
 
 # --- 数据库操作 (不变) ---
 def init_db():
     with sqlite3.connect(DB_PATH) as conn:
         cursor = conn.cursor()
-        cursor.execute('CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, filepath TEXT NOT NULL UNIQUE, character_name TEXT)')
+        cursor.execute('CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, filepath TEXT NOT NULL UNIQUE, character_name TEXT, rand_key INTEGER)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_character_name ON images (character_name)')
         cursor.execute('CREATE TABLE IF NOT EXISTS tags (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, category INTEGER)')
         cursor.execute('CREATE TABLE IF NOT EXISTS image_tags (image_id INTEGER, tag_id INTEGER, confidence REAL, FOREIGN KEY (image_id) REFERENCES images (id) ON DELETE CASCADE, FOREIGN KEY (tag_id) REFERENCES tags (id), PRIMARY KEY (image_id, tag_id))')
+        ensure_library_root(conn, LIBRARY_ROOT)
+        ensure_rand_key(conn)
+        ensure_metadata_columns(conn)
         conn.commit()
 
 # --- AI Tagger 核心类 (不变) ---
@@ -64,18 +71,9 @@ def handle_index(args):
         indexed_files = {row[0] for row in cursor.fetchall()}
     print(f"Found {len(indexed_files)} images already in the database.")
 
-    image_paths = []
-    supported_exts = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
     project_dir_name = os.path.basename(os.getcwd())
-    scan_path = os.path.abspath('..')
-    print(f"Scanning for images in '{scan_path}'...")
-    for root, dirs, files in os.walk(scan_path, topdown=True):
-        if project_dir_name in dirs: dirs.remove(project_dir_name)
-        for file in files:
-            if file.lower().endswith(supported_exts):
-                image_paths.append(os.path.abspath(os.path.join(root, file)))
-    
-    new_files = [p for p in image_paths if p not in indexed_files]
+    print(f"Scanning for images in '{LIBRARY_ROOT}'...")
+    new_files = [entry.path for entry in scan_tree(LIBRARY_ROOT, IMAGE_EXTS, exclude_dirs={project_dir_name}) if entry.path not in indexed_files]
     if not new_files:
         print("No new images found. Database is up to date."); return
     
@@ -100,7 +98,7 @@ def handle_index(args):
 
         for filepath in tqdm(new_files, desc="Tagging images"):
             try:
-                image = Image.open(filepath).convert("RGB")
+                image = Image.open(os.path.join(LIBRARY_ROOT, filepath)).convert("RGB")
                 probabilities = predictor.predict(image)
                 best_character_name = "others/oc"
                 best_character_score = 0.0
@@ -109,7 +107,7 @@ def handle_index(args):
                     if prob > CHARACTER_CONFIDENCE_THRESHOLD and prob > best_character_score:
                         best_character_name = tags_df.loc[i, 'name']
                         best_character_score = prob
-                cursor.execute("INSERT INTO images (filepath, character_name) VALUES (?, ?)", (filepath, best_character_name))
+                cursor.execute(f"INSERT INTO images (filepath, character_name, rand_key) VALUES (?, ?, {RAND_KEY_SQL})", (filepath, best_character_name))
                 image_id = cursor.lastrowid
                 tags_to_insert = []
                 for i, prob in enumerate(probabilities):
@@ -123,6 +121,8 @@ def handle_index(args):
             if len(new_files) > 100 and new_files.index(filepath) % 100 == 0:
                 conn.commit()
         conn.commit()
+        # 补上新的角色名 / 标签名; main.py 只在 name_fts 不存在时建一次, 之后只查这张表
+        sync_name_index(conn)
     print("Indexing complete!")
 
 
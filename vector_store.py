@@ -0,0 +1,95 @@
+# vector_store.py (按 image id 存放定长向量的 float16 内存映射存储)
+import json
+import os
+import numpy as np
+
+# --- 文件布局 ---
+# <base>.f16  : 行优先的 float16 矩阵, 每行 dim 个元素 (只追加)
+# <base>.ids  : 与行一一对应的 int64 image id (只追加)
+# <base>.json : {"dim": ..., "dtype": "float16"}
+
+class VectorStore:
+    def __init__(self, base_path: str, dim: int | None = None):
+        self.base_path = base_path
+        self.data_path, self.ids_path, self.meta_path = base_path + ".f16", base_path + ".ids", base_path + ".json"
+        self.dim = dim
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as f: stored_dim = json.load(f)["dim"]
+            if dim is not None and dim != stored_dim:
+                raise ValueError(f"Vector store '{base_path}' has dim {stored_dim}, expected {dim}.")
+            self.dim = stored_dim
+        self._matrix, self._ids, self._row_of, self._live = None, None, None, None
+
+    def exists(self) -> bool:
+        return os.path.exists(self.meta_path) and os.path.exists(self.data_path)
+
+    def __len__(self) -> int:
+        if not self.exists(): return 0
+        ids_rows = os.path.getsize(self.ids_path) // 8 if os.path.exists(self.ids_path) else 0
+        return min(ids_rows, os.path.getsize(self.data_path) // (2 * self.dim))
+
+    def _truncate_to_complete_rows(self):
+        """写入中途崩溃会留下没有 id 的数据行 (或写了一半的 id); 追加前把两个文件截到同样的完整行数,
+        否则新 id 会从旧的行数开始编号, 而新数据排在残留行之后, 此后每个 id 都对应错误的向量"""
+        if not os.path.exists(self.data_path): return
+        rows = len(self)
+        for path, row_bytes in ((self.data_path, 2 * self.dim), (self.ids_path, 8)):
+            if os.path.exists(path) and os.path.getsize(path) != rows * row_bytes:
+                with open(path, 'r+b') as f: f.truncate(rows * row_bytes)
+
+    # --- 写入 ---
+    def append(self, image_ids, vectors: np.ndarray):
+        """追加一批向量; 同一 id 多次写入时以最后一次为准"""
+        vectors = np.asarray(vectors, dtype=np.float16).reshape(len(image_ids), -1)
+        if self.dim is None: self.dim = vectors.shape[1]
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected vectors of dim {self.dim}, got {vectors.shape[1]}.")
+        if not os.path.exists(self.meta_path):
+            with open(self.meta_path, 'w', encoding='utf-8') as f: json.dump({"dim": self.dim, "dtype": "float16"}, f)
+        # 先写数据再写 id; 上次中途崩溃留下的残留行先截掉, 保证两个文件逐行对齐
+        self._truncate_to_complete_rows()
+        with open(self.data_path, 'ab') as f: f.write(np.ascontiguousarray(vectors).tobytes())
+        with open(self.ids_path, 'ab') as f: f.write(np.asarray(image_ids, dtype=np.int64).tobytes())
+        self._matrix, self._ids, self._row_of, self._live = None, None, None, None
+
+    # --- 读取 ---
+    def _load(self):
+        if self._matrix is not None: return
+        ids = np.fromfile(self.ids_path, dtype=np.int64) if os.path.exists(self.ids_path) else np.empty(0, dtype=np.int64)
+        rows = min(len(ids), len(self))  # 崩溃残留的尾部行在下次 append 前截掉
+        self._ids = ids[:rows]
+        self._matrix = np.memmap(self.data_path, dtype=np.float16, mode='r', shape=(rows, self.dim)) if rows else np.empty((0, self.dim or 0), dtype=np.float16)
+
+    @property
+    def ids(self) -> np.ndarray:
+        self._load(); return self._ids
+
+    @property
+    def matrix(self) -> np.ndarray:
+        self._load(); return self._matrix
+
+    @property
+    def live(self) -> np.ndarray:
+        """每行是否为该 id 最后一次写入的行 (与 get 一致); 被覆盖的旧行在扫描和建索引时跳过"""
+        self._load()
+        if self._live is None:
+            n = len(self._ids)
+            _, last_from_end = np.unique(self._ids[::-1], return_index=True)
+            self._live = np.zeros(n, dtype=bool); self._live[n - 1 - last_from_end] = True
+        return self._live
+
+    def get(self, image_id: int):
+        """返回某个 image id 的向量 (float32), 不存在时返回 None"""
+        self._load()
+        if self._row_of is None:
+            # 顺序覆盖, 重复 id 自然取最后一次写入的行
+            self._row_of = {int(i): r for r, i in enumerate(self._ids)}
+        row = self._row_of.get(int(image_id))
+        return None if row is None else np.asarray(self._matrix[row], dtype=np.float32)
+
+    def iter_chunks(self, chunk_size: int = 65536):
+        """按块迭代 (ids, float32 矩阵), 每块只把 chunk_size 行读入内存; 同一 id 只产出最后一次写入的行"""
+        live = self.live
+        for start in range(0, len(self._ids), chunk_size):
+            mask = live[start:start + chunk_size]
+            yield self._ids[start:start + chunk_size][mask], np.asarray(self._matrix[start:start + chunk_size], dtype=np.float32)[mask]
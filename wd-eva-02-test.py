@@ -1,6 +1,12 @@
 # image_database_onnx_optimized.py
 import argparse
+import itertools
+import json
 import os
+import sys
+import queue
+import threading
+import time
 os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
 import sqlite3
 import huggingface_hub
@@ -10,14 +16,34 @@ import onnxruntime as rt
 import pandas as pd
 from PIL import Image
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from vector_store import VectorStore
+from similarity import IVFIndex, IVF_MIN_VECTORS, normalize
+from query import compile_query, ensure_indexes
+from name_index import add_names, init_name_index, load_indexed_names, sync_name_index
+from library_root import RAND_KEY_SQL, ensure_library_root, ensure_metadata_columns, ensure_rand_key, missing_columns, to_relative
+from media_scanner import IMAGE_EXTS, scan_tree
+from media_metadata import PROBE_WORKERS, fill_missing_db_metadata
+from export import EXPORT_FORMATS, encode_export, export_chunks
+from index_tuning import StageTelemetry, autotune, default_memory_budget, load_tuning, save_tuning
 
 # --- 配置 ---
 MODEL_REPO = "SmilingWolf/wd-eva02-large-tagger-v3"
 MODEL_FILENAME = "model.onnx"
 LABEL_FILENAME = "selected_tags.csv"
+MODEL_DIR = os.environ.get("WD_MODEL_DIR")  # 设置后从这个目录读取 model.onnx 和 selected_tags.csv, 不访问 Hugging Face (基准测试的替身模型)
 DB_PATH = "image_tags.db"
+LIBRARY_ROOT = os.path.abspath('..')  # 数据库里的 filepath 相对这个目录存储
+PROBS_STORE_PATH = "image_probs"  # 原始概率向量存储 (index --store-probs / retag)
+EMBED_STORE_PATH = "image_embeds"  # 归一化 embedding 存储 (index --store-embeddings, 供 /api/similar 使用)
 CHARACTER_CONFIDENCE_THRESHOLD = 0.85
+DEFAULT_BATCH_SIZE, DEFAULT_NUM_WORKERS = 32, 8
+INDEX_TUNING_PATH = "index_tuning.json"  # index --autotune 的结果; 之后的 index 未指定 --batch-size / --num-workers 时沿用
+AUTOTUNE_BATCH_SIZES = (8, 16, 32, 64, 128)
+AUTOTUNE_WORKER_COUNTS = (2, 4, 8, 12, 16, 24, 32)  # 实际只试到 CPU 核数的两倍
+TAGGER_HOST, TAGGER_PORT = "127.0.0.1", 5001  # serve 子命令默认监听地址
 
 kaomojis = [
     "0_0", "(o)_(o)", "+_+", "+_-", "._.", "<o>_<o>", "<|>_<|>", "=_=", ">_<", "3_3",
@@ -27,11 +53,17 @@ kaomojis = [
 # --- 数据库操作 (不变) ---
 def init_db():
     with sqlite3.connect(DB_PATH) as conn:
+        # WAL: export 的长读事务期间 index / serve 仍能提交 (回滚日志模式下写入会在 5 秒后报 database is locked)
+        conn.execute("PRAGMA journal_mode=WAL")
         cursor = conn.cursor()
-        cursor.execute('CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, filepath TEXT NOT NULL UNIQUE, rating TEXT, character_name TEXT)')
+        cursor.execute('CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, filepath TEXT NOT NULL UNIQUE, rating TEXT, character_name TEXT, rand_key INTEGER)')
         cursor.execute('CREATE TABLE IF NOT EXISTS tags (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
         cursor.execute('CREATE TABLE IF NOT EXISTS image_tags (image_id INTEGER, tag_id INTEGER, confidence REAL, FOREIGN KEY (image_id) REFERENCES images (id) ON DELETE CASCADE, FOREIGN KEY (tag_id) REFERENCES tags (id), PRIMARY KEY (image_id, tag_id))')
-        conn.commit()
+        ensure_indexes(conn)
+        ensure_library_root(conn, LIBRARY_ROOT)
+        ensure_rand_key(conn)
+        ensure_metadata_columns(conn)
+        if not init_name_index(conn): print("SQLite build lacks FTS5 trigram support; substring name search will fall back to LIKE.")
 
 # --- 核心预测器类 (已修改为支持批处理) ---
 def load_labels(dataframe) -> tuple[list[str], list[int], list[int], list[int]]:
@@ -43,22 +75,62 @@ def load_labels(dataframe) -> tuple[list[str], list[int], list[int], list[int]]:
     character_indexes = list(np.where(dataframe["category"] == 4)[0])
     return tag_names, rating_indexes, general_indexes, character_indexes
 
+def _model_file(filename: str) -> str:
+    if MODEL_DIR: return os.path.join(MODEL_DIR, filename)
+    return huggingface_hub.hf_hub_download(MODEL_REPO, filename)
+
+def load_tag_labels():
+    """只下载标签表 (不加载模型), retag 等不需要推理的命令使用"""
+    csv_path = _model_file(LABEL_FILENAME)
+    return load_labels(pd.read_csv(csv_path))
+
+def _find_embedding_tensor(graph):
+    """从输出节点往回找分类头 (MatMul/Gemm), 它的输入就是池化后的倒数第二层特征"""
+    producers = {out: node for node in graph.node for out in node.output}
+    name = graph.output[0].name
+    while name in producers:
+        node = producers[name]
+        if node.op_type in ("MatMul", "Gemm"): return node.input[0]
+        name = node.input[0]
+    return None
+
+def _export_embedding_model(model_path: str):
+    """生成一个额外输出 embedding 的模型副本, 缺少 onnx 包或找不到分类头时返回 None"""
+    export_path = os.path.splitext(model_path)[0] + "_with_embedding.onnx"
+    if os.path.exists(export_path): return export_path
+    try:
+        import onnx
+    except ImportError:
+        print("Package 'onnx' is not installed (pip install onnx); --store-embeddings cannot expose the embedding output."); return None
+    model = onnx.load(model_path)
+    tensor_name = _find_embedding_tensor(model.graph)
+    if tensor_name is None:
+        print("Could not locate the classifier head in the ONNX graph."); return None
+    model.graph.output.append(onnx.helper.make_tensor_value_info(tensor_name, onnx.TensorProto.FLOAT, None))
+    onnx.save(model, export_path)
+    return export_path
+
 class Predictor:
     def __init__(self):
         self.model = None
         self.tag_names, self.rating_indexes, self.general_indexes, self.character_indexes = [], [], [], []
         self.model_target_size = None
+        self.embedding_output = None
 
-    def load_model(self):
+    def load_model(self, with_embeddings: bool = False):
         if self.model: return
-        print(f"Downloading and loading model '{MODEL_REPO}'...")
-        csv_path = huggingface_hub.hf_hub_download(MODEL_REPO, LABEL_FILENAME)
-        model_path = huggingface_hub.hf_hub_download(MODEL_REPO, MODEL_FILENAME)
-        tags_df = pd.read_csv(csv_path)
-        self.tag_names, self.rating_indexes, self.general_indexes, self.character_indexes = load_labels(tags_df)
+        print(f"Downloading and loading model '{MODEL_DIR or MODEL_REPO}'...")
+        model_path = _model_file(MODEL_FILENAME)
+        if with_embeddings:
+            model_path = _export_embedding_model(model_path) or model_path
+        self.tag_names, self.rating_indexes, self.general_indexes, self.character_indexes = load_tag_labels()
         providers = ['CUDAExecutionProvider'] if 'CUDAExecutionProvider' in rt.get_available_providers() else ['CPUExecutionProvider']
         print(f"Using ONNX provider: {providers[0]}")
         self.model = rt.InferenceSession(model_path, providers=providers)
+        outputs = self.model.get_outputs()
+        if with_embeddings:
+            if len(outputs) > 1: self.embedding_output = outputs[1].name
+            else: print("Model has no embedding output; embeddings will not be stored.")
         _, height, _, _ = self.model.get_inputs()[0].shape
         self.model_target_size = height
         print(f"Model loaded. Target image size: {self.model_target_size}x{self.model_target_size}")
@@ -78,35 +150,184 @@ class Predictor:
         image_array = np.asarray(padded_image, dtype=np.float32)
         return image_array[:, :, ::-1] # RGB to BGR, but without the batch dimension
 
-    def predict_batch(self, image_arrays: list[np.ndarray]):
+    def infer_batch(self, image_arrays: list[np.ndarray]):
+        """返回 (概率矩阵 (batch_size, num_tags), 归一化 embedding 或 None)"""
         # 将多个numpy数组堆叠成一个批次
         batch_array = np.stack(image_arrays, axis=0)
         
         input_name = self.model.get_inputs()[0].name
         label_name = self.model.get_outputs()[0].name
         
-        preds = self.model.run([label_name], {input_name: batch_array})[0]
-        # preds 的形状现在是 (batch_size, num_tags)
-        
-        results = []
-        for p in preds:
-            labels = list(zip(self.tag_names, p.astype(float)))
-            ratings = dict([labels[i] for i in self.rating_indexes])
-            general_names = [labels[i] for i in self.general_indexes]
-            character_names = [labels[i] for i in self.character_indexes]
-            results.append((ratings, general_names, character_names))
-        return results
+        if self.embedding_output is None:
+            return self.model.run([label_name], {input_name: batch_array})[0], None
+        preds, embeds = self.model.run([label_name, self.embedding_output], {input_name: batch_array})
+        if embeds.ndim == 3: embeds = embeds.mean(axis=1)  # 未池化的 token 序列取均值
+        return preds, normalize(embeds)
+
+    def split_labels(self, p: np.ndarray):
+        labels = list(zip(self.tag_names, p.astype(float)))
+        ratings = dict([labels[i] for i in self.rating_indexes])
+        general_names = [labels[i] for i in self.general_indexes]
+        character_names = [labels[i] for i in self.character_indexes]
+        return ratings, general_names, character_names
+
+    def predict_batch(self, image_arrays: list[np.ndarray]):
+        return [self.split_labels(p) for p in self.infer_batch(image_arrays)[0]]
 
 # --- 命令行处理函数 (已重构) ---
-def _prepare_single_image(filepath, predictor):
-    """辅助函数，用于在子线程中加载和预处理单张图片"""
+def _prepare_single_image(filepath, predictor, telemetry=None):
+    """辅助函数，用于在子线程中加载和预处理单张图片; 相对路径按 LIBRARY_ROOT 解析"""
     try:
-        image = Image.open(filepath).convert("RGBA")
-        return predictor.prepare_image(image), filepath
+        start = time.perf_counter()
+        image = Image.open(os.path.join(LIBRARY_ROOT, filepath)).convert("RGBA")
+        decoded = time.perf_counter()
+        prepared = predictor.prepare_image(image)
+        if telemetry is not None: telemetry.add("decode", decoded - start); telemetry.add("preprocess", time.perf_counter() - decoded)
+        return prepared, filepath
     except Exception:
         # 忽略损坏的图片
         return None, filepath
 
+def _prefetch_images(filepaths, predictor, num_workers: int, prefetch: int, telemetry=None):
+    """按原顺序产出预处理结果, 同时在途的图片不超过 prefetch 张 (executor.map 会一次提交全部文件, 推理跟不上时内存持续增长)"""
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    remaining, pending = iter(filepaths), deque()
+    try:
+        for filepath in itertools.islice(remaining, prefetch): pending.append(executor.submit(_prepare_single_image, filepath, predictor, telemetry))
+        while pending:
+            result = pending.popleft().result()
+            for filepath in itertools.islice(remaining, 1): pending.append(executor.submit(_prepare_single_image, filepath, predictor, telemetry))
+            yield result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def _index_files(filepaths, predictor, writer, batch_size: int, num_workers: int, telemetry, pbar, on_batch=None):
+    """按批推理并入库 (每个批次提交一次), 返回入库的图片数; on_batch(已处理文件数, 已入库图片数) 在每个批次写库后调用"""
+    consumed = tagged = 0
+    prepared = _prefetch_images(filepaths, predictor, num_workers, batch_size * 2 + num_workers, telemetry)
+    try:
+        while True:
+            batch_arrays, batch_paths = [], []
+            # 从预处理结果中收集一个批次, 等待时间记为 queue_wait (模型在等 CPU)
+            with telemetry.stage("queue_wait"): items = list(itertools.islice(prepared, batch_size))
+            if not items: break # 结束循环
+            for prepared_array, filepath in items:
+                if prepared_array is not None:
+                    batch_arrays.append(prepared_array)
+                    batch_paths.append(filepath)
+            if batch_arrays:
+                with telemetry.stage("inference", len(batch_arrays)): batch_probs, batch_embeds = predictor.infer_batch(batch_arrays)
+                with telemetry.stage("db_write", len(batch_paths)): writer.write_batch(batch_paths, batch_probs, batch_embeds)
+            consumed += len(items); tagged += len(batch_paths)
+            pbar.update(len(items)); telemetry.images_done(len(batch_paths))
+            if on_batch is not None: on_batch(consumed, tagged)
+    finally:
+        prepared.close()  # 出错提前退出时停止预处理线程
+    return tagged
+
+def _tuning_key(predictor) -> str:
+    return f"{MODEL_DIR or MODEL_REPO}|{predictor.model.get_providers()[0]}|embeddings={predictor.embedding_output is not None}"
+
+def _autotune_index(new_files, predictor, writer, telemetry, pbar, args, num_workers: int):
+    """在真实的待打标文件上依次试验候选配置 (试验中的图片照常入库), 返回 (最佳配置或 None, 已处理文件数, 已入库图片数)"""
+    budget = int(args.memory_budget_mb * 2**20) if args.memory_budget_mb else default_memory_budget()
+    if budget is None: tqdm.write("Memory budget unknown (install psutil or pass --memory-budget-mb); trials are not limited by memory.")
+    position = tagged_total = 0
+
+    def run_trial(batch_size, trial_workers):
+        nonlocal position, tagged_total
+        window = max(args.autotune_images, batch_size * 3)
+        if position + window > len(new_files): return None
+        telemetry.set_context(phase="autotune", batch_size=batch_size, num_workers=trial_workers); telemetry.reset_peak()
+        marks = []
+        try: _index_files(new_files[position:position + window], predictor, writer, batch_size, trial_workers, telemetry, pbar,
+                          on_batch=lambda consumed, tagged: marks.append((time.perf_counter(), consumed, tagged)))
+        except Exception:
+            writer.rollback()  # 失败批次写了一半的行不能随下一次试验一起提交
+            raise
+        finally:
+            if marks: position += marks[-1][1]; tagged_total += marks[-1][2]
+        # 第一个批次包含线程池启动和新批大小的首次推理, 不计入吞吐
+        (t0, _, n0), (t1, _, n1) = marks[0], marks[-1]
+        return {"images_per_second": round((n1 - n0) / (t1 - t0), 2) if t1 > t0 else 0.0, "peak_rss": telemetry.peak_rss}
+
+    worker_counts = [w for w in AUTOTUNE_WORKER_COUNTS if w <= 2 * (os.cpu_count() or 1)]
+    best, trials = autotune(run_trial, AUTOTUNE_BATCH_SIZES, worker_counts, num_workers, budget, log=tqdm.write)
+    if best is not None:
+        save_tuning(INDEX_TUNING_PATH, _tuning_key(predictor), {
+            "batch_size": best["batch_size"], "num_workers": best["num_workers"], "images_per_second": best["images_per_second"],
+            "memory_budget_mb": round(budget / 2**20) if budget else None, "tuned_at": time.strftime("%Y-%m-%d %H:%M:%S"), "trials": trials})
+        tqdm.write(f"Autotune picked batch_size={best['batch_size']} num_workers={best['num_workers']} ({best['images_per_second']:.1f} images/s), saved to '{INDEX_TUNING_PATH}'.")
+    else: tqdm.write("Autotune found no usable configuration (not enough new images or every trial failed); keeping the current settings.")
+    return best, position, tagged_total
+
+class TagWriter:
+    """把一批推理结果写入数据库 (以及可选的概率/embedding 存储), index 和 serve 共用"""
+
+    def __init__(self, predictor, general_thresh: float, store_probs: bool = False):
+        self.predictor, self.general_thresh = predictor, general_thresh
+        # check_same_thread=False: serve 模式下连接在批处理线程里创建和使用
+        self.conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute("SELECT name, id FROM tags")
+        self.tag_to_id = {name: id for name, id in self.cursor.fetchall()}
+        self.probs_store = VectorStore(PROBS_STORE_PATH, len(predictor.tag_names)) if store_probs else None
+        self.embed_store = VectorStore(EMBED_STORE_PATH) if predictor.embedding_output else None
+        self.name_index = init_name_index(self.conn)
+        self.indexed_names = load_indexed_names(self.conn) if self.name_index else set()
+
+    def write_batch(self, filepaths, batch_probs, batch_embeds=None):
+        """filepaths 为磁盘路径, 入库时转为相对 LIBRARY_ROOT 的路径; 返回每张图片的 {"id", "rating", "character", "tags"} 摘要"""
+        cursor, summaries = self.cursor, []
+        for i, filepath in enumerate(filepaths):
+            ratings, general_names, character_names = self.predictor.split_labels(batch_probs[i])
+            
+            general_res = {name: prob for name, prob in general_names if prob > self.general_thresh}
+            character_res = {name: prob for name, prob in character_names if prob > CHARACTER_CONFIDENCE_THRESHOLD}
+
+            best_rating = max(ratings, key=ratings.get) if ratings else "unknown"
+            sorted_chars = sorted(character_res.items(), key=lambda x: x[1], reverse=True)
+            best_char = sorted_chars[0][0] if sorted_chars else "others/oc"
+
+            cursor.execute(f"INSERT INTO images (filepath, rating, character_name, rand_key) VALUES (?, ?, ?, {RAND_KEY_SQL})",(to_relative(filepath, LIBRARY_ROOT), best_rating, best_char))
+            image_id = cursor.lastrowid
+            
+            tags_to_insert = []
+            for tag_name, confidence in general_res.items():
+                tag_id = self.tag_to_id.get(tag_name)
+                if tag_id is None: # 如果是新标签
+                    cursor.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag_name,))
+                    tag_id = cursor.execute("SELECT id FROM tags WHERE name = ?", (tag_name,)).fetchone()[0]
+                    self.tag_to_id[tag_name] = tag_id
+                tags_to_insert.append((image_id, tag_id, confidence))
+            
+            if tags_to_insert:
+                cursor.executemany("INSERT OR IGNORE INTO image_tags (image_id, tag_id, confidence) VALUES (?, ?, ?)", tags_to_insert)
+            summaries.append({"id": image_id, "rating": best_rating, "character": best_char, "tags": len(tags_to_insert)})
+            if self.name_index:
+                add_names(self.conn, 'char', [best_char], self.indexed_names)
+                add_names(self.conn, 'tag', general_res, self.indexed_names)
+
+        self.conn.commit()
+        image_ids = [summary["id"] for summary in summaries]
+        if self.probs_store is not None:
+            self.probs_store.append(image_ids, batch_probs)
+        if self.embed_store is not None:
+            self.embed_store.append(image_ids, batch_embeds)
+        return summaries
+
+    def rollback(self):
+        """批次中途失败时撤销未提交的写入; 该批次新建的标签 id 和名字索引也随之回滚, 缓存按数据库重新加载"""
+        self.conn.rollback()
+        self.tag_to_id = {name: id for name, id in self.cursor.execute("SELECT name, id FROM tags").fetchall()}
+        if self.name_index: self.indexed_names = load_indexed_names(self.conn)
+
+    def close(self):
+        self.conn.close()
+        if self.embed_store is not None and len(self.embed_store) >= IVF_MIN_VECTORS:
+            print(f"Rebuilding IVF index over {len(self.embed_store)} embeddings...")
+            IVFIndex.build(self.embed_store)
+
 def handle_index(args):
     """处理 index 子命令: 使用批处理和并行加载"""
     print("Initializing database...")
@@ -118,161 +339,242 @@ def handle_index(args):
         indexed_files = {row[0] for row in cursor.fetchall()}
     print(f"Found {len(indexed_files)} images already in the database.")
 
-    # (扫描文件部分不变)
-    image_paths = []
-    supported_exts = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+    # 扫描得到的已经是相对 LIBRARY_ROOT 的路径, 可以直接和数据库比对
     project_dir_name = os.path.basename(os.getcwd())
-    scan_path = os.path.abspath('..')
-    for root, dirs, files in os.walk(scan_path, topdown=True):
-        if project_dir_name in dirs: dirs.remove(project_dir_name)
-        for file in files:
-            if file.lower().endswith(supported_exts):
-                image_paths.append(os.path.abspath(os.path.join(root, file)))
-    
-    new_files = sorted(list(set(image_paths) - indexed_files))
+    new_files = sorted(entry.path for entry in scan_tree(LIBRARY_ROOT, IMAGE_EXTS, exclude_dirs={project_dir_name}) if entry.path not in indexed_files)
     if not new_files:
-        print("No new images to index."); return
+        print("No new images to index."); handle_metadata(args); return
     
     print(f"Found {len(new_files)} new images. Starting optimized tagging process...")
     predictor = Predictor()
-    predictor.load_model() # 提前加载模型
+    predictor.load_model(with_embeddings=args.store_embeddings) # 提前加载模型
+
+    # 命令行参数优先, 其次是之前 --autotune 保存的结果
+    tuned = load_tuning(INDEX_TUNING_PATH, _tuning_key(predictor)) or {}
+    batch_size = args.batch_size or tuned.get("batch_size") or DEFAULT_BATCH_SIZE
+    num_workers = args.num_workers or tuned.get("num_workers") or DEFAULT_NUM_WORKERS
+    if tuned and not args.autotune and (args.batch_size is None or args.num_workers is None):
+        print(f"Using tuned settings from '{INDEX_TUNING_PATH}': batch_size={batch_size} num_workers={num_workers}")
+
+    writer = TagWriter(predictor, args.general_thresh, args.store_probs)
+    telemetry_stream = None
+    if args.telemetry == "-": telemetry_stream = sys.stderr  # 不和 stdout 上的结果输出混在一起
+    elif args.telemetry: telemetry_stream = open(args.telemetry, "a", encoding="utf-8")
+    telemetry = StageTelemetry(telemetry_stream, args.telemetry_interval, phase="index", batch_size=batch_size, num_workers=num_workers)
+
+    processed_count = position = 0
+    pbar = tqdm(total=len(new_files), desc="Tagging Images")
+    try:
+        if args.autotune:
+            best, position, processed_count = _autotune_index(new_files, predictor, writer, telemetry, pbar, args, num_workers)
+            if best is not None: batch_size, num_workers = best["batch_size"], best["num_workers"]
+            telemetry.set_context(phase="index", batch_size=batch_size, num_workers=num_workers)
+        # 对每个批次进行GPU推理, 结果存入数据库 (每个批次提交一次)
+        processed_count += _index_files(new_files[position:], predictor, writer, batch_size, num_workers, telemetry, pbar)
+    finally:
+        pbar.close()
+        telemetry.close()
+        if telemetry_stream not in (None, sys.stderr): telemetry_stream.close()
+        writer.close()
+    print(f"Indexing complete! {processed_count} new images were tagged.")
+    handle_metadata(args)
+
+def handle_metadata(args):
+    """处理 metadata 子命令: 只读文件头, 为还没有尺寸 / 大小 / 修改时间的图片补上元数据 (index 结束时也会调用)"""
+    init_db()
+    with sqlite3.connect(DB_PATH) as conn:
+        updated = fill_missing_db_metadata(conn, LIBRARY_ROOT, getattr(args, "probe_workers", PROBE_WORKERS))
+    print(f"Stored header metadata for {updated} images.")
+
+def handle_retag(args):
+    """处理 retag 子命令: 用已保存的概率向量按新阈值重建 rating / character_name / image_tags, 无需重新推理"""
+    store = VectorStore(PROBS_STORE_PATH)
+    if not store.exists():
+        print(f"Probability store '{PROBS_STORE_PATH}' not found. Run 'index --store-probs' first."); return
+    tag_names, rating_indexes, general_indexes, character_indexes = load_tag_labels()
+    if store.dim != len(tag_names):
+        print(f"Probability store has {store.dim} columns but the label file has {len(tag_names)} tags."); return
+    tag_names = np.array(tag_names, dtype=object)
+    rating_idx, general_idx, char_idx = np.array(rating_indexes), np.array(general_indexes), np.array(character_indexes)
 
-    # 创建数据库连接和标签查找字典
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
-    cursor.execute("SELECT name, id FROM tags")
-    tag_to_id_base = {name: id for name, id in cursor.fetchall()}
-
-    processed_count = 0
-    # 使用线程池进行并行预处理
-    with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
-        # 创建一个迭代器，它会在后台加载和预处理图片
-        image_iterator = executor.map(lambda p: _prepare_single_image(p, predictor), new_files)
-        
-        pbar = tqdm(total=len(new_files), desc="Tagging Images")
-        
-        while True:
-            batch_arrays = []
-            batch_paths = []
-            
-            # 从迭代器中收集一个批次的预处理数据
-            try:
-                for _ in range(args.batch_size):
-                    prepared_array, filepath = next(image_iterator)
-                    if prepared_array is not None:
-                        batch_arrays.append(prepared_array)
-                        batch_paths.append(filepath)
-                    pbar.update(1)
-            except StopIteration:
-                # 所有图片都已处理
-                pass
-
-            if not batch_arrays:
-                break # 结束循环
-
-            # 对收集到的批次进行GPU推理
-            batch_results = predictor.predict_batch(batch_arrays)
-            
-            # 将批次结果存入数据库
-            for i, filepath in enumerate(batch_paths):
-                ratings, general_names, character_names = batch_results[i]
-                
-                general_res = {name: prob for name, prob in general_names if prob > args.general_thresh}
-                character_res = {name: prob for name, prob in character_names if prob > CHARACTER_CONFIDENCE_THRESHOLD}
-
-                best_rating = max(ratings, key=ratings.get) if ratings else "unknown"
-                sorted_chars = sorted(character_res.items(), key=lambda x: x[1], reverse=True)
-                best_char = sorted_chars[0][0] if sorted_chars else "others/oc"
-
-                cursor.execute("INSERT INTO images (filepath, rating, character_name) VALUES (?, ?, ?)",(filepath, best_rating, best_char))
-                image_id = cursor.lastrowid
-                
-                tags_to_insert = []
-                for tag_name, confidence in general_res.items():
-                    tag_id = tag_to_id_base.get(tag_name)
-                    if tag_id is None: # 如果是新标签
-                        cursor.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (tag_name,))
-                        tag_id = cursor.execute("SELECT id FROM tags WHERE name = ?", (tag_name,)).fetchone()[0]
-                        tag_to_id_base[tag_name] = tag_id
-                    tags_to_insert.append((image_id, tag_id, confidence))
-                
-                if tags_to_insert:
-                    cursor.executemany("INSERT OR IGNORE INTO image_tags (image_id, tag_id, confidence) VALUES (?, ?, ?)", tags_to_insert)
-            
-            processed_count += len(batch_paths)
-            conn.commit() # 每个批次提交一次
-            
-            # ============================================
-            #  ↓↓↓ 在此处添加短暂休眠 ↓↓↓
-            # ============================================
-            #time.sleep(0.05) # 休眠50毫秒
+    # 新阈值可能让此前从未入库的标签出现, 先把所有通用标签补进 tags 表
+    cursor.executemany("INSERT OR IGNORE INTO tags (name) VALUES (?)", [(name,) for name in tag_names[general_idx]])
+    tag_to_id = dict(cursor.execute("SELECT name, id FROM tags").fetchall())
+    general_tag_ids = np.array([tag_to_id[name] for name in tag_names[general_idx]], dtype=np.int64)
+    existing_ids = {row[0] for row in cursor.execute("SELECT id FROM images")}
+
+    retagged = 0
+    pbar = tqdm(total=len(store), desc="Retagging")
+    for ids, probs in store.iter_chunks(args.chunk_size):
+        pbar.update(len(ids))
+        keep = np.fromiter((int(i) in existing_ids for i in ids), dtype=bool, count=len(ids))
+        # 同一 id 存在多行时只保留最后一行
+        _, last_rows = np.unique(ids[::-1], return_index=True)
+        keep &= np.isin(np.arange(len(ids)), len(ids) - 1 - last_rows)
+        ids, probs = ids[keep], probs[keep]
+        if not len(ids): continue
+
+        best_ratings = tag_names[rating_idx[probs[:, rating_idx].argmax(axis=1)]]
+        char_probs = probs[:, char_idx]
+        best_char_col = char_probs.argmax(axis=1)
+        has_char = char_probs[np.arange(len(ids)), best_char_col] > args.character_thresh
+        best_chars = np.where(has_char, tag_names[char_idx[best_char_col]], "others/oc")
+        rows, cols = np.nonzero(probs[:, general_idx] > args.general_thresh)
 
+        id_list = ids.tolist()
+        cursor.executemany("UPDATE images SET rating = ?, character_name = ? WHERE id = ?", zip(best_ratings.tolist(), best_chars.tolist(), id_list))
+        cursor.executemany("DELETE FROM image_tags WHERE image_id = ?", ((i,) for i in id_list))
+        cursor.executemany("INSERT INTO image_tags (image_id, tag_id, confidence) VALUES (?, ?, ?)",
+                           zip(ids[rows].tolist(), general_tag_ids[cols].tolist(), probs[rows, general_idx[cols]].tolist()))
+        conn.commit()
+        retagged += len(ids)
     pbar.close()
+    sync_name_index(conn)
     conn.close()
-    print(f"Indexing complete! {processed_count} new images were tagged.")
+    print(f"Retag complete! {retagged} images were updated.")
+
+# --- serve 子命令: 常驻打标服务 ---
+class TaggingService:
+    """常驻的打标队列: 把并发请求合并成动态批次, 批次凑满或等待超过 max_latency 即推理"""
+
+    def __init__(self, predictor, writer, batch_size: int, max_latency: float, num_workers: int):
+        self.predictor, self.writer = predictor, writer
+        self.batch_size, self.max_latency = batch_size, max_latency
+        self.requests = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, filepath: str) -> Future:
+        future = Future()
+        self.requests.put((filepath, future))
+        return future
+
+    def _collect_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            try: batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty: break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            try: self._process(batch)
+            except Exception as e:
+                # 撤销这个批次已执行但未提交的 INSERT, 否则会随下一批次一起提交 (没有 probs/embedding, 重试时又被当成已入库)
+                self.writer.rollback()
+                for _, future in batch:
+                    if not future.done(): future.set_exception(e)
+
+    def _process(self, batch):
+        # 同一批次里重复的路径或已入库的图片直接返回已有记录
+        pending = {}
+        for filepath, future in batch:
+            row = self.writer.cursor.execute("SELECT id, rating, character_name FROM images WHERE filepath = ?", (to_relative(filepath, LIBRARY_ROOT),)).fetchone()
+            if row: future.set_result({"status": "exists", "id": row[0], "rating": row[1], "character": row[2]})
+            else: pending.setdefault(filepath, []).append(future)
+        if not pending: return
+
+        arrays, paths = [], []
+        for prepared_array, filepath in self.executor.map(lambda p: _prepare_single_image(p, self.predictor), pending):
+            if prepared_array is None:
+                for future in pending[filepath]: future.set_result({"status": "error", "error": "Could not open image."})
+            else:
+                arrays.append(prepared_array); paths.append(filepath)
+        if not arrays: return
+
+        batch_probs, batch_embeds = self.predictor.infer_batch(arrays)
+        for filepath, summary in zip(paths, self.writer.write_batch(paths, batch_probs, batch_embeds)):
+            for future in pending[filepath]: future.set_result({"status": "tagged", **summary})
+
+def _make_request_handler(service, library_root: str):
+    class TagRequestHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/health": return self._send_json(404, {"error": "Not found"})
+            self._send_json(200, {"status": "ok", "queued": service.requests.qsize()})
+
+        def do_POST(self):
+            """POST /tag {"paths": [...], "wait": true}; 相对路径按图库根目录解析"""
+            if self.path != "/tag": return self._send_json(404, {"error": "Not found"})
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                requested = [str(p) for p in payload["paths"]]
+            except (ValueError, KeyError, TypeError):
+                return self._send_json(400, {"error": "Expected a JSON body like {\"paths\": [...]}"})
+            # 绝对路径和 ../ 解析后必须仍在图库根目录之内, 否则任何客户端都能让服务读取主机上的任意文件
+            paths, rejected = [], {}
+            for p in requested:
+                path = os.path.abspath(os.path.join(library_root, p))
+                try: inside = os.path.commonpath([path, library_root]) == library_root and path != library_root
+                except ValueError: inside = False  # Windows 上不同盘符
+                if inside: paths.append(path)
+                else: rejected[p] = {"status": "error", "code": 400, "error": "Path is outside the library root."}
+            if rejected: return self._send_json(400, {"error": "Some paths are outside the library root; nothing was queued.", "paths": rejected})
+            futures = [service.submit(p) for p in paths]
+            if not payload.get("wait", True): return self._send_json(202, {"queued": len(futures)})
+            results = {}
+            for filepath, future in zip(paths, futures):
+                try: results[filepath] = future.result()
+                except Exception as e: results[filepath] = {"status": "error", "error": str(e)}
+            self._send_json(200, results)
+
+        def log_message(self, format, *args):
+            pass  # 不逐条打印请求日志
+    return TagRequestHandler
+
+def handle_serve(args):
+    """处理 serve 子命令: 常驻加载模型, 通过本地 HTTP 端口接收打标请求"""
+    init_db()
+    predictor = Predictor()
+    predictor.load_model(with_embeddings=args.store_embeddings)
+    writer = TagWriter(predictor, args.general_thresh, args.store_probs)
+    service = TaggingService(predictor, writer, args.batch_size, args.max_latency_ms / 1000, args.num_workers)
+    server = ThreadingHTTPServer((args.host, args.port), _make_request_handler(service, os.path.abspath(LIBRARY_ROOT)))
+    print(f"Tagging service listening on http://{args.host}:{args.port} (POST /tag)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down tagging service...")
+    finally:
+        server.server_close()
+        writer.close()
 
 # ==========================================================
 #  ↓↓↓ 新增的 search 命令处理函数 ↓↓↓
 # ==========================================================
+def _schema_ready(conn) -> bool:
+    """search / export 只读数据库; 还没迁移 (缺少补加的列) 时提示先运行 index, 不在这里改库"""
+    missing = missing_columns(conn)
+    if missing: print(f"Database has not been migrated yet (missing columns: {', '.join(missing)}). Run the 'index' or 'metadata' command first.")
+    return not missing
+
 def handle_search(args):
     """处理 search 子命令：根据复合标签搜索图片"""
     if not os.path.exists(DB_PATH):
         print("Database not found. Please run the 'index' command first."); return
     
-    # 1. 解析和分类用户输入的标签
-    raw_tags = [tag.strip() for tag in args.tags.split(',')]
-    rating_filters = []
-    char_filters = []
-    general_tags = []
-    
-    for tag in raw_tags:
-        if tag.startswith("rating:"):
-            rating_filters.append(tag)
-        elif tag.startswith("char:"):
-            # 去掉前缀 "char:" 并将空格替换回下划线以匹配数据库
-            char_filters.append(tag[5:].strip().replace(" ", "_"))
-        else:
-            # 通用标签，空格也替换为下划线
-            general_tags.append(tag.strip().replace(" ", "_"))
-
-    # 2. 动态构建SQL查询
-    base_query = "SELECT DISTINCT T0.filepath FROM images AS T0"
-    params = []
-    where_clauses = []
-    
-    # 2a. 构建通用标签的子查询
-    if general_tags:
-        # 这个子查询找出包含所有通用标签的 image_id
-        general_subquery = f"""
-            SELECT it.image_id
-            FROM image_tags it
-            JOIN tags t ON it.tag_id = t.id
-            WHERE t.name IN ({','.join(['?']*len(general_tags))})
-            GROUP BY it.image_id
-            HAVING COUNT(it.image_id) = ?
-        """
-        # 将子查询作为主查询的一部分
-        where_clauses.append(f"T0.id IN ({general_subquery})")
-        params.extend(general_tags)
-        params.append(len(general_tags))
-
-    # 2b. 添加对 rating 和 character 的直接过滤
-    for rating in rating_filters:
-        where_clauses.append("T0.rating = ?")
-        params.append(rating)
-        
-    for char in char_filters:
-        where_clauses.append("T0.character_name = ?")
-        params.append(char)
-        
-    # 3. 组合并执行查询
-    if where_clauses:
-        final_query = f"{base_query} WHERE {' AND '.join(where_clauses)}"
-    else:
+    # 解析查询并编译为 SQL (语法见 query.py)
+    compiled = compile_query(args.tags, order_by=None)
+    if compiled is None:
         print("Please provide tags to search for.")
         return
+    final_query, params = compiled
 
     with sqlite3.connect(DB_PATH) as conn:
+        if not _schema_ready(conn): return
         cursor = conn.cursor()
         cursor.execute(final_query, params)
         results = cursor.fetchall()
@@ -284,6 +586,23 @@ def handle_search(args):
     else:
         print("\nNo images found matching all the specified criteria.")
 
+def handle_export(args):
+    """处理 export 子命令: 把匹配的图片连同标签和置信度逐块写出, 不一次性读入内存"""
+    if not os.path.exists(DB_PATH):
+        print("Database not found. Please run the 'index' command first."); return
+    exported = 0
+    def counted(chunks):
+        nonlocal exported
+        for chunk in chunks: exported += len(chunk); yield chunk
+    with sqlite3.connect(DB_PATH) as conn:
+        if not _schema_ready(conn): return
+        out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8", newline="")
+        try:
+            for text in encode_export(counted(export_chunks(conn, args.query, args.min_confidence)), args.format): out.write(text)
+        finally:
+            if out is not sys.stdout: out.close()
+    # 输出到 stdout 时统计写到 stderr, 不混进导出内容
+    print(f"Exported {exported} images.", file=sys.stderr if args.output == "-" else sys.stdout)
 
 # --- main 函数 (已更新) ---
 def main():
@@ -293,18 +612,61 @@ def main():
     # index 命令
     parser_index = subparsers.add_parser("index", help="Scan and tag new images.")
     parser_index.add_argument("--general-thresh", type=float, default=0.35, help="Threshold for general tags.")
-    parser_index.add_argument("--batch-size", type=int, default=32, help="Images per GPU batch.")
-    parser_index.add_argument("--num-workers", type=int, default=8, help="CPU cores for preprocessing.")
+    parser_index.add_argument("--batch-size", type=int, default=None, help=f"Images per GPU batch (default: the tuned value from '{INDEX_TUNING_PATH}', else {DEFAULT_BATCH_SIZE}).")
+    parser_index.add_argument("--num-workers", type=int, default=None, help=f"CPU cores for preprocessing (default: the tuned value, else {DEFAULT_NUM_WORKERS}).")
+    parser_index.add_argument("--telemetry", type=str, default=None, help="Append per-stage timing (decode, preprocess, queue wait, inference, DB write) as JSON lines to this file ('-' for stderr).")
+    parser_index.add_argument("--telemetry-interval", type=float, default=10.0, help="Seconds between telemetry lines.")
+    parser_index.add_argument("--autotune", action="store_true", help=f"Try batch sizes and worker counts on the first new images, keep the fastest within the memory budget and save it to '{INDEX_TUNING_PATH}'.")
+    parser_index.add_argument("--autotune-images", type=int, default=256, help="Images per autotune trial (at least three batches).")
+    parser_index.add_argument("--memory-budget-mb", type=float, default=None, help="Peak resident memory allowed during autotune trials (default: current usage plus 80%% of available RAM).")
+    parser_index.add_argument("--store-embeddings", action="store_true", help=f"Also store normalized image embeddings in '{EMBED_STORE_PATH}' for similarity search (needs the 'onnx' package unless the model already has a second output).")
+    parser_index.add_argument("--store-probs", action="store_true", help=f"Also keep each image's full probability vector in '{PROBS_STORE_PATH}' for later retagging.")
+    
+    # retag 命令
+    parser_retag = subparsers.add_parser("retag", help="Rebuild tags from stored probabilities with new thresholds.")
+    parser_retag.add_argument("--general-thresh", type=float, default=0.35, help="Threshold for general tags.")
+    parser_retag.add_argument("--character-thresh", type=float, default=CHARACTER_CONFIDENCE_THRESHOLD, help="Threshold for character tags.")
+    parser_retag.add_argument("--chunk-size", type=int, default=65536, help="Images processed per vectorized chunk.")
+    
+    # serve 命令
+    parser_serve = subparsers.add_parser("serve", help="Keep the model loaded and tag images submitted over HTTP.")
+    parser_serve.add_argument("--host", type=str, default=TAGGER_HOST, help="Address to listen on.")
+    parser_serve.add_argument("--port", type=int, default=TAGGER_PORT, help="Port to listen on.")
+    parser_serve.add_argument("--general-thresh", type=float, default=0.35, help="Threshold for general tags.")
+    parser_serve.add_argument("--batch-size", type=int, default=32, help="Maximum images per dynamic batch.")
+    parser_serve.add_argument("--max-latency-ms", type=int, default=50, help="Longest time a request waits for its batch to fill.")
+    parser_serve.add_argument("--num-workers", type=int, default=8, help="CPU cores for preprocessing.")
+    parser_serve.add_argument("--store-embeddings", action="store_true", help="Also store normalized image embeddings.")
+    parser_serve.add_argument("--store-probs", action="store_true", help="Also keep full probability vectors for retagging.")
     
+    # metadata 命令
+    parser_metadata = subparsers.add_parser("metadata", help="Read image headers and store width/height/size/mtime for images that lack them.")
+    parser_metadata.add_argument("--probe-workers", type=int, default=PROBE_WORKERS, help="Threads reading image headers.")
+
     # search 命令
     parser_search = subparsers.add_parser("search", help="Search for images by tags.")
-    parser_search.add_argument("tags", type=str, help="Comma-separated tags. Use 'rating:' and 'char:' prefixes. E.g., '1girl,rating:safe,char:tokoyami towa'")
+    parser_search.add_argument("tags", type=str, help="Comma-separated tags. Use '-tag' to exclude, 'a|b' for either, 'conf>0.8' for confidence and 'rating:'/'char:'/'orientation:'/'minres:' prefixes. E.g., '1girl,-hat,rating:general,char:tokoyami towa'")
+
+    # export 命令
+    parser_export = subparsers.add_parser("export", help="Stream matching images with their tags and confidences as NDJSON or CSV.")
+    parser_export.add_argument("query", type=str, nargs="?", default="", help="Same syntax as 'search'; omit to export every image.")
+    parser_export.add_argument("--format", choices=list(EXPORT_FORMATS), default="ndjson", help="Output format.")
+    parser_export.add_argument("--output", type=str, default="-", help="Output file ('-' for stdout).")
+    parser_export.add_argument("--min-confidence", type=float, default=None, help="Only export tags at or above this confidence.")
 
     args = parser.parse_args()
     if args.command == "index":
         handle_index(args)
+    elif args.command == "retag":
+        handle_retag(args)
+    elif args.command == "serve":
+        handle_serve(args)
+    elif args.command == "metadata":
+        handle_metadata(args)
     elif args.command == "search":
         handle_search(args)
+    elif args.command == "export":
+        handle_export(args)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file